@@ -0,0 +1,79 @@
+from __future__ import absolute_import
+from collections import OrderedDict
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from tastypie.authentication import ApiKeyAuthentication
+from tastypie.models import ApiKey
+from monitor.utils import bump
+from monitor import conf
+import threading
+import time
+
+# per-process cache of API keys that authenticated successfully, keyed by (username, key).
+# Entries expire after conf.AUTH_CACHE_TTL seconds and the least recently used are dropped
+# past conf.AUTH_CACHE_SIZE entries. The handlers below bump a per-user version counter in
+# the shared cache when a User or ApiKey is saved or deleted; every hit compares it with the
+# version its entry was stored at, so a revoked key or deactivated user is refused by the
+# next request in any process. Failed lookups are never cached.
+VERSION_KEY = 'api:auth:version:{}'
+
+_keys = OrderedDict()
+_lock = threading.Lock()
+
+
+class CachedApiKeyAuthentication(ApiKeyAuthentication):
+    """ ApiKeyAuthentication that skips the User and ApiKey queries for keys it has
+    recently accepted """
+
+    def is_authenticated(self, request, **kwargs):
+        try:
+            credentials = self.extract_credentials(request)
+        except ValueError:
+            return self._unauthorized()
+
+        with _lock:
+            cached = _keys.get(credentials)
+        if cached is not None:
+            user, expires, version = cached
+            if expires >= time.time() and version == cache.get(VERSION_KEY.format(user.id), 0):
+                if not self.check_active(user):
+                    return False
+                with _lock:
+                    if credentials in _keys:
+                        _keys.move_to_end(credentials)
+                request.user = user
+                return True
+            with _lock:
+                _keys.pop(credentials, None)
+
+        result = super(CachedApiKeyAuthentication, self).is_authenticated(request, **kwargs)
+        if result is True:
+            version = cache.get(VERSION_KEY.format(request.user.id), 0)
+            with _lock:
+                _keys[credentials] = (request.user, time.time() + conf.AUTH_CACHE_TTL, version)
+                while len(_keys) > conf.AUTH_CACHE_SIZE:
+                    _keys.popitem(last=False)
+        return result
+
+
+def forget(user_id):
+    """ drops every cached key of a user, in every process """
+    with _lock:
+        for credentials in [credentials for credentials, (user, expires, version) in _keys.items()
+                            if user.id == user_id]:
+            del _keys[credentials]
+    bump(VERSION_KEY.format(user_id))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    forget(instance.id)
+
+
+@receiver(post_save, sender=ApiKey)
+@receiver(post_delete, sender=ApiKey)
+def api_key_changed(sender, instance, **kwargs):
+    forget(instance.user_id)
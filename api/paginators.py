@@ -0,0 +1,63 @@
+from __future__ import absolute_import
+from django.db.models import Q
+from tastypie.exceptions import BadRequest
+from tastypie.paginator import Paginator
+from monitor.utils import to_micros, from_micros
+from urllib.parse import urlencode
+
+
+class KeysetPaginator(Paginator):
+    """ pages readings newest first by (monitor_time, id) instead of OFFSET
+
+    Each page's meta.next carries a ?cursor= naming the last reading returned; the next
+    page starts right after it, so every page costs the same however deep it is. ?offset=
+    still works for the first page. ?count=false leaves out meta.total_count and the
+    COUNT(*) behind it. The objects must be ordered by ('-monitor_time', '-id').
+    """
+
+    def page(self):
+        limit = self.get_limit()
+        cursor = self.request_data.get('cursor')
+        objects = self.objects
+        offset = 0
+        if cursor:
+            when, pk = decode_cursor(cursor)
+            objects = objects.filter(Q(monitor_time__lt=when) | Q(monitor_time=when, id__lt=pk))
+        else:
+            offset = self.get_offset()
+
+        # one extra row says whether there is a next page without counting
+        rows = list(objects[offset:offset + limit + 1]) if limit else list(objects[offset:])
+        more = bool(limit) and len(rows) > limit
+        rows = rows[:limit] if limit else rows
+
+        meta = {'limit': limit, 'offset': offset, 'previous': None, 'next': None}
+        if more:
+            meta['next'] = self._cursor_uri(limit, encode_cursor(rows[-1]))
+        if self.request_data.get('count', 'true').lower() not in ('false', '0', 'no'):
+            meta['total_count'] = self.get_count()
+        return {self.collection_name: rows, 'meta': meta}
+
+    def _cursor_uri(self, limit, cursor):
+        if self.resource_uri is None:
+            return None
+        params = dict((key, value) for key, value in self.request_data.items()
+                      if key not in ('limit', 'offset', 'cursor'))
+        params['limit'] = limit
+        params['cursor'] = cursor
+        return '{}?{}'.format(self.resource_uri, urlencode(sorted(params.items())))
+
+
+def encode_cursor(reading):
+    """ '<monitor_time as epoch microseconds>_<id>' for a reading """
+    return '{}_{}'.format(to_micros(reading.monitor_time), reading.pk)
+
+
+def decode_cursor(cursor):
+    try:
+        micros, pk = cursor.split('_')
+        when = from_micros(micros)
+        pk = int(pk)
+    except (ValueError, OverflowError):
+        raise BadRequest('invalid cursor {!r}'.format(cursor))
+    return when, pk
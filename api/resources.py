@@ -1,22 +1,39 @@
-from tastypie import fields
-from tastypie.resources import ModelResource, ALL, ALL_WITH_RELATIONS
-from monitor.models import Monitor, Channel, Reading, ChannelType
+from django.conf.urls import url
+from django.http import HttpResponse
+from django.core.urlresolvers import resolve, Resolver404
+from tastypie import fields, http
+from tastypie.exceptions import BadRequest
+from tastypie.resources import Resource, ModelResource, ALL, ALL_WITH_RELATIONS
+from tastypie.utils import trailing_slash
+from monitor.models import Monitor, Channel, Reading, ChannelType, Rollup
+from monitor.ingest import ingest_readings, parse_time
+from monitor.rollups import summarize
+from monitor.utils import from_seconds
+from monitor import conf, metrics
 from tastypie.authorization import Authorization
-from tastypie.authentication import ApiKeyAuthentication
+from api.authentication import CachedApiKeyAuthentication
+from api.paginators import KeysetPaginator
+import numpy as np
+import time
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 class MonitorResource(ModelResource):
     class Meta:
         queryset = Monitor.objects.all()
         resource_name = 'monitor'
         allowed_methods = ['get']
-        authentication = ApiKeyAuthentication()
+        authentication = CachedApiKeyAuthentication()
 
 class ChannelTypeResource(ModelResource):
     class Meta:
         queryset = ChannelType.objects.all()
         resource_name = 'channel_type'
         allowed_methods = ['get']
-        authentication = ApiKeyAuthentication()
+        authentication = CachedApiKeyAuthentication()
 
 class ChannelResource(ModelResource):
     channel_type = fields.ForeignKey(ChannelTypeResource, 'channel_type')
@@ -25,7 +42,7 @@ class ChannelResource(ModelResource):
         queryset = Channel.objects.all()
         resource_name = 'channel'
         allowed_methods = ['get']
-        authentication = ApiKeyAuthentication()
+        authentication = CachedApiKeyAuthentication()
 
         
 class ReadingResource(ModelResource):
@@ -34,13 +51,224 @@ class ReadingResource(ModelResource):
         always_return_data = True
         queryset = Reading.objects.all()
         authorization = Authorization()
-        authentication = ApiKeyAuthentication()
+        authentication = CachedApiKeyAuthentication()
         allowed_methods = ['get', 'post']
         filtering = {
             'channel': ALL_WITH_RELATIONS,
             'monitor': ALL_WITH_RELATIONS,
+            # combined with channel these are served by the (channel, monitor_time) index
+            'monitor_time': ['exact', 'lt', 'lte', 'gt', 'gte', 'range'],
         }
         resource_name = 'reading'
+        paginator_class = KeysetPaginator
 
     def get_object_list(self, request):
-        return super(ReadingResource, self).get_object_list(request).order_by('-monitor_time')
+        # id breaks monitor_time ties so the paginator's cursors are exact
+        return super(ReadingResource, self).get_object_list(request).order_by('-monitor_time', '-id')
+
+    def apply_sorting(self, obj_list, options=None):
+        # the keyset paginator depends on the default order
+        return obj_list
+
+    def full_dehydrate(self, bundle, for_list=False):
+        """ dehydrates only the ?fields= requested (all of them by default), writing the
+        channel URI from channel_id instead of loading and dehydrating the channel """
+        for name in self._requested_fields(bundle.request):
+            field = self.fields[name]
+            use_in = field.use_in
+            if callable(use_in) and not use_in(bundle):
+                continue
+            if not callable(use_in) and use_in not in ('all', 'list' if for_list else 'detail'):
+                continue
+            if name == 'channel':
+                bundle.data[name] = self._channel_uri(bundle.obj.channel_id)
+            else:
+                bundle.data[name] = field.dehydrate(bundle, for_list=for_list)
+            method = getattr(self, 'dehydrate_%s' % name, None)
+            if method:
+                bundle.data[name] = method(bundle)
+        return self.dehydrate(bundle)
+
+    def _requested_fields(self, request):
+        fields = request.GET.get('fields') if request is not None else None
+        if not fields:
+            return list(self.fields)
+        fields = [name.strip() for name in fields.split(',') if name.strip()]
+        unknown = [name for name in fields if name not in self.fields]
+        if unknown:
+            raise BadRequest('unknown fields: {}'.format(', '.join(unknown)))
+        return fields
+
+    def _channel_uri(self, channel_id):
+        prefix = getattr(self, '_channel_prefix', None)
+        if prefix is None:
+            prefix = self._channel_prefix = self._build_reverse_url('api_dispatch_list', kwargs={
+                'api_name': self._meta.api_name, 'resource_name': ChannelResource._meta.resource_name})
+        return '{}{}/'.format(prefix, channel_id)
+
+    @metrics.timed('reading_create')
+    def obj_create(self, bundle, **kwargs):
+        return super(ReadingResource, self).obj_create(bundle, **kwargs)
+
+    def prepend_urls(self):
+        return [
+            url(r"^(?P<resource_name>%s)/bulk%s$" % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('post_bulk'), name='api_reading_bulk'),
+        ]
+
+    def post_bulk(self, request, **kwargs):
+        """ accepts {"objects": [{"channel": ..., "value": ..., "monitor_time": ...}, ...]}
+        where channel is either a channel URI or id, and writes the readings in one batch """
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        data = self.deserialize(request, request.body, format=request.META.get('CONTENT_TYPE', 'application/json'))
+        if isinstance(data, dict):
+            data = data.get('objects', [])
+        try:
+            rows = [{'channel': _channel_id(obj['channel']),
+                     'value': float(obj['value']),
+                     'monitor_time': parse_time(obj['monitor_time']),
+                     'offset_value': float(obj.get('offset_value', 0.0))} for obj in data]
+            readings = ingest_readings(rows)
+        except (KeyError, TypeError, ValueError) as e:
+            raise BadRequest('invalid reading batch: {}'.format(e))
+
+        self.log_throttled_access(request)
+        return self.create_response(request, {'created': len(readings)}, response_class=http.HttpCreated)
+
+
+class AggregateResource(Resource):
+    """ bucketed statistics of a channel's valid readings
+
+    GET /api/v1/aggregate/?channel=<id or URI>&interval=<seconds>&start=<time>[&end=<time>]
+
+    start and end are epoch seconds or ISO 8601 times (end defaults to now) and are widened
+    to whole intervals. Each object is {"bucket", "min", "max", "mean", "count"} with bucket
+    the start of the interval. Minute, hour and day multiples are served from the rollups,
+    and readings the rollups haven't folded in yet from the raw readings.
+    """
+    class Meta:
+        resource_name = 'aggregate'
+        allowed_methods = ['get']
+        authentication = CachedApiKeyAuthentication()
+        authorization = Authorization()
+
+    def get_list(self, request, **kwargs):
+        try:
+            channel_id = _channel_id(request.GET['channel'])
+            interval = int(request.GET.get('interval', Rollup.HOUR))
+            start = _time(request.GET['start'])
+            end = _time(request.GET['end']) if request.GET.get('end') else parse_time(time.time())
+        except KeyError as e:
+            raise BadRequest('missing parameter {}'.format(e))
+        except (TypeError, ValueError, OverflowError) as e:
+            raise BadRequest('invalid parameter: {}'.format(e))
+        if interval <= 0:
+            raise BadRequest('interval must be positive')
+        if (end - start).total_seconds() / interval > conf.AGGREGATE_MAX_BUCKETS:
+            raise BadRequest('more than {} buckets; use a longer interval'.format(conf.AGGREGATE_MAX_BUCKETS))
+        if not Channel.objects.filter(pk=channel_id).exists():
+            return http.HttpNotFound()
+
+        buckets, minimum, maximum, mean, count = summarize(channel_id, start, end, interval)
+        objects = [{'bucket': from_seconds(bucket), 'min': low, 'max': high, 'mean': average, 'count': int(n)}
+                   for bucket, low, high, average, n in zip(buckets.tolist(), minimum.tolist(), maximum.tolist(),
+                                                            mean.tolist(), count.tolist())]
+        return self.create_response(request, {'channel': channel_id, 'interval': interval, 'objects': objects})
+
+
+class IngestResource(Resource):
+    """ compact reading upload for devices, next to ReadingResource
+
+    POST /api/v1/ingest/ with either
+
+      text/csv - one line per channel: "channel id,epoch seconds,value[,value...]"; extra
+                 values are later samples ?step= seconds apart
+      application/x-msgpack - an array of [channel id, epoch seconds, value] or
+                 [channel id, epoch seconds, step, values] entries, where values is a
+                 list of numbers or packed little-endian float32 bytes
+
+    The readings go through monitor.ingest in one batch and the response is just the
+    number created; nothing is deserialized into bundles or echoed back.
+    """
+    class Meta:
+        resource_name = 'ingest'
+        allowed_methods = ['post']
+        authentication = CachedApiKeyAuthentication()
+        authorization = Authorization()
+
+    def post_list(self, request, **kwargs):
+        content_type = request.META.get('CONTENT_TYPE', 'text/csv').split(';')[0].strip()
+        try:
+            step = float(request.GET.get('step', 0))
+            if content_type == 'application/x-msgpack':
+                if msgpack is None:
+                    return HttpResponse('msgpack is not installed on this server', status=415)
+                rows = compact_msgpack(request.body)
+            elif content_type in ('text/csv', 'text/plain'):
+                rows = compact_csv(request.body.decode('ascii'), step)
+            else:
+                return HttpResponse('unsupported content type {}'.format(content_type), status=415)
+            readings = ingest_readings(rows)
+        except (TypeError, ValueError, UnicodeDecodeError) as e:
+            return http.HttpBadRequest('invalid readings: {}'.format(e), content_type='text/plain')
+        return http.HttpCreated(str(len(readings)), content_type='text/plain')
+
+
+def compact_csv(text, step=0):
+    """ reading rows from "channel,epoch,value[,value...]" lines """
+    rows = []
+    for line in text.splitlines():
+        fields = line.strip().split(',')
+        if fields == ['']:
+            continue
+        if len(fields) < 3:
+            raise ValueError('expected channel,epoch,value: {!r}'.format(line))
+        rows.extend(_samples(int(fields[0]), float(fields[1]), step, [float(value) for value in fields[2:]]))
+    return rows
+
+
+def compact_msgpack(body):
+    """ reading rows from a msgpack array of [channel, epoch, value] or
+    [channel, epoch, step, values] entries """
+    rows = []
+    for entry in msgpack.unpackb(body):
+        if len(entry) == 3:
+            rows.extend(_samples(int(entry[0]), float(entry[1]), 0, [float(entry[2])]))
+        elif len(entry) == 4:
+            values = entry[3]
+            if isinstance(values, bytes):
+                values = np.frombuffer(values, dtype='<f4').tolist()
+            rows.extend(_samples(int(entry[0]), float(entry[1]), float(entry[2]), [float(value) for value in values]))
+        else:
+            raise ValueError('expected [channel, epoch, value] or [channel, epoch, step, values]')
+    return rows
+
+
+def _samples(channel_id, epoch, step, values):
+    if len(values) > 1 and step <= 0:
+        raise ValueError('several values for channel {} need a step'.format(channel_id))
+    return [{'channel': channel_id, 'value': value, 'monitor_time': parse_time(epoch + i * step)}
+            for i, value in enumerate(values)]
+
+
+def _channel_id(value):
+    """ a channel id from an id or a channel URI """
+    if isinstance(value, int):
+        return value
+    value = str(value)
+    if value.isdigit():
+        return int(value)
+    try:
+        return int(resolve(value).kwargs['pk'])
+    except (Resolver404, KeyError):
+        raise ValueError('bad channel {}'.format(value))
+
+
+def _time(value):
+    try:
+        return parse_time(float(value))
+    except ValueError:
+        return parse_time(value)
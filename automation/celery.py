@@ -1,6 +1,8 @@
 from __future__ import absolute_import
 import os
+from datetime import timedelta
 from celery import Celery
+from kombu import Exchange, Queue
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'automation.settings')
 
@@ -10,3 +12,58 @@ app=Celery('automation')
 app.config_from_object('django.conf:settings')
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
+# periodic jobs; entries in settings.CELERYBEAT_SCHEDULE take precedence
+app.conf.CELERYBEAT_SCHEDULE = dict({
+    'update-rollups': {
+        'task': 'monitor.tasks.update_rollups',
+        'schedule': timedelta(minutes=1),
+    },
+    'check-overdue': {
+        'task': 'monitor.tasks.check_overdue',
+        'schedule': timedelta(minutes=1),
+    },
+    'send-digests': {
+        'task': 'monitor.tasks.send_digests',
+        'schedule': timedelta(minutes=1),
+    },
+    'compact-readings': {
+        'task': 'monitor.tasks.compact_readings',
+        'schedule': timedelta(days=1),
+    },
+    'enforce-retention': {
+        'task': 'monitor.tasks.enforce_retention',
+        'schedule': timedelta(hours=1),
+    },
+}, **(app.conf.CELERYBEAT_SCHEDULE or {}))
+
+# Work is split over three queues so a slow SMTP server or a long housekeeping job can't
+# hold up rule evaluation; run a worker (or pool) per queue, e.g.
+#   celery -A automation worker -Q readings -c 8
+#   celery -A automation worker -Q alerts -c 4
+#   celery -A automation worker -Q housekeeping,celery -c 2
+# Within a queue, higher priority (0-9) messages go first on brokers that support it
+# (RabbitMQ 3.5+ with x-max-priority, Redis). RabbitMQ won't redeclare an existing queue
+# with different arguments (PRECONDITION_FAILED), so the default 'celery' queue, which
+# existing brokers already have, keeps its plain declaration; to give a queue priorities
+# later, drain and delete it first. Workers running the evaluate_readings batch consumer
+# (MONITOR_BATCHED_EVALUATION) should prefetch at least MONITOR_EVALUATE_BATCH messages:
+# CELERYD_PREFETCH_MULTIPLIER = 0, or concurrency times the multiplier above it.
+app.conf.CELERY_QUEUES = app.conf.CELERY_QUEUES or tuple(
+    Queue(name, Exchange(name), routing_key=name, queue_arguments={'x-max-priority': 10})
+    for name in ('readings', 'alerts', 'housekeeping')) + (Queue('celery', Exchange('celery'), routing_key='celery'),)
+
+# task routes; entries in settings.CELERY_ROUTES take precedence
+app.conf.CELERY_ROUTES = dict({
+    'monitor.tasks.process_reading': {'queue': 'readings', 'routing_key': 'readings', 'priority': 6},
+    'monitor.tasks.process_readings': {'queue': 'readings', 'routing_key': 'readings', 'priority': 6},
+    'monitor.tasks.evaluate_readings': {'queue': 'readings', 'routing_key': 'readings', 'priority': 6},
+    'monitor.tasks.update_pointers': {'queue': 'readings', 'routing_key': 'readings', 'priority': 3},
+    'monitor.tasks.process_alert': {'queue': 'alerts', 'routing_key': 'alerts', 'priority': 8},
+    'monitor.tasks.process_alerts': {'queue': 'alerts', 'routing_key': 'alerts', 'priority': 8},
+    'monitor.tasks.send_digests': {'queue': 'alerts', 'routing_key': 'alerts', 'priority': 4},
+    'monitor.tasks.unpause': {'queue': 'housekeeping', 'routing_key': 'housekeeping', 'priority': 7},
+    'monitor.tasks.check_overdue': {'queue': 'housekeeping', 'routing_key': 'housekeeping', 'priority': 7},
+    'monitor.tasks.update_rollups': {'queue': 'housekeeping', 'routing_key': 'housekeeping', 'priority': 3},
+    'monitor.tasks.compact_readings': {'queue': 'housekeeping', 'routing_key': 'housekeeping', 'priority': 0},
+    'monitor.tasks.enforce_retention': {'queue': 'housekeeping', 'routing_key': 'housekeeping', 'priority': 0},
+}, **(app.conf.CELERY_ROUTES or {}))
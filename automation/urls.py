@@ -9,6 +9,8 @@ v1_api.register(MonitorResource())
 v1_api.register(ChannelTypeResource())
 v1_api.register(ChannelResource())
 v1_api.register(ReadingResource())
+v1_api.register(IngestResource())
+v1_api.register(AggregateResource())
 
 urlpatterns = [
     url(r'^$', include('monitor.urls')),
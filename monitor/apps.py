@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class MonitorConfig(AppConfig):
     name = 'monitor'
+
+    def ready(self):
+        # connect the channel state and unit cache invalidation handlers and the alert event publisher
+        from monitor import state, events, units
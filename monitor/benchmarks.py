@@ -0,0 +1,284 @@
+from __future__ import absolute_import
+from contextlib import contextmanager
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import Max
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from monitor.models import Monitor, Unit, ChannelType, Channel, Reading, RuleType, Rule, Preference
+from monitor.state import invalidate
+from monitor.engine import reset_engine
+import numpy as np
+import datetime
+import json
+import os
+import random
+import subprocess
+import time
+import tracemalloc
+
+# Shared pieces of the benchmark commands. A run builds a throwaway test database from
+# the configured DATABASES (SQLite, or Postgres when the settings point at one), runs
+# Celery eagerly so every stage includes the tasks it queues, and reports one summary per
+# stage. Results are JSON so runs from different commits can be compared.
+
+SCHEMA = 1
+
+
+class Stage(object):
+    """ wall-clock time and query count of each call in a benchmark stage """
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = []
+        self.queries = []
+        self.peaks = []
+
+    def run(self, call):
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            result = call()
+            self.seconds.append(time.perf_counter() - started)
+        self.queries.append(len(captured))
+        return result
+
+    def trace(self, call):
+        """ runs a call under tracemalloc and records its peak allocation; kept apart from
+        run() because tracing slows every allocation down """
+        tracemalloc.start()
+        try:
+            result = call()
+            self.peaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+        return result
+
+    def summary(self, items=1):
+        """ items is the number of readings/alerts handled per call, for throughput """
+        seconds = np.array(self.seconds)
+        queries = np.array(self.queries, dtype=np.float64)
+        total = float(seconds.sum())
+        summary = {
+            'calls': len(self.seconds),
+            'items_per_call': items,
+            'total_s': total,
+        }
+        if not self.seconds:
+            # nothing was timed (--repeat 0), so there are no timings to summarize
+            summary.update((key, None) for key in (
+                'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'items_per_s', 'queries_per_call',
+                'max_queries'))
+        else:
+            summary.update({
+                'mean_ms': float(seconds.mean() * 1000),
+                'p50_ms': float(np.percentile(seconds, 50) * 1000),
+                'p95_ms': float(np.percentile(seconds, 95) * 1000),
+                'p99_ms': float(np.percentile(seconds, 99) * 1000),
+                'max_ms': float(seconds.max() * 1000),
+                'items_per_s': len(self.seconds) * items / total if total else None,
+                'queries_per_call': float(queries.mean()),
+                'max_queries': int(queries.max()),
+            })
+        if self.peaks:
+            summary['peak_kb'] = max(self.peaks) / 1024.0
+        return summary
+
+
+@contextmanager
+def environment(keepdb=False):
+    """ runs the enclosed block against a fresh test database with eager Celery and the
+    in-memory mail backend """
+    from automation.celery import app
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=keepdb)
+    eager = app.conf.CELERY_ALWAYS_EAGER
+    app.conf.CELERY_ALWAYS_EAGER = True
+    try:
+        yield
+    finally:
+        app.conf.CELERY_ALWAYS_EAGER = eager
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keepdb)
+        teardown_test_environment()
+
+
+def seed(monitors=10, channels=8, rules=2, contacts=3, seed=0):
+    """ creates synthetic monitors, channels, rules and contacts
+
+    Inputs:
+      monitors - number of monitors
+      channels - channels per monitor
+      rules - rules per channel, drawn from low/high/range thresholds around 50
+      contacts - users notified by every rule (and every monitor's overdue alerts)
+      seed - random seed; the same seed gives the same data
+
+    Outputs:
+      dict with the created users, channel ids and the API key of the first user
+    """
+    rng = random.Random(seed)
+    unit = Unit.objects.create(name='bench', unit_metric='unit', unit_imperial='unit',
+                               abbrev_metric='u', abbrev_imperial='u')
+    channel_type = ChannelType.objects.create(sensor_name='bench', common_name='bench', units=unit)
+    rule_types = [RuleType.objects.create(name=name, description=name, eval_func=name)
+                  for name in ('eval_lt', 'eval_gt', 'range')]
+
+    users = []
+    for i in range(contacts):
+        user = User.objects.create_user('bench{}'.format(i), 'bench{}@example.com'.format(i), 'bench')
+        Preference.objects.create(user=user)
+        users.append(user)
+
+    Monitor.objects.bulk_create([Monitor(name='bench {}'.format(i), location='bench', expected_interval=60)
+                                 for i in range(monitors)])
+    monitor_ids = list(Monitor.objects.order_by('pk').values_list('pk', flat=True))
+    Channel.objects.bulk_create([Channel(monitor_id=monitor_id, channel_num=n, channel_type=channel_type,
+                                         name='channel {}'.format(n), status=Channel.ENABLED)
+                                 for monitor_id in monitor_ids for n in range(channels)])
+    channel_ids = list(Channel.objects.order_by('pk').values_list('pk', flat=True))
+
+    Rule.objects.bulk_create([Rule(name='bench', rule_type=rng.choice(rule_types),
+                                   lower_threshold=rng.uniform(10, 30), upper_threshold=rng.uniform(70, 90),
+                                   action=Rule.SEND_EMAIL_TEXT_ALERT)
+                              for channel_id in channel_ids for n in range(rules)])
+    rule_ids = list(Rule.objects.order_by('pk').values_list('pk', flat=True))
+    Channel.rules.through.objects.bulk_create([Channel.rules.through(channel_id=channel_id, rule_id=rule_id)
+                                               for channel_id, rule_id in zip(np.repeat(channel_ids, rules).tolist(),
+                                                                              rule_ids)])
+    Rule.contacts.through.objects.bulk_create([Rule.contacts.through(rule_id=rule_id, user_id=user.id)
+                                               for rule_id in rule_ids for user in users])
+    Monitor.contacts.through.objects.bulk_create([Monitor.contacts.through(monitor_id=monitor_id, user_id=user.id)
+                                                  for monitor_id in monitor_ids for user in users])
+    reset_engine()
+    for channel_id in channel_ids:
+        invalidate(channel_id)
+    return {'users': users, 'channel_ids': channel_ids,
+            'api_key': 'ApiKey {}:{}'.format(users[0].username, users[0].api_key.key)}
+
+
+def stream(channel_ids, count, seed=0, start=None, step=60, excursion=0.02):
+    """ yields `count` synthetic (channel_id, monitor_time, value) readings, cycling over
+    the channels; values random-walk around 50 and a fraction `excursion` of them jump
+    outside the rule thresholds """
+    rng = random.Random(seed)
+    when = start or datetime.datetime(2016, 1, 1)
+    values = dict((channel_id, 50.0) for channel_id in channel_ids)
+    for i in range(count):
+        channel_id = channel_ids[i % len(channel_ids)]
+        if rng.random() < excursion:
+            value = rng.choice((rng.uniform(0, 10), rng.uniform(90, 100)))
+        else:
+            value = min(max(values[channel_id] + rng.gauss(0, 1), 35), 65)
+            values[channel_id] = value
+        yield channel_id, _aware(when + datetime.timedelta(seconds=step * (i // len(channel_ids)))), value
+
+
+def new_readings(rows):
+    """ inserts readings without Reading.save (so no tasks run) and returns them in order """
+    last = Reading.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    Reading.objects.bulk_create([Reading(channel_id=channel_id, monitor_time=monitor_time, value=value)
+                                 for channel_id, monitor_time, value in rows])
+    return list(Reading.objects.filter(pk__gt=last).order_by('pk'))
+
+
+def seed_history(channel_ids, count, days=365, seed=0, chunk=5000):
+    """ gives every channel `count` readings spread evenly over the last `days` days,
+    points the channels at their newest reading and builds the rollups """
+    from monitor.ingest import set_pointers
+    from monitor.rollups import update_rollups
+    rng = random.Random(seed)
+    end = datetime.datetime.now().replace(microsecond=0)
+    step = days * 86400.0 / count
+    for channel_id in channel_ids:
+        value = 50.0
+        rows = []
+        for i in range(count):
+            value = min(max(value + rng.gauss(0, 0.5), 35), 65)
+            rows.append(Reading(channel_id=channel_id, value=value,
+                                monitor_time=_aware(end - datetime.timedelta(seconds=step * (count - 1 - i)))))
+        Reading.objects.bulk_create(rows, batch_size=chunk)
+    newest = list(Reading.objects.filter(channel_id__in=channel_ids).values('channel_id')
+                  .annotate(latest=Max('pk')).values_list('latest', flat=True))
+    latest = dict((channel_id, (pk, monitor_time)) for pk, channel_id, monitor_time in
+                  Reading.objects.filter(pk__in=newest).values_list('pk', 'channel_id', 'monitor_time'))
+    set_pointers(latest, list(Monitor.objects.values_list('pk', flat=True)), latest_valid=latest)
+    while update_rollups():
+        pass
+
+
+def revision():
+    """ the commit the benchmark ran against, with '-dirty' when the tree has changes """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty.strip() else '')
+
+
+def report(name, params, stages):
+    """ the machine-readable result of a benchmark run """
+    return {
+        'schema': SCHEMA,
+        'benchmark': name,
+        'revision': revision(),
+        'database': connection.vendor,
+        'started': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'params': params,
+        'stages': stages,
+    }
+
+
+def compare(result, baseline, tolerance):
+    """ compares each stage's mean and p95 time and query count against a baseline run
+
+    Outputs:
+      (lines, regressions) - a printable line per stage and the names of stages that are
+      more than `tolerance` (a fraction) slower or issue more queries per call
+    """
+    lines = []
+    regressions = []
+    for name, stage in sorted(result['stages'].items()):
+        old = baseline.get('stages', {}).get(name)
+        if old is None:
+            lines.append('{:<20} new stage'.format(name))
+            continue
+        if stage['mean_ms'] is None or old['mean_ms'] is None:
+            lines.append('{:<20} not timed'.format(name))
+            continue
+        mean = stage['mean_ms'] / old['mean_ms'] if old['mean_ms'] else 1.0
+        p95 = stage['p95_ms'] / old['p95_ms'] if old['p95_ms'] else 1.0
+        slower = max(mean, p95) > 1 + tolerance
+        more_queries = stage['queries_per_call'] > old['queries_per_call']
+        lines.append('{:<20} mean {:8.3f}ms x{:.2f}  p95 {:8.3f}ms x{:.2f}  queries {:.1f} (was {:.1f}){}'.format(
+            name, stage['mean_ms'], mean, stage['p95_ms'], p95, stage['queries_per_call'],
+            old['queries_per_call'], '  REGRESSION' if slower or more_queries else ''))
+        if slower or more_queries:
+            regressions.append(name)
+    return lines, regressions
+
+
+def check(result, path, tolerance, write):
+    """ compares a result with the baseline saved at `path`, writing a line per stage,
+    and raises CommandError if any stage regressed """
+    with open(path) as baseline:
+        lines, regressions = compare(result, json.load(baseline), tolerance)
+    for line in lines:
+        write(line)
+    if regressions:
+        raise CommandError('regressions in: {}'.format(', '.join(regressions)))
+
+
+def write(result, path=None):
+    text = json.dumps(result, indent=2, sort_keys=True)
+    if path:
+        with open(path, 'w') as output:
+            output.write(text + '\n')
+    return text
+
+
+def _aware(when):
+    if settings.USE_TZ:
+        from django.utils import timezone
+        return timezone.make_aware(when, timezone.utc)
+    return when
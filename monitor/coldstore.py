@@ -0,0 +1,231 @@
+from __future__ import absolute_import
+from django.db import transaction
+from monitor.models import Channel, Reading, Alert
+from monitor.utils import to_seconds, from_seconds, batches
+from monitor import conf
+import numpy as np
+import datetime
+import os
+import shutil
+
+# Readings older than conf.HOT_DAYS are moved out of the Reading table into one partition
+# per channel and month under conf.COLD_STORAGE:
+#
+#   <root>/<channel id>/<YYYY-MM>/id.npy     int64    reading ids
+#                                 time.npy   int64    microseconds since the start of the month
+#                                 value.npy  float32
+#                                 valid.npy  bool
+#
+# The arrays are sorted by time and are read back memory-mapped. Partitions written before
+# sub-second times were kept hold uint32 whole seconds in time.npy; partition_times() reads
+# either. Readings referenced by
+# alerts or by a channel's last_reading/last_valid_reading pointers stay in the table.
+
+COLUMNS = ('id', 'time', 'value', 'valid')
+
+
+def month_start(when):
+    return when.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(when):
+    when = month_start(when)
+    if when.month == 12:
+        return when.replace(year=when.year + 1, month=1)
+    return when.replace(month=when.month + 1)
+
+
+def partition_path(channel_id, month):
+    return os.path.join(conf.COLD_STORAGE, str(channel_id), month.strftime('%Y-%m'))
+
+
+def partitions(channel_id):
+    """ returns the months (as datetimes) that have a cold partition for the channel """
+    if not conf.COLD_STORAGE:
+        return []
+    path = os.path.join(conf.COLD_STORAGE, str(channel_id))
+    if not os.path.isdir(path):
+        return []
+    months = []
+    for name in sorted(os.listdir(path)):
+        try:
+            months.append(datetime.datetime.strptime(name, '%Y-%m'))
+        except ValueError:
+            continue
+    return months
+
+
+def load_partition(channel_id, month):
+    """ returns the partition's columns as a dict of (memory-mapped) arrays, or None """
+    path = partition_path(channel_id, month)
+    if not os.path.isdir(path):
+        return None
+    return dict((column, np.load(os.path.join(path, column + '.npy'), mmap_mode='r')) for column in COLUMNS)
+
+
+def partition_times(columns):
+    """ a partition's time column as int64 microseconds since the start of its month """
+    times = np.asarray(columns['time'])
+    if times.dtype == np.uint32:
+        return times.astype(np.int64) * 1000000
+    return times
+
+
+def write_partition(channel_id, month, columns):
+    """ writes a partition, replacing any existing one in a single rename """
+    path = partition_path(channel_id, month)
+    tmp = path + '.tmp'
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    for column in COLUMNS:
+        np.save(os.path.join(tmp, column + '.npy'), columns[column])
+    old = path + '.old'
+    if os.path.isdir(path):
+        os.rename(path, old)
+    os.rename(tmp, path)
+    if os.path.isdir(old):
+        shutil.rmtree(old)
+
+
+def readings_between(channel_id, start, end=None, valid_only=True, size=None):
+    """ yields (epoch seconds, values) array pairs for a channel's readings in [start, end),
+    in time order, reading cold partitions and the Reading table as needed """
+    size = size or conf.HISTORY_BATCH
+    months = [month for month in partitions(channel_id)
+              if next_month(month) > _naive(start) and (end is None or month < _naive(end))]
+    # months with a partition are read one at a time, merged with any readings of that
+    # month still in the table (late or pinned ones); the stretches between them, before
+    # the first and after the last come from the table alone
+    position = _naive(start)
+    for month in months:
+        if position < month:
+            for batch in batches(_hot(channel_id, position, month, valid_only), size):
+                yield batch
+        seconds, values = _cold(channel_id, month, start, end, valid_only)
+        hot_seconds, hot_values = _hot_arrays(channel_id, max(month, _naive(start)),
+                                              min(next_month(month), _naive(end)) if end else next_month(month),
+                                              valid_only)
+        if len(hot_seconds):
+            seconds = np.concatenate([seconds, hot_seconds])
+            values = np.concatenate([values, hot_values])
+            order = np.argsort(seconds, kind='mergesort')
+            seconds, values = seconds[order], values[order]
+        for i in range(0, len(seconds), size):
+            yield seconds[i:i + size], values[i:i + size]
+        position = max(position, next_month(month))
+
+    if end is not None and position >= _naive(end):
+        return
+    for batch in batches(_hot(channel_id, position, end, valid_only), size):
+        yield batch
+
+
+def pinned_readings():
+    """ ids of readings that must stay in the Reading table """
+    pinned = set(Alert.objects.filter(reading__isnull=False).values_list('reading_id', flat=True))
+    for last, last_valid in Channel.objects.values_list('last_reading_id', 'last_valid_reading_id'):
+        pinned.add(last)
+        pinned.add(last_valid)
+    pinned.discard(None)
+    return pinned
+
+
+def compact(before=None):
+    """ moves readings older than `before` (default: conf.HOT_DAYS ago) into cold partitions
+
+    Outputs:
+      number of readings moved
+    """
+    if not conf.COLD_STORAGE:
+        return 0
+    cutoff = before or datetime.datetime.now() - datetime.timedelta(days=conf.HOT_DAYS)
+    pinned = pinned_readings()
+    moved = 0
+    for channel_id in Channel.objects.values_list('pk', flat=True):
+        oldest = (Reading.objects.filter(channel_id=channel_id, monitor_time__lt=cutoff)
+                  .order_by('monitor_time').values_list('monitor_time', flat=True).first())
+        if oldest is None:
+            continue
+        month = month_start(_naive(oldest))
+        while month < _naive(cutoff):
+            moved += _compact_month(channel_id, month, min(next_month(month), _naive(cutoff)), pinned)
+            month = next_month(month)
+    return moved
+
+
+def _compact_month(channel_id, month, end, pinned):
+    rows = [row for row in (Reading.objects.filter(channel_id=channel_id, monitor_time__gte=_db(month),
+                                                   monitor_time__lt=_db(end))
+                            .values_list('id', 'monitor_time', 'value', 'is_valid').iterator())
+            if row[0] not in pinned]
+    if len(rows) == 0:
+        return 0
+    ids, times, values, valid = zip(*rows)
+    base = (np.datetime64(month, 's') - np.datetime64('1970-01-01T00:00:00', 's')).astype(np.int64)
+    columns = {'id': np.array(ids, dtype=np.int64),
+               'time': np.round((to_seconds(times) - base) * 1e6).astype(np.int64),
+               'value': np.array(values, dtype=np.float32),
+               'valid': np.array(valid, dtype=bool)}
+
+    existing = load_partition(channel_id, month)
+    if existing is not None:
+        # the ids make a re-run after an interrupted compaction harmless
+        existing = dict(existing, time=partition_times(existing))
+        columns = dict((column, np.concatenate([np.asarray(existing[column]), columns[column]])) for column in COLUMNS)
+        ids, first = np.unique(columns['id'], return_index=True)
+        columns = dict((column, columns[column][first]) for column in COLUMNS)
+    order = np.argsort(columns['time'], kind='mergesort')
+    write_partition(channel_id, month, dict((column, columns[column][order]) for column in COLUMNS))
+
+    moved = [row[0] for row in rows]
+    for i in range(0, len(moved), 1000):
+        with transaction.atomic():
+            Reading.objects.filter(pk__in=moved[i:i + 1000]).delete()
+    return len(moved)
+
+
+def _cold(channel_id, month, start, end, valid_only):
+    columns = load_partition(channel_id, month)
+    times = partition_times(columns)
+    base = (np.datetime64(month, 's') - np.datetime64('1970-01-01T00:00:00', 's')).astype(np.int64)
+    first = np.searchsorted(times, _micros(_seconds(start) - base), 'left')
+    last = len(times) if end is None else np.searchsorted(times, _micros(_seconds(end) - base), 'left')
+    seconds = times[first:last] / 1e6 + base
+    values = columns['value'][first:last].astype(np.float64)
+    if valid_only:
+        mask = np.asarray(columns['valid'][first:last])
+        seconds, values = seconds[mask], values[mask]
+    return seconds, values
+
+
+def _hot(channel_id, start, end, valid_only):
+    rows = Reading.objects.filter(channel_id=channel_id, monitor_time__gte=_db(start))
+    if end is not None:
+        rows = rows.filter(monitor_time__lt=_db(end))
+    if valid_only:
+        rows = rows.filter(is_valid=True)
+    return rows.order_by('monitor_time').values_list('monitor_time', 'value')
+
+
+def _hot_arrays(channel_id, start, end, valid_only):
+    for seconds, values in batches(_hot(channel_id, start, end, valid_only), 1 << 30):
+        return seconds, values
+    return np.array([]), np.array([])
+
+
+def _micros(seconds):
+    return max(0, int(round(seconds * 1e6)))
+
+
+def _seconds(when):
+    return to_seconds([when])[0]
+
+
+def _naive(when):
+    # partition boundaries are handled as naive UTC
+    return from_seconds(_seconds(when)).replace(tzinfo=None)
+
+
+def _db(when):
+    return from_seconds(_seconds(when))
@@ -0,0 +1,86 @@
+from django.conf import settings
+
+# when True, Reading.save only inserts the reading and the channel's last_reading and the
+# monitor's last_update are written later by a coalescing update_pointers task
+DEFERRED_POINTERS = getattr(settings, 'MONITOR_DEFERRED_POINTERS', False)
+# seconds to wait before flushing deferred pointers; updates inside the window are merged
+POINTER_FLUSH_DELAY = getattr(settings, 'MONITOR_POINTER_FLUSH_DELAY', 5)
+# seconds a process keeps its cached per-channel state (see monitor.state) before reloading
+STATE_TTL = getattr(settings, 'MONITOR_STATE_TTL', 60)
+# most new readings update_rollups folds in per run
+ROLLUP_BATCH = getattr(settings, 'MONITOR_ROLLUP_BATCH', 50000)
+# seconds a reading must have been stored before update_rollups takes it; longer than any
+# transaction that writes readings, so the checkpoint can't pass an uncommitted one
+ROLLUP_LAG = getattr(settings, 'MONITOR_ROLLUP_LAG', 60)
+# points the history chart aims for; roughly its width in pixels
+HISTORY_POINTS = getattr(settings, 'MONITOR_HISTORY_POINTS', 1000)
+# rows per batch when streaming history responses
+HISTORY_BATCH = getattr(settings, 'MONITOR_HISTORY_BATCH', 5000)
+# seconds the dashboard's latest-value snapshot is reused before being rebuilt
+DASHBOARD_TTL = getattr(settings, 'MONITOR_DASHBOARD_TTL', 10)
+# directory for the cold reading partitions (see monitor.coldstore); None keeps every
+# reading in the Reading table
+COLD_STORAGE = getattr(settings, 'MONITOR_COLD_STORAGE', None)
+# days of readings kept in the Reading table before compaction into cold storage
+HOT_DAYS = getattr(settings, 'MONITOR_HOT_DAYS', 30)
+# directory raw readings are exported to before retention deletes them; retention is not
+# enforced while this is unset
+ARCHIVE_ROOT = getattr(settings, 'MONITOR_ARCHIVE_ROOT', None)
+# readings exported and deleted per transaction by the retention job
+RETENTION_CHUNK = getattr(settings, 'MONITOR_RETENTION_CHUNK', 1000)
+# times failed notification recipients are retried, and the delay before the first retry
+# in seconds (doubled for each further attempt)
+NOTIFY_RETRIES = getattr(settings, 'MONITOR_NOTIFY_RETRIES', 3)
+NOTIFY_RETRY_DELAY = getattr(settings, 'MONITOR_NOTIFY_RETRY_DELAY', 60)
+# default minutes between reminders for an open, unacknowledged alert
+RENOTIFY_MINUTES = getattr(settings, 'MONITOR_RENOTIFY_MINUTES', 30)
+# default seconds between a monitor's reports, and how many reports it may miss before an
+# overdue alert is raised
+EXPECTED_INTERVAL = getattr(settings, 'MONITOR_EXPECTED_INTERVAL', 300)
+OVERDUE_MISSES = getattr(settings, 'MONITOR_OVERDUE_MISSES', 3)
+# no monitor is considered overdue before it has been silent this many seconds; bounds
+# the overdue detector's range query
+OVERDUE_MIN_SECONDS = getattr(settings, 'MONITOR_OVERDUE_MIN_SECONDS', 180)
+# record hot-path timings and counts (see monitor.metrics)
+METRICS_ENABLED = getattr(settings, 'MONITOR_METRICS_ENABLED', True)
+# directory each process writes its metrics to so /monitor/metrics can report all of them;
+# None reports only the process serving the request
+METRICS_DIR = getattr(settings, 'MONITOR_METRICS_DIR', None)
+# seconds between a process's metric writes
+METRICS_FLUSH = getattr(settings, 'MONITOR_METRICS_FLUSH', 15)
+# seconds after its last write a process's metrics file is dropped (and deleted)
+METRICS_MAX_AGE = getattr(settings, 'MONITOR_METRICS_MAX_AGE', 3600)
+# when set, /monitor/metrics requires an "Authorization: Bearer <token>" header; otherwise
+# it is only served to logged-in staff
+METRICS_TOKEN = getattr(settings, 'MONITOR_METRICS_TOKEN', None)
+# seconds an accepted API key is trusted without checking the database, and how many
+# keys each process remembers
+AUTH_CACHE_TTL = getattr(settings, 'MONITOR_AUTH_CACHE_TTL', 300)
+AUTH_CACHE_SIZE = getattr(settings, 'MONITOR_AUTH_CACHE_SIZE', 1000)
+# most buckets one aggregation request may ask for
+AGGREGATE_MAX_BUCKETS = getattr(settings, 'MONITOR_AGGREGATE_MAX_BUCKETS', 10000)
+# seconds new readings and alert changes stay in the live event log, and the most events
+# a lagging /monitor/events client is sent at once
+EVENT_TTL = getattr(settings, 'MONITOR_EVENT_TTL', 120)
+EVENT_BACKLOG = getattr(settings, 'MONITOR_EVENT_BACKLOG', 1000)
+# seconds between a page's polls of /monitor/events, and seconds a reader waits for an
+# event whose number was taken before skipping it (see monitor.events)
+EVENT_POLL = getattr(settings, 'MONITOR_EVENT_POLL', 5)
+EVENT_GRACE = getattr(settings, 'MONITOR_EVENT_GRACE', 5)
+# readings the ewma and mad glitch filters look back over (see monitor.filters)
+GLITCH_WINDOW = getattr(settings, 'MONITOR_GLITCH_WINDOW', 15)
+# change, in a channel type's units, never treated as a glitch when the type doesn't set
+# its own; keeps the relative filters from rejecting small moves of readings near zero
+GLITCH_TOLERANCE = getattr(settings, 'MONITOR_GLITCH_TOLERANCE', 1.0)
+# queue readings saved one at a time to the evaluate_readings batch consumer (needs
+# celery.contrib.batches or the celery-batches package) instead of a process_reading task
+# each; a batch is evaluated when it holds EVALUATE_BATCH readings or EVALUATE_WAIT
+# milliseconds after its first one arrived. Batched messages are acknowledged as they are
+# buffered, so a worker that dies or is restarted drops the readings it was holding
+# without evaluating them (rules see the channel's next reading as usual)
+BATCHED_EVALUATION = getattr(settings, 'MONITOR_BATCHED_EVALUATION', False)
+EVALUATE_BATCH = getattr(settings, 'MONITOR_EVALUATE_BATCH', 200)
+EVALUATE_WAIT = getattr(settings, 'MONITOR_EVALUATE_WAIT', 250)
+# seconds a channel's glitch filter state is kept in the shared cache after its last
+# reading; after that it is rebuilt from the channel's latest readings
+FILTER_STATE_TTL = getattr(settings, 'MONITOR_FILTER_STATE_TTL', 86400)
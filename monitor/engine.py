@@ -0,0 +1,128 @@
+from __future__ import absolute_import
+from django.core.cache import cache
+from monitor.models import Channel, Rule
+from monitor.utils import bump
+from monitor import conf, metrics
+import numpy as np
+import threading
+import time
+
+# vectorized versions of the Rule.eval_* methods, keyed by RuleType.eval_func. Missing
+# thresholds are stored as NaN, which never compares true.
+OPERATORS = {
+    'eval_lt': lambda values, lower, upper: values < lower,
+    'eval_lte': lambda values, lower, upper: values <= lower,
+    'eval_gt': lambda values, lower, upper: values > upper,
+    'eval_gte': lambda values, lower, upper: values >= upper,
+    'range': lambda values, lower, upper: (values < lower) | (values > upper),
+}
+
+_engine = None
+_lock = threading.Lock()
+# bumped by reset_engine() so every process recompiles, not just the one that changed a rule
+VERSION_KEY = 'monitor:engine:version'
+
+
+class RuleGroup(object):
+    """ the (channel, rule) pairs sharing one operator, as arrays sorted by channel """
+
+    def __init__(self, operator, pairs):
+        pairs = sorted(pairs, key=lambda pair: pair[0])
+        self.operator = operator
+        self.channels = np.array([channel_id for channel_id, rule in pairs], dtype=np.int64)
+        self.rule_ids = np.array([rule.id for channel_id, rule in pairs], dtype=np.int64)
+        self.lower = np.array([_threshold(rule.lower_threshold) for channel_id, rule in pairs], dtype=np.float64)
+        self.upper = np.array([_threshold(rule.upper_threshold) for channel_id, rule in pairs], dtype=np.float64)
+
+    def evaluate(self, channel_ids, values):
+        """ returns (reading index, rule id, matched) arrays for every reading/rule pair """
+        first = np.searchsorted(self.channels, channel_ids, 'left')
+        counts = np.searchsorted(self.channels, channel_ids, 'right') - first
+        total = counts.sum()
+        reading_index = np.repeat(np.arange(len(channel_ids)), counts)
+        # position of each pair inside its reading's run of matching rules
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        pair_index = np.repeat(first, counts) + offsets
+        matched = self.operator(values[reading_index], self.lower[pair_index], self.upper[pair_index])
+        return reading_index, self.rule_ids[pair_index], matched
+
+
+class RuleEngine(object):
+    """ all active and paused rules compiled into threshold arrays grouped by operator
+
+    Paused rules are evaluated so their open alerts can still be resolved (see
+    tasks.evaluate_reading). Rules whose eval_func has no vectorized operator are
+    evaluated one reading at a time through Rule.evaluate.
+    """
+
+    def __init__(self, version=0):
+        self.version = version
+        self.rules = {}
+        self.groups = []
+        self.scalar = {}
+        pairs = {}
+        links = (Channel.rules.through.objects.filter(rule__state__in=[Rule.RULE_ACTIVE, Rule.RULE_PAUSED])
+                 .select_related('rule__rule_type'))
+        for link in links:
+            rule = self.rules.setdefault(link.rule_id, link.rule)
+            if rule.rule_type.eval_func in OPERATORS:
+                pairs.setdefault(rule.rule_type.eval_func, []).append((link.channel_id, rule))
+            else:
+                self.scalar.setdefault(link.channel_id, []).append(rule)
+        for eval_func, group in pairs.items():
+            self.groups.append(RuleGroup(OPERATORS[eval_func], group))
+        self.expires = time.time() + conf.STATE_TTL
+
+    @metrics.timed('rule_engine')
+    def evaluate(self, readings):
+        """ evaluates a batch of readings against every rule on their channels
+
+        Inputs:
+          readings - list of Reading objects
+
+        Outputs:
+          list with one entry per reading: a list of (rule, matched) tuples
+        """
+        results = [[] for reading in readings]
+        if len(readings) == 0:
+            return results
+        channel_ids = np.array([reading.channel_id for reading in readings], dtype=np.int64)
+        values = np.array([reading.value for reading in readings], dtype=np.float64)
+        for group in self.groups:
+            reading_index, rule_ids, matched = group.evaluate(channel_ids, values)
+            for i, rule_id, match in zip(reading_index.tolist(), rule_ids.tolist(), matched.tolist()):
+                results[i].append((self.rules[rule_id], match))
+        if self.scalar:
+            for i, reading in enumerate(readings):
+                for rule in self.scalar.get(reading.channel_id, []):
+                    results[i].append((rule, bool(rule.evaluate(reading))))
+        return results
+
+    def matches(self, readings):
+        """ returns the (reading, rule) pairs where the rule matched """
+        return [(reading, rule)
+                for reading, results in zip(readings, self.evaluate(readings))
+                for rule, matched in results if matched]
+
+
+def get_engine():
+    global _engine
+    engine = _engine
+    version = cache.get(VERSION_KEY, 0)
+    if engine is None or engine.expires < time.time() or engine.version != version:
+        engine = RuleEngine(version)
+        with _lock:
+            _engine = engine
+    return engine
+
+
+def reset_engine():
+    """ drops the compiled rules; the next get_engine() call in any process recompiles them """
+    global _engine
+    with _lock:
+        _engine = None
+    bump(VERSION_KEY)
+
+
+def _threshold(value):
+    return np.nan if value is None else value
@@ -0,0 +1,108 @@
+from __future__ import absolute_import
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from monitor.models import Alert
+from monitor.utils import to_seconds
+from monitor import conf
+import time
+
+# A short log of new readings and alert changes kept in the shared cache, which pages poll
+# through /monitor/events instead of the database. Events are numbered by the
+# SEQUENCE_KEY counter and each lives for conf.EVENT_TTL seconds under EVENT_KEY; a client
+# that falls further behind than that just misses them (and can reload). The cache must
+# be shared by the web and Celery processes (memcached, redis) for events published by a
+# worker to reach the pages.
+#
+# A publisher takes its numbers before it writes the events, so a reader can see a number
+# whose event isn't there yet. Readers stop at the first such gap and pick up from it on
+# their next poll; a gap is only skipped once a later event has been in the log for
+# conf.EVENT_GRACE seconds, by when its publisher has either written it or failed.
+#
+# If the cache loses the counter, numbering starts again from 1. A reader whose position
+# is past the current number is told to resync: it is answered from the start of the new
+# numbering and its page reloads, since events from around the loss may be gone.
+
+SEQUENCE_KEY = 'monitor:events:sequence'
+EVENT_KEY = 'monitor:events:{}'
+
+
+def publish(events):
+    """ appends events (JSON-able dicts with a 'channel' key) to the log """
+    if not events:
+        return
+    try:
+        last = cache.incr(SEQUENCE_KEY, len(events))
+    except ValueError:
+        # no counter yet (or it was evicted)
+        cache.add(SEQUENCE_KEY, 0, None)
+        last = cache.incr(SEQUENCE_KEY, len(events))
+    first = last - len(events) + 1
+    now = time.time()
+    cache.set_many(dict((EVENT_KEY.format(first + i), (now, event)) for i, event in enumerate(events)),
+                   conf.EVENT_TTL)
+
+
+def latest():
+    """ number of the newest event """
+    return cache.get(SEQUENCE_KEY) or 0
+
+
+def read(after, channel_ids):
+    """ returns (number to read after next time, [(number, event)], resync) for the events
+    after `after` that concern the given channels; resync is True when `after` is ahead of
+    the log because the counter was lost """
+    newest = latest()
+    resync = after > newest
+    if resync:
+        after = 0
+    if newest <= after:
+        return after, [], resync
+    # a reader that is far behind skips to the most recent events
+    first = max(after + 1, newest - conf.EVENT_BACKLOG + 1)
+    numbers = list(range(first, newest + 1))
+    found = cache.get_many([EVENT_KEY.format(number) for number in numbers])
+    entries = [found.get(EVENT_KEY.format(number)) for number in numbers]
+    # settled[i]: some event after numbers[i] was published more than EVENT_GRACE ago
+    settled = []
+    oldest = None
+    for entry in reversed(entries):
+        settled.append(oldest is not None and oldest < time.time() - conf.EVENT_GRACE)
+        if entry is not None:
+            oldest = entry[0] if oldest is None else min(oldest, entry[0])
+    settled.reverse()
+
+    last = first - 1
+    events = []
+    for number, entry, skip in zip(numbers, entries, settled):
+        if entry is None:
+            if not skip:
+                break
+        elif entry[1].get('channel') in channel_ids:
+            events.append((number, entry[1]))
+        last = number
+    return last, events, resync
+
+
+def reading_events(readings):
+    seconds = to_seconds([reading.monitor_time for reading in readings]).tolist()
+    return [{'type': 'reading', 'channel': reading.channel_id, 'id': reading.pk, 'time': when,
+             'value': reading.value, 'valid': reading.is_valid}
+            for reading, when in zip(readings, seconds)]
+
+
+@receiver(post_save, sender=Alert)
+def alert_changed(sender, instance, created, **kwargs):
+    if instance.channel_id is None:
+        return
+    if not instance.active:
+        state = 'resolved'
+    elif instance.acknowledged_time:
+        state = 'acknowledged'
+    else:
+        state = 'open'
+    rule = instance.rule.descriptive_name() if instance.rule_id else ''
+    event = {'type': 'alert', 'channel': instance.channel_id, 'alert': str(instance.uuid),
+             'state': state, 'rule': rule}
+    transaction.on_commit(lambda: publish([event]))
@@ -0,0 +1,231 @@
+from __future__ import absolute_import
+from abc import ABCMeta, abstractmethod
+from collections import deque
+from django.db import transaction
+from django.db.models import Q
+from monitor.models import Channel, Reading
+from monitor.utils import to_seconds
+from monitor import conf, rollups
+import numpy as np
+import math
+
+# Streaming glitch filters. Each channel type names one of FILTERS, an optional threshold
+# and a tolerance: a reading is a glitch when it is further from what the filter expects
+# than the threshold allows, but never when it is within the tolerance (in the type's
+# units, conf.GLITCH_TOLERANCE unless the type sets one) of it, which keeps readings near
+# zero from being rejected. A filter keeps a constant-size state per channel (held by
+# monitor.state) and checks either one value at a time (step) or a whole array of values
+# in time order (batch); both give the same answers, so validity can be recomputed over
+# history without saving each reading. Neither changes the state it is given.
+FILTERS = {}
+# scales a median absolute deviation to the standard deviation of normal data
+MAD_SCALE = 1.4826
+
+
+def register(name):
+    """ class decorator adding a filter to FILTERS under `name` """
+    def decorator(cls):
+        cls.name = name
+        FILTERS[name] = cls
+        return cls
+    return decorator
+
+
+class GlitchFilter(metaclass=ABCMeta):
+    """ subclasses implement step() and may override batch() with a vectorized version
+
+    history - how many of a channel's most recent values warm up its state
+    default_threshold - threshold used when the channel type doesn't set one
+    """
+    history = 1
+    default_threshold = None
+
+    def __init__(self, threshold=None, tolerance=None):
+        self.threshold = self.default_threshold if threshold is None else threshold
+        self.tolerance = conf.GLITCH_TOLERANCE if tolerance is None else tolerance
+
+    def initial(self, values):
+        """ state after seeing `values`, the channel's most recent values oldest first """
+        state = None
+        for value in values:
+            valid, state = self.step(state, value)
+        return state
+
+    @abstractmethod
+    def step(self, state, value):
+        """ returns (whether `value` is valid, new state); state None means no history """
+
+    def batch(self, state, values):
+        """ checks values in time order; returns (boolean array, new state) """
+        valid = np.ones(len(values), dtype=bool)
+        for i, value in enumerate(np.asarray(values, dtype=np.float64).tolist()):
+            valid[i], state = self.step(state, value)
+        return valid, state
+
+
+@register('jump')
+class JumpFilter(GlitchFilter):
+    """ a reading is a glitch when it moves more than `threshold` times the previous
+    reading's magnitude (0.35 = 35%) away from it. state: the previous value """
+    default_threshold = 0.35
+
+    def step(self, state, value):
+        if state is None:
+            return True, value
+        return abs(value - state) <= max(self.tolerance, self.threshold * abs(state)), value
+
+    def batch(self, state, values):
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return np.ones(0, dtype=bool), state
+        previous = np.r_[np.nan if state is None else state, values[:-1]]
+        valid = np.abs(values - previous) <= np.maximum(self.tolerance, self.threshold * np.abs(previous))
+        if state is None:
+            valid[0] = True
+        return valid, float(values[-1])
+
+
+@register('ewma')
+class EwmaFilter(GlitchFilter):
+    """ a reading is a glitch when it is more than `threshold` standard deviations from an
+    exponentially weighted mean spanning conf.GLITCH_WINDOW readings. The first
+    conf.GLITCH_WINDOW readings are always accepted. A glitch moves the mean only as far
+    as the edge of the band but widens the band, so a real change of level is accepted
+    after a few readings. state: (mean, variance, readings seen)
+
+    Each update depends on whether the previous reading was accepted, so batch() steps
+    through the values rather than vectorizing.
+    """
+    default_threshold = 4.0
+    history = conf.GLITCH_WINDOW
+
+    def step(self, state, value):
+        if state is None:
+            return True, (value, 0.0, 1)
+        mean, variance, seen = state
+        band = max(self.tolerance, self.threshold * math.sqrt(variance))
+        deviation = value - mean
+        valid = seen < self.history or abs(deviation) <= band
+        alpha = 2.0 / (self.history + 1)
+        mean += alpha * (deviation if valid else math.copysign(band, deviation))
+        variance = (1 - alpha) * (variance + alpha * deviation * deviation)
+        return valid, (mean, variance, seen + 1)
+
+
+@register('mad')
+class MadFilter(GlitchFilter):
+    """ a reading is a glitch when it is more than `threshold` standard deviations, estimated
+    from the median absolute deviation, from the median of the previous conf.GLITCH_WINDOW
+    readings. Fewer than three previous readings accept anything. state: a deque of the
+    previous readings """
+    default_threshold = 5.0
+    history = conf.GLITCH_WINDOW
+
+    def step(self, state, value):
+        # a copy: the state passed in may still be the one held for the channel
+        window = deque(state if state is not None else (), maxlen=self.history)
+        valid = True
+        if len(window) >= 3:
+            previous = np.array(window)
+            median = np.median(previous)
+            spread = np.median(np.abs(previous - median)) * MAD_SCALE
+            valid = bool(abs(value - median) <= max(self.tolerance, self.threshold * spread))
+        window.append(value)
+        return valid, window
+
+    def batch(self, state, values):
+        values = np.asarray(values, dtype=np.float64)
+        window = deque(state if state is not None else (), maxlen=self.history)
+        valid = np.ones(len(values), dtype=bool)
+        # step until the window is full, then take the medians of every full window at once
+        head = min(len(values), self.history - len(window))
+        for i in range(head):
+            valid[i], window = self.step(window, float(values[i]))
+        if head < len(values):
+            series = np.concatenate([np.array(window, dtype=np.float64), values[head:]])
+            stride = series.strides[0]
+            # row i holds the conf.GLITCH_WINDOW values before values[head + i]
+            windows = np.lib.stride_tricks.as_strided(series, shape=(len(values) - head, self.history),
+                                                      strides=(stride, stride))
+            median = np.median(windows, axis=1)
+            spread = np.median(np.abs(windows - median[:, None]), axis=1) * MAD_SCALE
+            valid[head:] = np.abs(values[head:] - median) <= np.maximum(self.tolerance, self.threshold * spread)
+            window = deque(series[-self.history:].tolist(), maxlen=self.history)
+        return valid, window
+
+
+def recent_values(channel_id, count, before=None):
+    """ a channel's last `count` values (before `before` if given), oldest first """
+    rows = Reading.objects.filter(channel_id=channel_id)
+    if before is not None:
+        rows = rows.filter(monitor_time__lt=before)
+    return list(reversed(rows.order_by('-monitor_time', '-id').values_list('value', flat=True)[:count]))
+
+
+def recompute(channel_id, since=None, size=None):
+    """ re-runs a channel's glitch filter over its readings and rewrites is_valid
+
+    Inputs:
+      channel_id - channel to check
+      since - only readings from this time on; the readings before it warm up the filter
+      size - readings checked per batch (defaults to conf.HISTORY_BATCH)
+
+    Outputs:
+      (readings checked, readings whose is_valid changed)
+
+    Changed readings are updated with one UPDATE per batch and value and the rollups
+    holding them are rebuilt right after; the channel's last_valid_reading is reset at the
+    end. Readings already moved to cold storage are not rechecked.
+    """
+    from monitor.state import invalidate
+    size = size or conf.HISTORY_BATCH
+    channel = Channel.objects.select_related('channel_type').get(pk=channel_id)
+    glitch_filter = channel.channel_type.get_glitch_filter()
+    rows = Reading.objects.filter(channel_id=channel_id)
+    state = None
+    if since is not None:
+        state = glitch_filter.initial(recent_values(channel_id, glitch_filter.history, since))
+        rows = rows.filter(monitor_time__gte=since)
+    rows = rows.order_by('monitor_time', 'id').values_list('id', 'monitor_time', 'value', 'is_valid')
+
+    checked = 0
+    changed = 0
+    for chunk in _chunks(rows, size):
+        ids, times, values, was_valid = zip(*chunk)
+        valid, state = glitch_filter.batch(state, values)
+        flipped = np.flatnonzero(valid != np.array(was_valid, dtype=bool))
+        if len(flipped):
+            ids = np.array(ids)
+            with transaction.atomic():
+                for value in (True, False):
+                    pks = ids[flipped[valid[flipped] == value]].tolist()
+                    if pks:
+                        Reading.objects.filter(pk__in=pks).update(is_valid=value)
+            rollups.rebuild(channel_id, to_seconds([times[i] for i in flipped.tolist()]))
+        checked += len(chunk)
+        changed += len(flipped)
+
+    if changed:
+        latest_valid = (Reading.objects.filter(channel_id=channel_id, is_valid=True)
+                        .order_by('-monitor_time', '-pk').values_list('pk', 'monitor_time').first())
+        latest_valid = latest_valid or (None, None)
+        Channel.objects.filter(pk=channel_id).update(last_valid_reading=latest_valid[0],
+                                                     last_valid_time=latest_valid[1])
+    invalidate(channel_id)
+    return checked, changed
+
+
+def _chunks(rows, size):
+    """ yields (id, monitor_time, ...) rows ordered by (monitor_time, id) in lists of
+    `size`, one query per list starting after the previous list's last row """
+    last = None
+    while True:
+        page = rows
+        if last is not None:
+            page = rows.filter(Q(monitor_time__gt=last[1]) | Q(monitor_time=last[1], id__gt=last[0]))
+        chunk = list(page[:size])
+        if chunk:
+            yield chunk
+        if len(chunk) < size:
+            return
+        last = chunk[-1]
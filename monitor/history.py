@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+from dateutil import tz
+from monitor.models import Rollup
+from monitor.coldstore import readings_between
+from monitor.rollups import RESOLUTIONS
+from monitor.utils import batches
+from monitor import conf
+import numpy as np
+import datetime
+import json
+
+LOCAL_ZONE = tz.gettz('America/New_York')
+
+
+def pick_resolution(seconds, points=None):
+    """ returns the coarsest rollup resolution that still gives at least `points` buckets
+    over a span of `seconds`, or None when only raw readings are fine enough """
+    points = points or conf.HISTORY_POINTS
+    resolution = None
+    for candidate in RESOLUTIONS:
+        if seconds / candidate >= points:
+            resolution = candidate
+    return resolution
+
+
+def series(channel_id, earliest, resolution=None):
+    """ yields (epoch seconds, values) array batches for a channel since `earliest`, in time
+    order. Raw readings span the Reading table and the cold partitions; with a resolution
+    the values are the bucket means of that rollup. """
+    if resolution is None:
+        return readings_between(channel_id, earliest)
+    return batches(Rollup.objects.filter(channel_id=channel_id, resolution=resolution, bucket__gt=earliest)
+                   .order_by('bucket').values_list('bucket', 'mean'))
+
+
+def local_strings(seconds, zone=LOCAL_ZONE):
+    """ formats epoch seconds as 'YYYY-mm-dd HH:MM:SS' strings in `zone`
+
+    The zone's UTC offset is looked up once per distinct hour rather than once per row.
+    """
+    hours, inverse = np.unique(np.floor(seconds / 3600), return_inverse=True)
+    offsets = np.array([_utc_offset(hour * 3600, zone) for hour in hours.tolist()])
+    local = np.floor(seconds + offsets[inverse]).astype('datetime64[s]')
+    return np.char.replace(np.datetime_as_string(local), 'T', ' ')
+
+
+def stream_json(rows, unit, convert=None, columnar=False, since=None):
+    """ yields a JSON document for the rows piece by piece
+
+    Inputs:
+      rows - (epoch seconds, values) array batches, e.g. from series()
+      unit - unit name to include in the document
+      convert - optional function applied to each batch of values
+      columnar - emit {"unit": ..., "chunks": [{"x": [times], "y": [values]}, ...]} instead
+                 of the default {"unit": ..., time: value, ...} object
+      since - when given, the document ends with a "since" key holding the epoch seconds
+              of the last row (or `since` itself if there are none), the cursor for the
+              next incremental request
+    """
+    last = since
+    if columnar:
+        yield '{{"unit": {}, "chunks": ['.format(json.dumps(unit))
+        separator = ''
+        for seconds, values in rows:
+            if convert is not None:
+                values = convert(values)
+            yield '{}{{"x": {}, "y": {}}}'.format(separator, json.dumps(local_strings(seconds).tolist()),
+                                                json.dumps(values.tolist()))
+            separator = ', '
+            last = float(seconds[-1]) if len(seconds) else last
+        yield ']'
+    else:
+        yield '{{"unit": {}'.format(json.dumps(unit))
+        for seconds, values in rows:
+            if convert is not None:
+                values = convert(values)
+            yield ''.join(', {}: {}'.format(json.dumps(t), json.dumps(v))
+                          for t, v in zip(local_strings(seconds).tolist(), values.tolist()))
+            last = float(seconds[-1]) if len(seconds) else last
+    if since is not None:
+        yield ', "since": {}'.format(json.dumps(last))
+    yield '}'
+
+
+def _utc_offset(seconds, zone):
+    when = datetime.datetime.fromtimestamp(seconds, tz.tzutc()).astimezone(zone)
+    return when.utcoffset().total_seconds()
@@ -0,0 +1,237 @@
+from __future__ import absolute_import
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, When, Value, F, Q, IntegerField, DateTimeField
+from django.utils import timezone
+from dateutil import parser as date_parser
+from monitor.models import Channel, Monitor, Reading
+from monitor.state import get_state
+from monitor import conf, events
+import datetime
+
+PENDING_READING_KEY = 'monitor:pointers:reading:{}'
+PENDING_VALID_KEY = 'monitor:pointers:valid:{}'
+PENDING_UPDATE_KEY = 'monitor:pointers:update:{}'
+SCHEDULED_CHANNEL_KEY = 'monitor:pointers:channel_flush:{}'
+SCHEDULED_MONITOR_KEY = 'monitor:pointers:monitor_flush:{}'
+
+
+def parse_time(value):
+    """ accepts a datetime, an epoch (seconds) or an ISO 8601 string and returns a datetime
+    in the form the Reading table stores (naive UTC unless USE_TZ is on) """
+    if isinstance(value, datetime.datetime):
+        when = value
+    elif isinstance(value, (int, float)):
+        when = datetime.datetime.fromtimestamp(value, timezone.utc)
+    else:
+        when = date_parser.parse(value)
+    if settings.USE_TZ and timezone.is_naive(when):
+        when = timezone.make_aware(when, timezone.utc)
+    elif not settings.USE_TZ and timezone.is_aware(when):
+        when = timezone.make_naive(when, timezone.utc)
+    return when
+
+
+def ingest_readings(rows):
+    """ writes a batch of readings with bulk inserts
+
+    Inputs:
+      rows - iterable of dicts with 'channel' (id), 'value' and 'monitor_time' keys and an
+             optional 'offset_value'
+
+    Outputs:
+      list of the created Reading objects
+
+    Each channel's glitch filter checks its readings as one array in monitor_time order,
+    each channel's last_reading/last_valid_reading and each monitor's last_update are
+    written once for the whole batch and a single process_readings task is queued for rule
+    evaluation.
+    """
+    from monitor.tasks import process_readings
+    rows = sorted(rows, key=lambda row: row['monitor_time'])
+    if len(rows) == 0:
+        return []
+
+    states = {}
+    for channel_id in set(int(row['channel']) for row in rows):
+        try:
+            states[channel_id] = get_state(channel_id)
+        except Channel.DoesNotExist:
+            raise ValueError('unknown channel {}'.format(channel_id))
+
+    readings = []
+    by_channel = {}
+    filter_states = {}
+    for row in rows:
+        channel_id = int(row['channel'])
+        offset = float(row.get('offset_value', 0.0))
+        reading = Reading(channel_id=channel_id,
+                          monitor_time=row['monitor_time'],
+                          value=float(row['value']) + offset,
+                          offset_value=offset)
+        readings.append(reading)
+        by_channel.setdefault(channel_id, []).append(reading)
+    for channel_id, channel_readings in by_channel.items():
+        state = states[channel_id]
+        valid, filter_states[channel_id] = state.glitch_filter.batch(state.load_filter(),
+                                                                     [reading.value for reading in channel_readings])
+        for reading, is_valid in zip(channel_readings, valid.tolist()):
+            reading.is_valid = is_valid
+
+    started = timezone.now()
+    with transaction.atomic():
+        Reading.objects.bulk_create(readings, batch_size=500)
+        if readings[0].pk is None:
+            _fetch_ids(readings, started)
+
+        latest = {}
+        latest_valid = {}
+        # readings are in monitor_time order, so the last one seen per channel is its newest
+        for reading in readings:
+            latest[reading.channel_id] = (reading.pk, reading.monitor_time)
+            if reading.is_valid:
+                latest_valid[reading.channel_id] = (reading.pk, reading.monitor_time)
+        monitor_ids = set(states[channel_id].monitor_id for channel_id in latest)
+        if conf.DEFERRED_POINTERS:
+            defer_pointers(latest, monitor_ids, latest_valid)
+        else:
+            set_pointers(latest, monitor_ids, latest_valid=latest_valid)
+
+    # the filters' states only move on once the readings they saw are stored
+    transaction.on_commit(lambda: [states[channel_id].store_filter(filter_state)
+                                   for channel_id, filter_state in filter_states.items()])
+    transaction.on_commit(lambda: process_readings.delay([reading.pk for reading in readings]))
+    transaction.on_commit(lambda: events.publish(events.reading_events(readings)))
+    return readings
+
+
+def _fetch_ids(readings, started):
+    # backends that can't return ids from a bulk insert: match the new rows back up by
+    # channel and monitor_time among the rows received since the batch started
+    keys = {}
+    for reading in readings:
+        keys.setdefault((reading.channel_id, reading.monitor_time), []).append(reading)
+    created = Reading.objects.filter(channel_id__in=set(r.channel_id for r in readings),
+                                     transaction_time__gte=started)
+    for pk, channel_id, monitor_time in created.values_list('id', 'channel_id', 'monitor_time').order_by('id'):
+        pending = keys.get((channel_id, monitor_time))
+        if pending:
+            pending.pop(0).pk = pk
+
+
+def set_pointers(latest, monitor_ids, when=None, latest_valid=None):
+    """ field-only update of Channel.last_reading, Channel.last_valid_reading and
+    Monitor.last_update
+
+    Inputs:
+      latest - dict mapping channel id to (id, monitor_time) of its newest reading
+      monitor_ids - monitors to stamp
+      when - time to stamp them with (defaults to now)
+      latest_valid - dict mapping channel id to (id, monitor_time) of its newest valid
+                     reading
+
+    All channels are written with one UPDATE and all monitors with another. A channel's
+    pointers only move to readings with a later monitor_time (the higher id on a tie), so
+    neither racing writers nor buffered uploads arriving late can replace a newer reading
+    with an older one.
+    """
+    latest_valid = latest_valid or {}
+    fields = {}
+    if latest:
+        fields['last_reading'], fields['last_reading_time'] = _forward('last_reading', 'last_reading_time', latest)
+    if latest_valid:
+        fields['last_valid_reading'], fields['last_valid_time'] = _forward('last_valid_reading', 'last_valid_time',
+                                                                           latest_valid)
+    if fields:
+        Channel.objects.filter(pk__in=set(latest) | set(latest_valid)).update(**fields)
+    if monitor_ids:
+        Monitor.objects.filter(pk__in=monitor_ids).update(last_update=when or datetime.datetime.now())
+
+
+def defer_pointers(latest, monitor_ids, latest_valid=None):
+    """ records the new pointers in the cache and makes sure an update_pointers task is
+    scheduled for each channel and monitor. Everything that arrives before that task runs
+    is folded into its single UPDATE. """
+    from monitor.tasks import update_pointers
+    latest_valid = latest_valid or {}
+    now = datetime.datetime.now()
+    pending = {}
+    for channel_id, pointer in latest.items():
+        pending[PENDING_READING_KEY.format(channel_id)] = pointer
+    for channel_id, pointer in latest_valid.items():
+        pending[PENDING_VALID_KEY.format(channel_id)] = pointer
+    # a pending pointer is only replaced by a newer reading
+    for key, pointer in cache.get_many(list(pending)).items():
+        if _key(pointer) > _key(pending[key]):
+            pending[key] = pointer
+    for monitor_id in monitor_ids:
+        pending[PENDING_UPDATE_KEY.format(monitor_id)] = now
+    cache.set_many(pending, 86400)
+
+    delay = conf.POINTER_FLUSH_DELAY
+    for channel_id in set(latest) | set(latest_valid):
+        if cache.add(SCHEDULED_CHANNEL_KEY.format(channel_id), True, delay * 10):
+            _schedule(update_pointers, {'channel_id': channel_id}, delay)
+    for monitor_id in monitor_ids:
+        if cache.add(SCHEDULED_MONITOR_KEY.format(monitor_id), True, delay * 10):
+            _schedule(update_pointers, {'monitor_id': monitor_id}, delay)
+
+
+def newest_reading(channel):
+    """ (id, monitor_time) of a channel's newest reading, from its last_reading pointer or
+    the newer pending one while pointers are deferred; (None, None) when it has none """
+    newest = (channel.last_reading_id, channel.last_reading_time)
+    if conf.DEFERRED_POINTERS:
+        pending = cache.get(PENDING_READING_KEY.format(channel.id))
+        if pending is not None and (newest[0] is None or _key(pending) > _key(newest)):
+            newest = pending
+    return newest
+
+
+def flush_pointers(channel_id=None, monitor_id=None):
+    """ writes the pending pointers for a channel and/or monitor recorded by defer_pointers """
+    latest = {}
+    latest_valid = {}
+    monitor_ids = []
+    when = None
+    # clear the scheduled flag before reading the pending value so anything recorded after
+    # this point schedules another flush rather than getting lost
+    if channel_id is not None:
+        cache.delete(SCHEDULED_CHANNEL_KEY.format(channel_id))
+        pending = cache.get_many([PENDING_READING_KEY.format(channel_id), PENDING_VALID_KEY.format(channel_id)])
+        if PENDING_READING_KEY.format(channel_id) in pending:
+            latest[channel_id] = pending[PENDING_READING_KEY.format(channel_id)]
+        if PENDING_VALID_KEY.format(channel_id) in pending:
+            latest_valid[channel_id] = pending[PENDING_VALID_KEY.format(channel_id)]
+    if monitor_id is not None:
+        cache.delete(SCHEDULED_MONITOR_KEY.format(monitor_id))
+        when = cache.get(PENDING_UPDATE_KEY.format(monitor_id))
+        if when is not None:
+            monitor_ids.append(monitor_id)
+    set_pointers(latest, monitor_ids, when, latest_valid)
+
+
+def _forward(field, time_field, pointers):
+    # CASE expressions that move each channel's pointer, and the monitor_time recorded
+    # with it, to the given reading unless it already points at a newer one
+    conditions = [(Q(pk=channel_id) & (Q(**{time_field + '__isnull': True}) |
+                                       Q(**{time_field + '__lt': monitor_time}) |
+                                       Q(**{time_field: monitor_time, field + '__lt': reading_id})),
+                   reading_id, monitor_time)
+                  for channel_id, (reading_id, monitor_time) in pointers.items()]
+    return (Case(*[When(condition, then=Value(reading_id)) for condition, reading_id, monitor_time in conditions],
+                 default=F(field), output_field=IntegerField()),
+            Case(*[When(condition, then=Value(monitor_time)) for condition, reading_id, monitor_time in conditions],
+                 default=F(time_field), output_field=DateTimeField()))
+
+
+def _key(pointer):
+    reading_id, monitor_time = pointer
+    if timezone.is_aware(monitor_time):
+        monitor_time = timezone.make_naive(monitor_time, timezone.utc)
+    return monitor_time, reading_id
+
+
+def _schedule(task, kwargs, countdown):
+    transaction.on_commit(lambda: task.apply_async(kwargs=kwargs, countdown=countdown))
@@ -0,0 +1,88 @@
+from __future__ import absolute_import
+from django.conf import settings
+from django.utils import timezone
+from monitor.models import Alert
+from monitor.utils import to_seconds
+import numpy as np
+
+# The path from a sensor sample to a delivered alert, split into the segments between
+# the stamps kept on Reading and Alert:
+#
+#   upload    reading.monitor_time     -> reading.transaction_time  device clock to API receipt
+#   queue     reading.transaction_time -> alert.evaluated_time      waiting for a worker
+#   evaluate  alert.evaluated_time     -> alert.alert_time          rule evaluation
+#   dispatch  alert.alert_time         -> alert.dispatched_time     waiting for process_alerts
+#   deliver   alert.dispatched_time    -> alert.delivered_time      SMTP (or the digest window)
+#   total     reading.monitor_time     -> alert.delivered_time
+#
+# upload includes any skew between the device's clock and the server's. monitor_time and
+# the evaluated/dispatched/delivered stamps are UTC (utils.utcnow); transaction_time and
+# alert_time come from auto_now_add, which is server-local time while USE_TZ is off, so
+# they are converted before the segments are taken.
+
+STAMPS = ('reading__monitor_time', 'reading__transaction_time', 'evaluated_time', 'alert_time',
+          'dispatched_time', 'delivered_time')
+SEGMENTS = (('upload', 0, 1), ('queue', 1, 2), ('evaluate', 2, 3), ('dispatch', 3, 4),
+            ('deliver', 4, 5), ('total', 0, 5))
+# stamps written by auto_now_add
+LOCAL_STAMPS = (1, 3)
+PERCENTILES = (50, 95, 99)
+
+
+def report(since, monitor_id=None, channel_id=None, by='channel'):
+    """ latency percentiles of the channel alerts raised since `since`
+
+    Inputs:
+      since - earliest alert_time to include
+      monitor_id, channel_id - optionally restrict to one monitor or channel
+      by - 'channel' or 'monitor', the grouping of the rows
+
+    Outputs:
+      list of dicts, one per group: its name, the number of alerts and for each segment
+      the count, mean and percentiles in seconds (None when no alert has both stamps)
+    """
+    alerts = Alert.objects.filter(alert_type=Alert.CHANNEL_ALERT, alert_time__gte=since, reading__isnull=False)
+    if monitor_id is not None:
+        alerts = alerts.filter(monitor_id=monitor_id)
+    if channel_id is not None:
+        alerts = alerts.filter(channel_id=channel_id)
+    if by == 'monitor':
+        group_fields = ('monitor_id', 'monitor__name')
+    else:
+        group_fields = ('channel_id', 'channel__monitor__name', 'channel__name')
+
+    groups = {}
+    for row in alerts.values_list(*(group_fields + STAMPS)).iterator():
+        key = row[:len(group_fields)]
+        groups.setdefault(key, []).append(row[len(group_fields):])
+
+    rows = []
+    for key, stamps in sorted(groups.items()):
+        columns = [_seconds([stamp[i] for stamp in stamps], i in LOCAL_STAMPS) for i in range(len(STAMPS))]
+        row = {'id': key[0], 'name': ': '.join(str(part) for part in key[1:]), 'alerts': len(stamps)}
+        for name, start, end in SEGMENTS:
+            row[name] = _summary(columns[end] - columns[start])
+        rows.append(row)
+    return rows
+
+
+def _seconds(times, local=False):
+    # missing stamps become NaN, which drops the alert from the segments that need them
+    present = [when for when in times if when is not None]
+    if local and not settings.USE_TZ:
+        # to_seconds takes naive times as UTC
+        present = [timezone.make_aware(when, timezone.get_default_timezone()) for when in present]
+    seconds = np.full(len(times), np.nan)
+    if present:
+        seconds[[i for i, when in enumerate(times) if when is not None]] = to_seconds(present)
+    return seconds
+
+
+def _summary(durations):
+    durations = durations[~np.isnan(durations)]
+    if len(durations) == 0:
+        return None
+    summary = {'count': len(durations), 'mean': float(durations.mean())}
+    for percentile in PERCENTILES:
+        summary['p{}'.format(percentile)] = float(np.percentile(durations, percentile))
+    return summary
@@ -0,0 +1,95 @@
+from __future__ import absolute_import
+from django.core import mail
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from monitor.models import Channel, Reading, Alert
+from monitor.tasks import process_reading, process_readings, process_alert
+from monitor import benchmarks
+from itertools import islice
+import json
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the ingest -> rule -> alert pipeline against a throwaway test database '
+            'with eager Celery and writes the results as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--monitors', type=int, default=10)
+        parser.add_argument('--channels', type=int, default=8, help='channels per monitor')
+        parser.add_argument('--rules', type=int, default=2, help='rules per channel')
+        parser.add_argument('--contacts', type=int, default=3, help='contacts per rule')
+        parser.add_argument('--readings', type=int, default=500, help='readings per stage')
+        parser.add_argument('--batch', type=int, default=100, help='readings per bulk call')
+        parser.add_argument('--alerts', type=int, default=100, help='alerts for the process_alert stage')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='write the JSON result to this file')
+        parser.add_argument('--compare', help='a previous JSON result to compare against')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='slowdown (as a fraction) that counts as a regression')
+        parser.add_argument('--keepdb', action='store_true', help='reuse the test database')
+
+    def handle(self, *args, **options):
+        params = dict((key, options[key]) for key in ('monitors', 'channels', 'rules', 'contacts',
+                                                       'readings', 'batch', 'alerts', 'seed'))
+        with benchmarks.environment(options['keepdb']):
+            data = benchmarks.seed(options['monitors'], options['channels'], options['rules'],
+                                   options['contacts'], options['seed'])
+            result = benchmarks.report('pipeline', params, self.run_stages(data, options))
+            result['messages_sent'] = len(mail.outbox)
+
+        self.stdout.write(benchmarks.write(result, options['output']))
+        if options['compare']:
+            benchmarks.check(result, options['compare'], options['tolerance'], self.stderr.write)
+
+    def run_stages(self, data, options):
+        channel_ids = data['channel_ids']
+        count = options['readings']
+        batch = options['batch']
+        # one stream for the whole run, so each stage continues where the last left off
+        readings = benchmarks.stream(channel_ids, count * 5, options['seed'])
+        client = Client(HTTP_AUTHORIZATION=data['api_key'])
+        stages = {}
+
+        stage = benchmarks.Stage('api_post')
+        for channel_id, monitor_time, value in islice(readings, count):
+            body = json.dumps({'channel': '/api/v1/channel/{}/'.format(channel_id), 'value': value,
+                               'monitor_time': monitor_time.isoformat()})
+            response = stage.run(lambda: client.post('/api/v1/reading/', body, content_type='application/json'))
+            if response.status_code != 201:
+                raise CommandError('reading POST failed: {} {}'.format(response.status_code, response.content))
+        stages[stage.name] = stage.summary()
+
+        stage = benchmarks.Stage('api_bulk_post')
+        rows = list(islice(readings, count))
+        for i in range(0, len(rows), batch):
+            body = json.dumps({'objects': [{'channel': channel_id, 'value': value, 'monitor_time': monitor_time.isoformat()}
+                                           for channel_id, monitor_time, value in rows[i:i + batch]]})
+            response = stage.run(lambda: client.post('/api/v1/reading/bulk/', body, content_type='application/json'))
+            if response.status_code != 201:
+                raise CommandError('bulk POST failed: {} {}'.format(response.status_code, response.content))
+        stages[stage.name] = stage.summary(batch)
+
+        stage = benchmarks.Stage('reading_save')
+        for channel_id, monitor_time, value in islice(readings, count):
+            stage.run(Reading(channel_id=channel_id, monitor_time=monitor_time, value=value).save)
+        stages[stage.name] = stage.summary()
+
+        stage = benchmarks.Stage('process_reading')
+        for reading in benchmarks.new_readings(islice(readings, count)):
+            stage.run(lambda: process_reading(reading.channel_id, reading.id))
+        stages[stage.name] = stage.summary()
+
+        stage = benchmarks.Stage('process_readings')
+        ids = [reading.id for reading in benchmarks.new_readings(islice(readings, count))]
+        for i in range(0, len(ids), batch):
+            stage.run(lambda: process_readings(ids[i:i + batch]))
+        stages[stage.name] = stage.summary(batch)
+
+        stage = benchmarks.Stage('process_alert')
+        links = list(Channel.rules.through.objects.order_by('pk')[:options['alerts']])
+        last = Reading.objects.order_by('-pk').first()
+        for link in links:
+            alert = Alert.objects.create(channel_id=link.channel_id, rule_id=link.rule_id, reading=last, active=True)
+            stage.run(lambda: process_alert(alert.id))
+        stages[stage.name] = stage.summary()
+        return stages
@@ -0,0 +1,70 @@
+from __future__ import absolute_import
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from monitor import benchmarks
+
+DAYS = (1, 7, 30, 365)
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the dashboard, channel and get_readings views against a throwaway test '
+            'database seeded with a year of history and writes the results as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--monitors', type=int, default=5)
+        parser.add_argument('--channels', type=int, default=4, help='channels per monitor')
+        parser.add_argument('--readings', type=int, default=50000, help='readings per channel, spread over a year')
+        parser.add_argument('--repeat', type=int, default=20, help='timed requests per view')
+        parser.add_argument('--trace', type=int, default=3, help='extra requests per view traced for peak memory')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='write the JSON result to this file')
+        parser.add_argument('--compare', help='a previous JSON result to compare against')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='slowdown (as a fraction) that counts as a regression')
+        parser.add_argument('--keepdb', action='store_true', help='reuse the test database')
+
+    def handle(self, *args, **options):
+        params = dict((key, options[key]) for key in ('monitors', 'channels', 'readings', 'repeat', 'seed'))
+        with benchmarks.environment(options['keepdb']):
+            data = benchmarks.seed(options['monitors'], options['channels'], 1, 1, options['seed'])
+            benchmarks.seed_history(data['channel_ids'], options['readings'], seed=options['seed'])
+            client = Client()
+            client.force_login(data['users'][0])
+            result = benchmarks.report('views', params, self.run_stages(client, data['channel_ids'], options))
+
+        self.stdout.write(benchmarks.write(result, options['output']))
+        if options['compare']:
+            benchmarks.check(result, options['compare'], options['tolerance'], self.stderr.write)
+
+    def run_stages(self, client, channel_ids, options):
+        channel_id = channel_ids[0]
+        # the dashboard is timed with the snapshot cache cleared so every request builds it
+        views = [('index', '/monitor/index', True), ('index_cached', '/monitor/index', False),
+                 ('channel', '/monitor/channel/{}/'.format(channel_id), False)]
+        views += [('get_readings_{}d'.format(days), '/monitor/get_readings/{}/{}/'.format(channel_id, days), False)
+                  for days in DAYS]
+
+        stages = {}
+        for name, path, uncached in views:
+            stage = benchmarks.Stage(name)
+
+            def request():
+                if uncached:
+                    cache.clear()
+                response = client.get(path)
+                # streamed responses are only produced as they are consumed
+                body = b''.join(response.streaming_content) if response.streaming else response.content
+                if response.status_code != 200:
+                    raise CommandError('{} returned {}'.format(path, response.status_code))
+                return len(body)
+
+            # warm-up; also gives the response size when --repeat is 0
+            size = request()
+            for i in range(options['repeat']):
+                size = stage.run(request)
+            for i in range(options['trace']):
+                stage.trace(request)
+            stages[name] = stage.summary()
+            stages[name]['response_bytes'] = size
+        return stages
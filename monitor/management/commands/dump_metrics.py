@@ -0,0 +1,23 @@
+from __future__ import absolute_import
+from django.core.management.base import BaseCommand
+from monitor import metrics
+import json
+
+
+class Command(BaseCommand):
+    help = 'Prints the metrics every process has written to MONITOR_METRICS_DIR'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true', help='print JSON instead of the Prometheus text format')
+
+    def handle(self, *args, **options):
+        if not options['json']:
+            self.stdout.write(metrics.exposition(), ending='')
+            return
+        counters, histograms = metrics.collect()
+        self.stdout.write(json.dumps({
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                         for (name, labels), value in sorted(counters.items())],
+            'histograms': [dict(histogram, name=name, labels=dict(labels))
+                           for (name, labels), histogram in sorted(histograms.items())],
+        }, indent=2, sort_keys=True))
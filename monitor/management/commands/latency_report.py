@@ -0,0 +1,46 @@
+from __future__ import absolute_import
+from django.core.management.base import BaseCommand
+from monitor import latency
+import datetime
+import json
+
+
+class Command(BaseCommand):
+    help = 'Reports sensor-to-alert latency per channel or monitor, split into upload, queue, evaluate, dispatch and deliver'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help='alerts raised in the last this many days')
+        parser.add_argument('--monitor', type=int, help='only this monitor id')
+        parser.add_argument('--channel', type=int, help='only this channel id')
+        parser.add_argument('--by', choices=('channel', 'monitor'), default='channel')
+        parser.add_argument('--json', action='store_true', help='print JSON instead of a table')
+
+    def handle(self, *args, **options):
+        since = datetime.datetime.now() - datetime.timedelta(days=options['days'])
+        rows = latency.report(since, options['monitor'], options['channel'], options['by'])
+        if options['json']:
+            self.stdout.write(json.dumps(rows, indent=2, sort_keys=True))
+            return
+        if len(rows) == 0:
+            self.stdout.write('no alerts in the last {} days'.format(options['days']))
+            return
+        segments = [name for name, start, end in latency.SEGMENTS]
+        self.stdout.write('{:<40} {:>6}  {}'.format(options['by'], 'alerts',
+                                                    ' '.join('{:>19}'.format(name + ' p50/p95') for name in segments)))
+        for row in rows:
+            self.stdout.write('{:<40} {:>6}  {}'.format(row['name'][:40], row['alerts'],
+                                                        ' '.join(_cell(row[name]) for name in segments)))
+
+
+def _cell(summary):
+    if summary is None:
+        return '{:>19}'.format('-')
+    return '{:>19}'.format('{}/{}'.format(_duration(summary['p50']), _duration(summary['p95'])))
+
+
+def _duration(seconds):
+    if abs(seconds) < 1:
+        return '{:.0f}ms'.format(seconds * 1000)
+    if abs(seconds) < 120:
+        return '{:.1f}s'.format(seconds)
+    return '{:.1f}m'.format(seconds / 60)
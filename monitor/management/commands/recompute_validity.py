@@ -0,0 +1,31 @@
+from __future__ import absolute_import
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from monitor.models import Channel
+from monitor import filters
+import datetime
+
+
+class Command(BaseCommand):
+    help = "Re-runs each channel's glitch filter over its stored readings and rewrites is_valid"
+
+    def add_arguments(self, parser):
+        parser.add_argument('channels', nargs='*', type=int, help='channel ids; all channels when none are given')
+        parser.add_argument('--channel-type', type=int, help='only channels of this channel type')
+        parser.add_argument('--days', type=int, help='only readings from the last this many days')
+
+    def handle(self, *args, **options):
+        channels = Channel.objects.order_by('pk')
+        if options['channels']:
+            channels = channels.filter(pk__in=options['channels'])
+        if options['channel_type'] is not None:
+            channels = channels.filter(channel_type_id=options['channel_type'])
+        channel_ids = list(channels.values_list('pk', flat=True))
+        if len(channel_ids) == 0:
+            raise CommandError('no matching channels')
+        since = None
+        if options['days'] is not None:
+            since = timezone.now() - datetime.timedelta(days=options['days'])
+        for channel_id in channel_ids:
+            checked, changed = filters.recompute(channel_id, since)
+            self.stdout.write('channel {}: {} readings checked, {} changed'.format(channel_id, checked, changed))
@@ -0,0 +1,263 @@
+from __future__ import absolute_import
+from contextlib import contextmanager
+from django.db import connection
+from django.utils import timezone
+from monitor import conf
+import atexit
+import datetime
+import functools
+import json
+import os
+import socket
+import threading
+import time
+
+# Process-local counters and histograms for the hot paths. Recording one observation is
+# a lock and a few additions, so instrumentation stays on in production. Each process
+# writes its totals to conf.METRICS_DIR at most every conf.METRICS_FLUSH seconds; the
+# /monitor/metrics endpoint and the dump_metrics command merge every process's file into
+# one Prometheus text exposition. Without a METRICS_DIR only the serving process is seen.
+#
+# Query counts come from Django's query log. Outside DEBUG, timer() forces debug cursors
+# for the enclosed block (as CaptureQueriesContext does) and drops the entries it caused
+# afterwards, so the log does not grow in workers that never see request_started.
+
+PREFIX = 'monitor_'
+# seconds
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LAG_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+HELP = {
+    'reading_save_seconds': 'Reading.save, including queueing its evaluation',
+    'reading_create_seconds': 'ReadingResource obj_create',
+    'process_reading_seconds': 'process_reading task',
+    'process_readings_seconds': 'process_readings task',
+    'rule_evaluate_seconds': 'Rule.evaluate for rules without a vectorized operator',
+    'rule_engine_seconds': 'RuleEngine.evaluate per batch of readings',
+    'process_alerts_seconds': 'process_alert/process_alerts tasks',
+    'view_seconds': 'dashboard and history views, to the end of the response',
+    'queries': 'database queries per call',
+    'queue_lag_seconds': 'time from a reading being stored to its evaluation starting',
+    'alert_fanout': 'messages sent per alert notification',
+    'notifications_sent_total': 'notification messages delivered',
+    'notifications_failed_total': 'notification messages that failed',
+    'readings_evaluated_total': 'readings evaluated against rules',
+    'evaluate_batch_size': 'readings per evaluate_readings batch',
+}
+
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_flushed = [time.time()]
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items())) if labels else ()
+
+
+def increment(name, amount=1, **labels):
+    """ adds to a counter """
+    if not conf.METRICS_ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+    _maybe_flush()
+
+
+def observe(name, value, buckets=TIME_BUCKETS, **labels):
+    """ records one observation in a histogram """
+    if not conf.METRICS_ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {'buckets': list(buckets), 'counts': [0] * (len(buckets) + 1),
+                                            'sum': 0.0, 'count': 0}
+        i = 0
+        for bound in histogram['buckets']:
+            if value <= bound:
+                break
+            i += 1
+        histogram['counts'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+    _maybe_flush()
+
+
+@contextmanager
+def timer(name, **labels):
+    """ times the enclosed block into the `<name>_seconds` histogram, and its query count
+    into `queries{stage=<name>}` (with the same labels) """
+    if not conf.METRICS_ENABLED:
+        yield
+        return
+    forced = not connection.queries_logged
+    if forced:
+        connection.force_debug_cursor = True
+    queries = len(connection.queries_log)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name + '_seconds', time.perf_counter() - started, **labels)
+        count = len(connection.queries_log) - queries
+        # the log is bounded; once it is full the difference no longer counts anything
+        if len(connection.queries_log) < connection.queries_log.maxlen:
+            observe('queries', count, COUNT_BUCKETS, stage=name, **labels)
+        if forced:
+            connection.force_debug_cursor = False
+            while len(connection.queries_log) > queries:
+                connection.queries_log.pop()
+
+
+def timed(name, **labels):
+    """ decorator form of timer() """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_stream(name, chunks, started, **labels):
+    """ records a streamed response's time from `started` (a time.perf_counter() value
+    taken when the view began) to its last chunk """
+    try:
+        for chunk in chunks:
+            yield chunk
+    finally:
+        observe(name + '_seconds', time.perf_counter() - started, **labels)
+
+
+def queue_lag(stored):
+    """ records how long ago a reading (stored at `stored`, its transaction_time) was saved """
+    if stored is None:
+        return
+    now = timezone.now() if timezone.is_aware(stored) else datetime.datetime.now()
+    observe('queue_lag_seconds', max((now - stored).total_seconds(), 0), LAG_BUCKETS)
+
+
+def snapshot():
+    """ this process's metrics as a JSON-able dict """
+    with _lock:
+        return {'counters': [[name, list(labels), value] for (name, labels), value in _counters.items()],
+                'histograms': [[name, list(labels), dict(histogram, counts=list(histogram['counts']))]
+                               for (name, labels), histogram in _histograms.items()]}
+
+
+def flush():
+    """ writes this process's snapshot to conf.METRICS_DIR """
+    _flushed[0] = time.time()
+    if not conf.METRICS_DIR:
+        return
+    with _flush_lock:
+        if not os.path.isdir(conf.METRICS_DIR):
+            os.makedirs(conf.METRICS_DIR)
+        path = os.path.join(conf.METRICS_DIR, '{}-{}.json'.format(socket.gethostname(), os.getpid()))
+        with open(path + '.tmp', 'w') as output:
+            json.dump(snapshot(), output)
+        os.rename(path + '.tmp', path)
+
+
+def collect():
+    """ merges the snapshots of every process (this one included) into
+    (counters, histograms) dicts keyed by (name, labels) """
+    snapshots = []
+    if conf.METRICS_DIR and os.path.isdir(conf.METRICS_DIR):
+        flush()
+        expired = time.time() - conf.METRICS_MAX_AGE
+        for name in os.listdir(conf.METRICS_DIR):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(conf.METRICS_DIR, name)
+            try:
+                # files of processes that have exited (or gone quiet) for too long
+                if os.path.getmtime(path) < expired:
+                    os.remove(path)
+                    continue
+                with open(path) as source:
+                    snapshots.append(json.load(source))
+            except (IOError, OSError, ValueError):
+                continue
+    else:
+        snapshots.append(snapshot())
+
+    counters = {}
+    histograms = {}
+    for data in snapshots:
+        for name, labels, value in data['counters']:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, histogram in data['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            merged = histograms.get(key)
+            if merged is None or merged['buckets'] != histogram['buckets']:
+                histograms[key] = dict(histogram, counts=list(histogram['counts']))
+                continue
+            merged['counts'] = [a + b for a, b in zip(merged['counts'], histogram['counts'])]
+            merged['sum'] += histogram['sum']
+            merged['count'] += histogram['count']
+    return counters, histograms
+
+
+def exposition():
+    """ the merged metrics in the Prometheus text format """
+    counters, histograms = collect()
+    lines = []
+    described = set()
+
+    def describe(name, kind):
+        if name not in described:
+            described.add(name)
+            if name in HELP:
+                lines.append('# HELP {}{} {}'.format(PREFIX, name, HELP[name]))
+            lines.append('# TYPE {}{} {}'.format(PREFIX, name, kind))
+
+    for (name, labels), value in sorted(counters.items()):
+        describe(name, 'counter')
+        lines.append('{}{}{} {}'.format(PREFIX, name, _labels(labels), value))
+    for (name, labels), histogram in sorted(histograms.items()):
+        describe(name, 'histogram')
+        total = 0
+        for bound, count in zip(histogram['buckets'] + ['+Inf'], histogram['counts']):
+            total += count
+            lines.append('{}{}_bucket{} {}'.format(PREFIX, name, _labels(labels + (('le', str(bound)),)), total))
+        lines.append('{}{}_sum{} {!r}'.format(PREFIX, name, _labels(labels), histogram['sum']))
+        lines.append('{}{}_count{} {}'.format(PREFIX, name, _labels(labels), histogram['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+
+def _maybe_flush():
+    if conf.METRICS_DIR and time.time() - _flushed[0] >= conf.METRICS_FLUSH:
+        try:
+            flush()
+        except (IOError, OSError) as e:
+            print('Failed to write metrics: {}'.format(e))
+
+
+@atexit.register
+def _flush_on_exit():
+    if conf.METRICS_DIR:
+        try:
+            flush()
+        except (IOError, OSError):
+            pass
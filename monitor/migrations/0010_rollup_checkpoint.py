@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2016-05-20 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitor', '0009_auto_20160513_1253'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Checkpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Rollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.IntegerField(choices=[(60, 'minute'), (3600, 'hour'), (86400, 'day')])),
+                ('bucket', models.DateTimeField()),
+                ('minimum', models.FloatField()),
+                ('maximum', models.FloatField()),
+                ('mean', models.FloatField()),
+                ('count', models.IntegerField()),
+                ('channel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='monitor.Channel')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='rollup',
+            unique_together=set([('channel', 'resolution', 'bucket')]),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2016-05-24 21:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def set_last_valid_reading(apps, schema_editor):
+    Channel = apps.get_model('monitor', 'Channel')
+    Reading = apps.get_model('monitor', 'Reading')
+    for channel in Channel.objects.all():
+        latest = Reading.objects.filter(channel=channel, is_valid=True).order_by('-monitor_time').first()
+        if latest:
+            Channel.objects.filter(pk=channel.pk).update(last_valid_reading=latest)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitor', '0010_rollup_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channel',
+            name='last_valid_reading',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='channel_last_valid_reading', to='monitor.Reading'),
+        ),
+        migrations.RunPython(set_last_valid_reading, migrations.RunPython.noop),
+    ]
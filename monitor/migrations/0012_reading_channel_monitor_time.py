@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2016-05-27 18:40
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitor', '0011_channel_last_valid_reading'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='reading',
+            index_together=set([('channel', 'monitor_time')]),
+        ),
+    ]
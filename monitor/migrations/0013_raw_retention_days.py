@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2016-06-02 09:31
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitor', '0012_reading_channel_monitor_time'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channel',
+            name='raw_retention_days',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='channeltype',
+            name='raw_retention_days',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2016-06-14 20:47
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('monitor', '0014_notification_coalescing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='monitor',
+            name='contacts',
+            field=models.ManyToManyField(blank=True, related_name='monitor_contacts', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='monitor',
+            name='expected_interval',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
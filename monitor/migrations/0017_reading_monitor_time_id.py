@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2016-06-21 09:33
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitor', '0016_alert_latency'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='reading',
+            index_together=set([('channel', 'monitor_time'), ('monitor_time', 'id')]),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2016-06-24 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitor', '0017_reading_monitor_time_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channeltype',
+            name='glitch_filter',
+            field=models.CharField(choices=[('jump', 'jump from the previous reading'), ('ewma', 'exponentially weighted mean and deviation'), ('mad', 'rolling median and median absolute deviation')], default='jump', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='channeltype',
+            name='glitch_threshold',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='channeltype',
+            name='glitch_tolerance',
+            field=models.FloatField(default=0.0),
+        ),
+    ]
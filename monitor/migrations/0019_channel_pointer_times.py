@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2016-06-27 14:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def set_pointer_times(apps, schema_editor):
+    Channel = apps.get_model('monitor', 'Channel')
+    for channel in Channel.objects.select_related('last_reading', 'last_valid_reading'):
+        Channel.objects.filter(pk=channel.pk).update(
+            last_reading_time=channel.last_reading.monitor_time if channel.last_reading else None,
+            last_valid_time=channel.last_valid_reading.monitor_time if channel.last_valid_reading else None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitor', '0018_channeltype_glitch_filter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channel',
+            name='last_reading_time',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='channel',
+            name='last_valid_time',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(set_pointer_times, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2016-06-29 09:18
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def clear_zero_tolerance(apps, schema_editor):
+    # 0.0 was the old default; blank now picks up MONITOR_GLITCH_TOLERANCE
+    ChannelType = apps.get_model('monitor', 'ChannelType')
+    ChannelType.objects.filter(glitch_tolerance=0.0).update(glitch_tolerance=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitor', '0019_channel_pointer_times'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='channeltype',
+            name='glitch_tolerance',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.RunPython(clear_zero_tolerance, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,7 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from tastypie.models import create_api_key
+from monitor import conf, metrics
 import uuid
 import datetime
 
@@ -17,6 +18,14 @@ class Monitor(models.Model):
     status = models.IntegerField(choices=STATUS_CHOICES,
                                  default=ACTIVE)
     last_update = models.DateTimeField(null=True, blank=True,db_index=True)
+    # seconds between reports; blank uses MONITOR_EXPECTED_INTERVAL
+    expected_interval = models.PositiveIntegerField(null=True, blank=True)
+    # who to tell when the monitor stops reporting
+    contacts = models.ManyToManyField(User, blank=True, related_name='monitor_contacts')
+
+    def overdue_after(self):
+        interval = self.expected_interval or conf.EXPECTED_INTERVAL
+        return datetime.timedelta(seconds=interval * conf.OVERDUE_MISSES)
 
     def __str__(self):
         return self.name
@@ -35,31 +44,52 @@ class Unit(models.Model):
     m_to_i_function = models.CharField(max_length=32, default='identity')
     i_to_m_function = models.CharField(max_length=32, default='identity')
 
+    # the conversions are names from the monitor.units registry or "affine:<scale>:<offset>"
     def m_to_i(self, x):
-        func = getattr(self, self.m_to_i_function)
-        return func(x)
+        from monitor.units import convert
+        return convert(self.m_to_i_function, x)
 
     def i_to_m(self, x):
-        func = getattr(self, self.i_to_m_function)
-        return func(x)
-
-    def identity(self, x):
-        return x
-
-    def celcius_to_fahrenheit(self, x):
-        return x * 9 / 5 + 32
-
-    def fahrenheit_to_celcius(self, x):
-        return (x - 32) * 5 / 9
+        from monitor.units import convert
+        return convert(self.i_to_m_function, x)
+
+    def clean(self):
+        from django.core.exceptions import ValidationError
+        from monitor.units import conversion
+        errors = {}
+        for field in ('m_to_i_function', 'i_to_m_function'):
+            try:
+                conversion(getattr(self, field))
+            except ValueError as e:
+                errors[field] = str(e)
+        if errors:
+            raise ValidationError(errors)
 
     def __str__(self):
         return self.name
 
 class ChannelType(models.Model):
+    # names in monitor.filters.FILTERS
+    GLITCH_FILTER_CHOICES = (('jump', 'jump from the previous reading'),
+                             ('ewma', 'exponentially weighted mean and deviation'),
+                             ('mad', 'rolling median and median absolute deviation'))
+
     sensor_name = models.CharField(max_length=200, default='')
     common_name = models.CharField(max_length=200, default='')
     units = models.ForeignKey(Unit)
     measurement_system = models.IntegerField(choices = Unit.UNIT_CHOICES, default=Unit.METRIC)
+    # days raw readings are kept before being archived; blank keeps them forever
+    raw_retention_days = models.PositiveIntegerField(null=True, blank=True)
+    # how new readings are checked for glitches, the filter's threshold (blank uses its
+    # default) and a change, in these units, that is never treated as a glitch (blank uses
+    # MONITOR_GLITCH_TOLERANCE)
+    glitch_filter = models.CharField(max_length=16, choices=GLITCH_FILTER_CHOICES, default='jump')
+    glitch_threshold = models.FloatField(null=True, blank=True)
+    glitch_tolerance = models.FloatField(null=True, blank=True)
+
+    def get_glitch_filter(self):
+        from monitor.filters import FILTERS
+        return FILTERS[self.glitch_filter](self.glitch_threshold, self.glitch_tolerance)
 
     def __str__(self):
         return self.common_name
@@ -79,7 +109,13 @@ class Channel(models.Model):
     rules = models.ManyToManyField('Rule', null=True, blank=True, db_index=True)
     status = models.IntegerField(choices=CHANNEL_STATUS_CHOICES)
     last_reading = models.ForeignKey('Reading', related_name='channel_last_reading', null=True, blank=True)
+    last_valid_reading = models.ForeignKey('Reading', related_name='channel_last_valid_reading', null=True, blank=True)
+    # monitor_time of the two readings above; the pointers only move to newer readings
+    last_reading_time = models.DateTimeField(null=True, blank=True)
+    last_valid_time = models.DateTimeField(null=True, blank=True)
     last_alert = models.ForeignKey('Alert', related_name='channel_last_alert', null=True, blank=True)
+    # overrides the channel type's raw_retention_days when set
+    raw_retention_days = models.PositiveIntegerField(null=True, blank=True)
 
     def get_units(self):
         return [self.channel_type.units.unit_imperial, self.channel_type.units.unit_metric]
@@ -87,6 +123,11 @@ class Channel(models.Model):
     def get_unit_abbrevs(self):
         return [self.channel_type.units.abbrev_imperial, self.channel_type.units.abbrev_metric]
 
+    def get_retention_days(self):
+        if self.raw_retention_days is not None:
+            return self.raw_retention_days
+        return self.channel_type.raw_retention_days
+
     def __str__(self):
         return ': '.join([self.monitor.name, self.name])
 
@@ -98,30 +139,38 @@ class Reading(models.Model):
     offset_value = models.FloatField(default = 0.0)
     is_valid = models.BooleanField(default=True)
 
+    class Meta:
+        index_together = [['channel', 'monitor_time'], ['monitor_time', 'id']]
+
     def __str__(self):
         return ': '.join([self.monitor_time.strftime("%Y-%m-%d %H:%M:%S"), str(self.value)])
 
+    @metrics.timed('reading_save')
     def save(self, *args, **kwargs):
-        from monitor.tasks import process_reading
+        from monitor.tasks import queue_evaluation
+        from monitor.ingest import set_pointers, defer_pointers
+        from monitor.state import get_state
+        from monitor import events
         self.value = float(self.value) + self.offset_value
         # smooth out glitches
-        if self.channel.last_reading:
-            last_value = self.channel.last_reading.value
-            if abs((self.value - last_value) / last_value) > 0.35:
-                self.is_valid = False
-            else:
-                self.is_valid = True
-        else:
-            self.is_valid = True
+        state = get_state(self.channel_id)
+        self.is_valid, filter_state = state.glitch_filter.step(state.load_filter(), self.value)
             
         super(Reading, self).save(*args, **kwargs)
-
-        process_reading.delay(self.channel.id, self.id)
-        self.channel.last_reading = self
-        self.channel.save()
-        monitor = self.channel.monitor
-        monitor.last_update = datetime.datetime.now()
-        monitor.save()
+        transaction.on_commit(lambda: state.store_filter(filter_state))
+
+        queue_evaluation(self.channel_id, self.id)
+        published = events.reading_events([self])
+        transaction.on_commit(lambda: events.publish(published))
+        # only touch the pointer columns; whole-row saves of the channel and monitor
+        # contend with each other and can overwrite concurrent changes
+        latest = {self.channel_id: (self.id, self.monitor_time)}
+        latest_valid = latest if self.is_valid else {}
+        monitor_ids = [state.monitor_id]
+        if conf.DEFERRED_POINTERS:
+            defer_pointers(latest, monitor_ids, latest_valid)
+        else:
+            set_pointers(latest, monitor_ids, latest_valid=latest_valid)
 
 class Preference(models.Model):
     EMAIL = 0
@@ -134,6 +183,8 @@ class Preference(models.Model):
     user = models.ForeignKey(User)
     contact_method = models.IntegerField(choices=CONTACT_CHOICES, default = EMAIL)
     measurement_system = models.IntegerField(choices=Unit.UNIT_CHOICES, default=Unit.IMPERIAL)
+    # when set, notifications are collected and sent as one digest every this many minutes
+    digest_minutes = models.PositiveIntegerField(null=True, blank=True)
 
     def __str__(self):
         return ' '.join([self.user.first_name, self.user.last_name])
@@ -170,6 +221,8 @@ class Rule(models.Model):
     action = models.IntegerField(choices=ACTIONS)
     contacts = models.ManyToManyField(User, related_name = 'rules_rule_contacts')
     state = models.IntegerField(default=RULE_ACTIVE)
+    # minutes between reminders for an open alert; blank uses MONITOR_RENOTIFY_MINUTES
+    renotify_minutes = models.PositiveIntegerField(null=True, blank=True)
 
     def descriptive_name(self):
         val = ""
@@ -185,26 +238,34 @@ class Rule(models.Model):
     def __str__(self):
         return self.name
 
+    @metrics.timed('rule_evaluate')
     def evaluate(self, reading):
         # get the eval function by name
         func = getattr(self, self.rule_type.eval_func)
         # call the eval function and return its result
         return func(reading)
 
+    def renotify_interval(self):
+        minutes = self.renotify_minutes
+        if minutes is None:
+            minutes = conf.RENOTIFY_MINUTES
+        return datetime.timedelta(minutes=minutes)
+
+    # a missing threshold never matches, as in monitor.engine
     def eval_lt(self, reading):
-        return reading.value < self.lower_threshold
+        return self.lower_threshold is not None and reading.value < self.lower_threshold
 
     def eval_lte(self, reading):
-        return reading.value <= self.lower_threshold
+        return self.lower_threshold is not None and reading.value <= self.lower_threshold
 
     def eval_gt(self, reading):
-        return reading.value > self.upper_threshold
+        return self.upper_threshold is not None and reading.value > self.upper_threshold
 
     def eval_gte(self, reading):
-        return reading.value >= self.upper_threshold
+        return self.upper_threshold is not None and reading.value >= self.upper_threshold
 
     def range(self, reading):
-        return self.eval_lt() or self.eval_gt()
+        return self.eval_lt(reading) or self.eval_gt(reading)
 
 class Alert(models.Model):
     CHANNEL_ALERT = 0
@@ -222,9 +283,56 @@ class Alert(models.Model):
     rule = models.ForeignKey(Rule, null=True, default=None)
     active = models.BooleanField(db_index=True)
     uuid = models.UUIDField(db_index=True, default=uuid.uuid4)
+    last_notified = models.DateTimeField(null=True, blank=True)
+    # latency stamps: when evaluation of the triggering reading started, when the first
+    # notification was handed to dispatch and when its first message was delivered
+    evaluated_time = models.DateTimeField(null=True, blank=True)
+    dispatched_time = models.DateTimeField(null=True, blank=True)
+    delivered_time = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         if self.channel:
             return ': '.join([self.channel.name, self.alert_time.strftime("%Y-%m-%d %H:%M:%S")])
         else:
             return ': '.join([self.monitor.name, self.alert_time.strftime("%Y-%m-%d %H:%M:%S")])
+
+class Rollup(models.Model):
+    # resolutions, in seconds
+    MINUTE = 60
+    HOUR = 3600
+    DAY = 86400
+    RESOLUTION_CHOICES = ((MINUTE, 'minute'),
+                          (HOUR, 'hour'),
+                          (DAY, 'day'))
+
+    channel = models.ForeignKey(Channel)
+    resolution = models.IntegerField(choices=RESOLUTION_CHOICES)
+    bucket = models.DateTimeField()
+    minimum = models.FloatField()
+    maximum = models.FloatField()
+    mean = models.FloatField()
+    count = models.IntegerField()
+
+    class Meta:
+        unique_together = (('channel', 'resolution', 'bucket'),)
+
+    def __str__(self):
+        return ': '.join([self.bucket.strftime("%Y-%m-%d %H:%M:%S"), self.get_resolution_display(), str(self.mean)])
+
+class Checkpoint(models.Model):
+    # progress markers for periodic jobs, e.g. the last reading id rolled up
+    name = models.CharField(max_length=100, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return '{}: {}'.format(self.name, self.value)
+
+class PendingNotification(models.Model):
+    # a notification held back for a contact's next digest
+    user = models.ForeignKey(User)
+    alert = models.ForeignKey(Alert)
+    restored = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return ': '.join([str(self.user), str(self.alert)])
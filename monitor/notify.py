@@ -0,0 +1,291 @@
+from __future__ import absolute_import
+from django.core.mail import EmailMultiAlternatives, EmailMessage, get_connection
+from django.db.models import F
+from monitor.models import Rule, Alert, Preference, PendingNotification
+from monitor.utils import utcnow
+from monitor import metrics
+from automation.settings import SERVER_URL
+import datetime
+
+# stands in for the contact's user id in the acknowledge links of a rendered notice
+BID = '__bid__'
+
+
+class AlertNotice(object):
+    """ the email and text bodies for one alert, rendered once and then addressed to each
+    contact """
+
+    def __init__(self, alert, restored=False):
+        self.restored = restored
+        self.text_from = 'Oldboy Monitor <admin@oldboy.net>'
+        link = 'https://{}/monitor/ack?aid={}&bid={}'.format(SERVER_URL, alert.uuid, BID)
+        if alert.alert_type == Alert.MONITOR_OVERDUE_ALERT:
+            self._overdue(alert.monitor, restored, link)
+            return
+        channel = alert.channel
+        monitor = channel.monitor
+        if restored:
+            self.email_subject = 'Alert from {} Monitor'.format(monitor.name)
+            self.email_from = 'Oldboy Monitor <admin@oldboy.net>'
+            self.email_text = 'Monitor: {}, channel:{}\nis reporting normal values.'.format(monitor.name, channel.name)
+            self.email_html = ('<span style="font-size: 150%;">Monitor: {}, channel:{}<br />'
+                               'is now reporting normal values.</span>').format(monitor.name, channel.name)
+            self.text_subject = 'Recovery Notice from {} Monitor'.format(monitor.name)
+            self.text_body = 'Monitor: {}, channel:{}\nis reporting normal values.'.format(monitor.name, channel.name)
+        else:
+            rule = alert.rule.descriptive_name()
+            # the reading that opened the alert; the channel's last_reading may lag behind
+            # (deferred pointers) or have moved on
+            value = alert.reading.value
+            self.email_subject = 'Alert from {} Monitor'.format(monitor.name)
+            self.email_from = 'Syliant Monitor <admin@syliant.com>'
+            self.email_text = ('The following rule was activated on monitor: {}, channel: {}\n{}\n\n'
+                               'Current reading for {} is {}\n\n'
+                               'To acknowledge this alert click <a href={}>here</a>').format(
+                                   monitor.name, channel.name, rule, channel.name, value, link)
+            self.email_html = ('<span style="font-size: 150%">The following rule was activated on monitor: {}, '
+                               'channel: {}<br /><span style="color:red;">{}</span><br /><br />'
+                               'Current reading for {} is {}<br />'
+                               'To acknowledge this alert click <a href={}>here</a></span>').format(
+                                   monitor.name, channel.name, rule, channel.name, value, link)
+            self.text_subject = 'Alert from {} Monitor'.format(monitor.name)
+            self.text_body = 'Monitor: {}, {}\n\nTo acknowledge click link:<a href={}></a>'.format(monitor.name, rule, link)
+
+    def _overdue(self, monitor, restored, link):
+        self.email_from = 'Oldboy Monitor <admin@oldboy.net>'
+        if restored:
+            self.email_subject = 'Alert from {} Monitor'.format(monitor.name)
+            self.email_text = 'Monitor: {}\nis reporting again.'.format(monitor.name)
+            self.email_html = '<span style="font-size: 150%;">Monitor: {}<br />is reporting again.</span>'.format(monitor.name)
+            self.text_subject = 'Recovery Notice from {} Monitor'.format(monitor.name)
+            self.text_body = 'Monitor: {}\nis reporting again.'.format(monitor.name)
+        else:
+            last = monitor.last_update.strftime('%Y-%m-%d %H:%M:%S') if monitor.last_update else 'never'
+            self.email_subject = 'Alert from {} Monitor'.format(monitor.name)
+            self.email_text = ('Monitor: {} has stopped reporting.\nLast report: {}\n\n'
+                               'To acknowledge this alert click <a href={}>here</a>').format(monitor.name, last, link)
+            self.email_html = ('<span style="font-size: 150%">Monitor: {} has '
+                               '<span style="color:red;">stopped reporting</span>.<br />Last report: {}<br /><br />'
+                               'To acknowledge this alert click <a href={}>here</a></span>').format(monitor.name, last, link)
+            self.text_subject = 'Alert from {} Monitor'.format(monitor.name)
+            self.text_body = 'Monitor: {} has stopped reporting\n\nTo acknowledge click link:<a href={}></a>'.format(
+                monitor.name, link)
+
+    def messages(self, preference):
+        """ returns the messages for a contact according to their contact method """
+        user = preference.user
+        bid = str(user.id)
+        messages = []
+        if preference.contact_method in (Preference.EMAIL, Preference.BOTH):
+            to_addr = ['{} <{}>'.format(str(user.get_full_name()), user.email)]
+            email = EmailMultiAlternatives(self.email_subject, self.email_text.replace(BID, bid), self.email_from, to_addr)
+            email.attach_alternative(self.email_html.replace(BID, bid), "text/html")
+            messages.append(email)
+        if preference.contact_method in (Preference.SMS, Preference.BOTH):
+            to_addr = ['{} <{}@{}>'.format(str(user.get_full_name()), user.text_number, user.text_provider)]
+            messages.append(EmailMessage(self.text_subject, self.text_body.replace(BID, bid), self.text_from, to_addr))
+        return messages
+
+
+def dispatch(notifications):
+    """ sends the notifications for a set of alerts over one mail connection
+
+    Inputs:
+      notifications - list of (alert_id, restored, contact_ids) tuples; contact_ids limits
+                      the recipients to those users, None means all of the rule's contacts
+                      (the monitor's contacts for an overdue alert)
+
+    Outputs:
+      (sent, failed) where sent is the number of messages delivered and failed is a list
+      of (alert_id, restored, contact_ids) tuples for the recipients that should be retried
+
+    Contacts with a digest window get a PendingNotification instead of a message. Repeats
+    of an alert's notification, e.g. one per matching reading in a batch, are sent once.
+    """
+    notifications = _merge(notifications)
+    alerts = Alert.objects.select_related('rule', 'monitor', 'channel__monitor', 'reading').in_bulk(
+        [alert_id for alert_id, restored, contact_ids in notifications])
+    rule_ids = set(alert.rule_id for alert in alerts.values()
+                   if alert.rule_id and alert.rule.action in (Rule.SEND_EMAIL_TEXT_ALERT, Rule.SEND_BOTH))
+    monitor_ids = set(alert.monitor_id for alert in alerts.values()
+                      if alert.alert_type == Alert.MONITOR_OVERDUE_ALERT)
+
+    # every active contact of every rule (or overdue monitor) involved, with their
+    # preferences, in one query each
+    contacts = {}
+    if rule_ids:
+        preferences = (Preference.objects.filter(user__rules_rule_contacts__in=rule_ids, user__is_active=True)
+                       .annotate(rule_id=F('user__rules_rule_contacts')).select_related('user'))
+        for preference in preferences:
+            contacts.setdefault(('rule', preference.rule_id), []).append(preference)
+    if monitor_ids:
+        preferences = (Preference.objects.filter(user__monitor_contacts__in=monitor_ids, user__is_active=True)
+                       .annotate(monitor_id=F('user__monitor_contacts')).select_related('user'))
+        for preference in preferences:
+            contacts.setdefault(('monitor', preference.monitor_id), []).append(preference)
+
+    outbox = []
+    held = []
+    for alert_id, restored, contact_ids in notifications:
+        alert = alerts.get(alert_id)
+        if alert is None:
+            continue
+        if alert.alert_type == Alert.MONITOR_OVERDUE_ALERT:
+            key = ('monitor', alert.monitor_id)
+        elif alert.rule_id in rule_ids:
+            key = ('rule', alert.rule_id)
+        else:
+            continue
+        notice = AlertNotice(alert, restored)
+        queued = len(outbox)
+        for preference in contacts.get(key, []):
+            if contact_ids is not None and preference.user_id not in contact_ids:
+                continue
+            if preference.digest_minutes:
+                held.append(PendingNotification(user_id=preference.user_id, alert_id=alert_id, restored=restored))
+                continue
+            for message in notice.messages(preference):
+                outbox.append(((alert_id, restored, preference.user_id), message))
+        metrics.observe('alert_fanout', len(outbox) - queued, metrics.COUNT_BUCKETS)
+    PendingNotification.objects.bulk_create(held)
+    # latency stamps only follow an alert's first (opening) notification
+    opening = set(alert_id for alert_id, restored, contact_ids in notifications if not restored)
+    Alert.objects.filter(pk__in=opening, dispatched_time__isnull=True).update(dispatched_time=utcnow())
+
+    sent, failures = _send(outbox)
+    delivered = set(alert_id for (alert_id, restored, user_id), message in outbox
+                    if not restored and (alert_id, restored, user_id) not in failures)
+    if delivered:
+        Alert.objects.filter(pk__in=delivered, delivered_time__isnull=True).update(delivered_time=utcnow())
+    failed = {}
+    for alert_id, restored, user_id in failures:
+        failed.setdefault((alert_id, restored), set()).add(user_id)
+    return sent, [(alert_id, restored, sorted(users)) for (alert_id, restored), users in failed.items()]
+
+
+def _merge(notifications):
+    # one entry per (alert, restored) in first-seen order, addressed to the union of the
+    # repeats' contacts
+    merged = {}
+    order = []
+    for alert_id, restored, contact_ids in notifications:
+        key = (alert_id, restored)
+        if key not in merged:
+            order.append(key)
+            merged[key] = None if contact_ids is None else set(contact_ids)
+        elif merged[key] is not None:
+            merged[key] = None if contact_ids is None else merged[key] | set(contact_ids)
+    return [(alert_id, restored, None if merged[(alert_id, restored)] is None else sorted(merged[(alert_id, restored)]))
+            for alert_id, restored in order]
+
+
+def digest_messages(preference, items):
+    """ merges a contact's pending notifications, across any number of channels and
+    monitors, into one message per contact method """
+    user = preference.user
+    lines = []
+    seen = set()
+    for item in items:
+        # a reminder held twice within the window is listed once
+        if (item.alert_id, item.restored) in seen:
+            continue
+        seen.add((item.alert_id, item.restored))
+        alert = item.alert
+        channel = alert.channel
+        if alert.alert_type == Alert.MONITOR_OVERDUE_ALERT:
+            if item.restored:
+                lines.append('Monitor: {} is reporting again.'.format(alert.monitor.name))
+            else:
+                link = 'https://{}/monitor/ack?aid={}&bid={}'.format(SERVER_URL, alert.uuid, user.id)
+                lines.append('Monitor: {} has stopped reporting. To acknowledge click <a href={}>here</a>'.format(
+                    alert.monitor.name, link))
+        elif item.restored:
+            lines.append('Monitor: {}, channel: {} is reporting normal values.'.format(channel.monitor.name, channel.name))
+        else:
+            link = 'https://{}/monitor/ack?aid={}&bid={}'.format(SERVER_URL, alert.uuid, user.id)
+            lines.append('Monitor: {}, channel: {}: {} (current reading {}). To acknowledge click <a href={}>here</a>'.format(
+                channel.monitor.name, channel.name, alert.rule.descriptive_name(), alert.reading.value, link))
+    subject = 'Monitor digest: {} notification{}'.format(len(items), '' if len(items) == 1 else 's')
+    messages = []
+    if preference.contact_method in (Preference.EMAIL, Preference.BOTH):
+        to_addr = ['{} <{}>'.format(str(user.get_full_name()), user.email)]
+        email = EmailMultiAlternatives(subject, '\n\n'.join(lines), 'Oldboy Monitor <admin@oldboy.net>', to_addr)
+        email.attach_alternative('<span style="font-size: 150%">{}</span>'.format('<br /><br />'.join(lines)), "text/html")
+        messages.append(email)
+    if preference.contact_method in (Preference.SMS, Preference.BOTH):
+        to_addr = ['{} <{}@{}>'.format(str(user.get_full_name()), user.text_number, user.text_provider)]
+        messages.append(EmailMessage(subject, '\n'.join(lines), 'Oldboy Monitor <admin@oldboy.net>', to_addr))
+    return messages
+
+
+def send_digests(now=None):
+    """ sends a digest to every contact whose oldest held notification is older than their
+    digest window, over one mail connection
+
+    Outputs:
+      number of messages sent
+    """
+    now = now or datetime.datetime.now()
+    pending = list(PendingNotification.objects.select_related('alert__rule', 'alert__monitor', 'alert__channel__monitor',
+                                                              'alert__reading').order_by('created'))
+    if len(pending) == 0:
+        return 0
+    by_user = {}
+    for item in pending:
+        by_user.setdefault(item.user_id, []).append(item)
+    preferences = dict((preference.user_id, preference) for preference in
+                       Preference.objects.filter(user_id__in=by_user).select_related('user'))
+
+    outbox = []
+    done = set()
+    mailed = set()
+    for user_id, items in by_user.items():
+        preference = preferences.get(user_id)
+        if preference is None or not preference.user.is_active:
+            done.add(user_id)
+            continue
+        if now - items[0].created < datetime.timedelta(minutes=preference.digest_minutes or 0):
+            continue
+        for message in digest_messages(preference, items):
+            outbox.append((user_id, message))
+            mailed.add(user_id)
+        done.add(user_id)
+
+    sent, failed = _send(outbox)
+    # a contact whose digest failed keeps their notifications for the next run
+    finished = [item.id for item in pending if item.user_id in done and item.user_id not in failed]
+    delivered = set(item.alert_id for item in pending
+                    if not item.restored and item.user_id in mailed and item.user_id not in failed)
+    if delivered:
+        Alert.objects.filter(pk__in=delivered, delivered_time__isnull=True).update(delivered_time=utcnow())
+    PendingNotification.objects.filter(pk__in=finished).delete()
+    return sent
+
+
+def _send(outbox):
+    """ sends (key, message) pairs over one connection; returns the number delivered and
+    the set of keys with a failed message """
+    sent = 0
+    failed = set()
+    if len(outbox) == 0:
+        return sent, failed
+    connection = get_connection()
+    connection.open()
+    try:
+        for key, message in outbox:
+            # one message per call so a bad recipient doesn't take the others down with it
+            try:
+                delivered = connection.send_messages([message])
+            except Exception as e:
+                print('Failed to send to {}: {}'.format(','.join(message.to), e))
+                delivered = 0
+            if delivered:
+                sent += delivered
+                metrics.increment('notifications_sent_total', delivered)
+                print('Sent email to {}'.format(','.join(message.to)))
+            else:
+                failed.add(key)
+                metrics.increment('notifications_failed_total')
+    finally:
+        connection.close()
+    return sent, failed
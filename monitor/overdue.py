@@ -0,0 +1,47 @@
+from __future__ import absolute_import
+from django.db import transaction
+from monitor.models import Monitor, Alert
+from monitor import conf
+import datetime
+
+# A monitor is overdue once it has been silent for Monitor.overdue_after(): its expected
+# interval (or conf.EXPECTED_INTERVAL) times conf.OVERDUE_MISSES. Each run looks at the
+# monitors silent for at least conf.OVERDUE_MIN_SECONDS, found with one range query on the
+# last_update index, plus the open overdue alerts. Monitors that have never reported are
+# not checked.
+
+
+def check_overdue(now=None):
+    """ opens an overdue alert for every monitor that has stopped reporting and resolves
+    the alerts of monitors that have started again. Alerts of monitors switched to
+    inactive are closed without a notification; they haven't started reporting.
+
+    Outputs:
+      (opened, resolved) lists of (alert_id, restored, contact_ids) notifications
+    """
+    now = now or datetime.datetime.now()
+    stale = Monitor.objects.filter(status=Monitor.ACTIVE,
+                                   last_update__lt=now - datetime.timedelta(seconds=conf.OVERDUE_MIN_SECONDS))
+    overdue = set(monitor.pk for monitor in stale.only('pk', 'last_update', 'expected_interval')
+                  if now - monitor.last_update >= monitor.overdue_after())
+    open_alerts = {}
+    retired = []
+    for monitor_id, pk, status in (Alert.objects.filter(alert_type=Alert.MONITOR_OVERDUE_ALERT, active=True)
+                                   .values_list('monitor_id', 'pk', 'monitor__status')):
+        if status == Monitor.ACTIVE:
+            open_alerts[monitor_id] = pk
+        else:
+            retired.append(pk)
+
+    opened = []
+    resolved = []
+    with transaction.atomic():
+        for monitor_id in overdue.difference(open_alerts):
+            alert = Alert.objects.create(alert_type=Alert.MONITOR_OVERDUE_ALERT, monitor_id=monitor_id,
+                                         active=True, last_notified=now)
+            opened.append((alert.id, False, None))
+        recovered = [pk for monitor_id, pk in open_alerts.items() if monitor_id not in overdue]
+        if recovered or retired:
+            Alert.objects.filter(pk__in=recovered + retired).update(active=False, resolved_time=now)
+            resolved = [(pk, True, None) for pk in recovered]
+    return opened, resolved
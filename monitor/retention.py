@@ -0,0 +1,99 @@
+from __future__ import absolute_import
+from django.db import transaction
+from monitor.models import Channel, Reading
+from monitor.coldstore import partitions, load_partition, partition_times, partition_path, next_month, pinned_readings
+from monitor import conf
+import numpy as np
+import datetime
+import gzip
+import os
+import shutil
+
+# Raw readings past their channel's retention are appended to
+#   <conf.ARCHIVE_ROOT>/<channel id>/<YYYY-MM>.csv.gz
+# as "id,monitor_time,value,offset_value,is_valid" lines and then deleted. Each export and
+# delete covers at most conf.RETENTION_CHUNK readings in its own transaction. Readings that
+# alerts or channel pointers refer to are never deleted; rollups are kept forever.
+
+HEADER = 'id,monitor_time,value,offset_value,is_valid\n'
+
+
+def enforce(now=None):
+    """ archives and deletes expired raw readings for every channel with a retention
+
+    Outputs:
+      number of readings archived
+    """
+    if not conf.ARCHIVE_ROOT:
+        return 0
+    now = now or datetime.datetime.now()
+    pinned = pinned_readings()
+    archived = 0
+    for channel in Channel.objects.select_related('channel_type'):
+        days = channel.get_retention_days()
+        if days is None:
+            continue
+        cutoff = now - datetime.timedelta(days=days)
+        archived += _expire_cold(channel.id, cutoff)
+        archived += _expire_hot(channel.id, cutoff, pinned)
+    return archived
+
+
+def archive_path(channel_id, month):
+    return os.path.join(conf.ARCHIVE_ROOT, str(channel_id), month.strftime('%Y-%m') + '.csv.gz')
+
+
+def _expire_hot(channel_id, cutoff, pinned):
+    archived = 0
+    last_pk = 0
+    while True:
+        rows = list(Reading.objects.filter(channel_id=channel_id, monitor_time__lt=cutoff, pk__gt=last_pk)
+                    .order_by('pk').values_list('id', 'monitor_time', 'value', 'offset_value', 'is_valid')
+                    [:conf.RETENTION_CHUNK])
+        if len(rows) == 0:
+            return archived
+        last_pk = rows[-1][0]
+        rows = [row for row in rows if row[0] not in pinned]
+        if len(rows) == 0:
+            continue
+        # the export is appended before the delete; a failed delete leaves the rows in
+        # place and a re-run archives them again under the same ids
+        _append(channel_id, [(row[0], row[1].isoformat(), row[2], row[3], int(row[4])) for row in rows])
+        with transaction.atomic():
+            Reading.objects.filter(pk__in=[row[0] for row in rows]).delete()
+        archived += len(rows)
+
+
+def _expire_cold(channel_id, cutoff):
+    # only whole months past the cutoff are archived out of cold storage
+    archived = 0
+    for month in partitions(channel_id):
+        if next_month(month) > cutoff.replace(tzinfo=None):
+            break
+        # cold partitions keep the offset-adjusted value only, so offset_value is written as 0
+        columns = load_partition(channel_id, month)
+        micros = partition_times(columns) + int((month - datetime.datetime(1970, 1, 1)).total_seconds()) * 1000000
+        times = np.datetime_as_string(micros.astype('datetime64[us]')).tolist()
+        _append(channel_id, zip(np.asarray(columns['id']).tolist(), times, np.asarray(columns['value']).tolist(),
+                                [0.0] * len(times), np.asarray(columns['valid']).astype(int).tolist()))
+        shutil.rmtree(partition_path(channel_id, month))
+        archived += len(times)
+    return archived
+
+
+def _append(channel_id, rows):
+    rows = list(rows)
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(row[1][:7], []).append(row)
+    for month, month_rows in by_month.items():
+        path = archive_path(channel_id, datetime.datetime.strptime(month, '%Y-%m'))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        new = not os.path.exists(path)
+        # each call adds a gzip member; gzip readers return the members concatenated
+        with gzip.open(path, 'at') as archive:
+            if new:
+                archive.write(HEADER)
+            for row in month_rows:
+                archive.write('{},{},{!r},{!r},{}\n'.format(*row))
@@ -0,0 +1,234 @@
+from __future__ import absolute_import
+from django.db import transaction
+from django.utils import timezone
+from monitor.models import Channel, Reading, Rollup, Checkpoint
+from monitor.utils import to_seconds, from_seconds
+from monitor import conf
+import numpy as np
+import datetime
+
+RESOLUTIONS = (Rollup.MINUTE, Rollup.HOUR, Rollup.DAY)
+CHECKPOINT = 'rollups'
+
+
+def aggregate(seconds, minimum, maximum, total, count, resolution):
+    """ folds sorted samples into buckets of `resolution` seconds
+
+    Inputs:
+      seconds - epoch seconds of each sample, in ascending order
+      minimum, maximum - per-sample min/max (the value itself for raw readings)
+      total, count - per-sample sum and number of readings (value and 1 for raw readings)
+      resolution - bucket width in seconds
+
+    Outputs:
+      (bucket start seconds, minimum, maximum, total, count) arrays, one entry per bucket
+    """
+    if len(seconds) == 0:
+        empty = np.array([])
+        return empty, empty, empty, empty, empty
+    keys = np.floor(seconds / resolution) * resolution
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return (keys[starts],
+            np.minimum.reduceat(minimum, starts),
+            np.maximum.reduceat(maximum, starts),
+            np.add.reduceat(total, starts),
+            np.add.reduceat(count, starts))
+
+
+def update_rollups(limit=None):
+    """ folds readings added since the last run into the minute, hour and day rollups
+
+    Inputs:
+      limit - maximum number of new readings to look at in one run
+
+    Outputs:
+      number of new readings processed
+
+    Progress is kept in the 'rollups' Checkpoint as the highest reading id seen. Every
+    bucket a new reading falls in is recomputed (see _rebuild), so late or out-of-order
+    readings are folded in correctly.
+
+    Ids are handed out before transactions commit, so a reading can become visible after
+    one with a higher id. Only readings stored more than conf.ROLLUP_LAG seconds ago are
+    taken, stopping at the first newer one, so the checkpoint never passes a reading
+    whose transaction may still be open.
+    """
+    limit = limit or conf.ROLLUP_BATCH
+    cutoff = timezone.now() - datetime.timedelta(seconds=conf.ROLLUP_LAG)
+    checkpoint, created = Checkpoint.objects.get_or_create(name=CHECKPOINT)
+    rows = []
+    for pk, channel_id, monitor_time, stored in (Reading.objects.filter(pk__gt=checkpoint.value).order_by('pk')
+                                                 .values_list('pk', 'channel_id', 'monitor_time',
+                                                              'transaction_time')[:limit]):
+        if stored >= cutoff:
+            break
+        rows.append((pk, channel_id, monitor_time))
+    if len(rows) == 0:
+        return 0
+
+    touched = {}
+    for pk, channel_id, monitor_time in rows:
+        touched.setdefault(channel_id, []).append(monitor_time)
+    touched = dict((channel_id, to_seconds(times)) for channel_id, times in touched.items())
+
+    raw_since = dict((channel_id, _raw_since(channel_id)) for channel_id in touched)
+    with transaction.atomic():
+        for channel_id, seconds in touched.items():
+            _rebuild_at(channel_id, seconds, raw_since[channel_id])
+        checkpoint.value = rows[-1][0]
+        checkpoint.save()
+    return len(rows)
+
+
+def rebuild(channel_id, seconds):
+    """ recomputes the channel's minute, hour and day rollups holding readings at `seconds`
+    (epoch seconds), e.g. after the validity of those readings changed
+
+    Only the buckets holding those times are recomputed, one day at a time, each day in
+    its own transaction.
+    """
+    seconds = np.asarray(seconds, dtype=np.float64)
+    raw_since = _raw_since(channel_id)
+    days = np.floor(seconds / Rollup.DAY) * Rollup.DAY
+    for day in np.unique(days).tolist():
+        with transaction.atomic():
+            _rebuild_at(channel_id, seconds[days == day], raw_since)
+
+
+def _rebuild_at(channel_id, seconds, raw_since):
+    """ recomputes the channel's buckets holding `seconds`, finest resolution first """
+    for resolution in RESOLUTIONS:
+        buckets = np.unique(np.floor(seconds / resolution) * resolution)
+        # neighbouring buckets are rebuilt as one range
+        for run in np.split(buckets, np.flatnonzero(np.diff(buckets) > resolution) + 1):
+            _rebuild(channel_id, resolution, run[0], run[-1], raw_since)
+
+
+def _raw_since(channel_id):
+    """ epoch seconds from which all of a channel's raw readings are still kept, in the
+    table or cold storage, or None when none can have been archived and deleted """
+    if not conf.ARCHIVE_ROOT:
+        return None
+    days = Channel.objects.select_related('channel_type').get(pk=channel_id).get_retention_days()
+    if days is None:
+        return None
+    # the cutoff monitor.retention would use now; anything after it is still here
+    return to_seconds([datetime.datetime.now() - datetime.timedelta(days=days)])[0]
+
+
+def _rebuild(channel_id, resolution, first, last, raw_since=None):
+    """ recomputes a channel's buckets of `resolution` covering epoch seconds [first, last]:
+    minutes from its valid readings (hot and cold), hours from minutes and days from hours.
+    Minutes starting before `raw_since` are left as they are, since some of their readings
+    may only be in the archive. """
+    from monitor.coldstore import readings_between
+    first = np.floor(first / resolution) * resolution
+    last = np.floor(last / resolution) * resolution + resolution
+    finer = RESOLUTIONS.index(resolution) - 1
+    if finer < 0:
+        if raw_since is not None:
+            first = max(first, np.ceil(raw_since / resolution) * resolution)
+            if first >= last:
+                return
+        start, end = from_seconds(first), from_seconds(last)
+        pieces = [piece for piece in readings_between(channel_id, start, end) if len(piece[0])]
+        if pieces:
+            seconds, values = [np.concatenate(column) for column in zip(*pieces)]
+            values = values.astype(np.float64)
+            buckets = aggregate(seconds, values, values, values, np.ones(len(values)), resolution)
+        else:
+            buckets = ()
+    else:
+        start, end = from_seconds(first), from_seconds(last)
+        rows = (Rollup.objects.filter(channel_id=channel_id, resolution=RESOLUTIONS[finer],
+                                      bucket__gte=start, bucket__lt=end)
+                .order_by('bucket').values_list('bucket', 'minimum', 'maximum', 'mean', 'count'))
+        if rows:
+            times, minimum, maximum, mean, count = zip(*rows)
+            count = np.array(count, dtype=np.float64)
+            buckets = aggregate(to_seconds(times), np.array(minimum), np.array(maximum),
+                                np.array(mean) * count, count, resolution)
+        else:
+            buckets = ()
+
+    existing = dict(Rollup.objects.filter(channel_id=channel_id, resolution=resolution,
+                                          bucket__gte=start, bucket__lt=end)
+                    .values_list('bucket', 'pk'))
+    new = []
+    for seconds, minimum, maximum, total, count in zip(*[column.tolist() for column in buckets]):
+        bucket = from_seconds(seconds)
+        fields = {'minimum': minimum, 'maximum': maximum, 'mean': total / count, 'count': int(count)}
+        if bucket in existing:
+            Rollup.objects.filter(pk=existing.pop(bucket)).update(**fields)
+        else:
+            new.append(Rollup(channel_id=channel_id, resolution=resolution, bucket=bucket, **fields))
+    Rollup.objects.bulk_create(new)
+    # buckets in the range left with no valid readings
+    if existing:
+        Rollup.objects.filter(pk__in=list(existing.values())).delete()
+
+
+def summarize(channel_id, start, end, interval):
+    """ min/max/mean/count of a channel's valid readings in buckets of `interval` seconds
+
+    Inputs:
+      channel_id - the channel
+      start, end - datetimes; widened to whole intervals
+      interval - bucket width in seconds
+
+    Outputs:
+      (bucket start seconds, minimum, maximum, mean, count) arrays, one entry per non-empty
+      bucket
+
+    When the interval is a whole number of minutes, hours or days the coarsest such
+    rollup is used. Buckets holding readings the rollups haven't folded in yet, and every
+    bucket of other intervals, are aggregated from the raw readings (hot and cold).
+    """
+    from monitor.coldstore import readings_between
+    first = np.floor(to_seconds([start])[0] / interval) * interval
+    last = np.ceil(to_seconds([end])[0] / interval) * interval
+    start, end = from_seconds(first), from_seconds(last)
+
+    resolutions = [resolution for resolution in RESOLUTIONS if interval % resolution == 0]
+    if not resolutions:
+        raw = [(first, last)]
+        pieces = []
+    else:
+        checkpoint = Checkpoint.objects.filter(name=CHECKPOINT).values_list('value', flat=True).first() or 0
+        recent = to_seconds(Reading.objects.filter(channel_id=channel_id, pk__gt=checkpoint,
+                                                   monitor_time__gte=start, monitor_time__lt=end)
+                            .values_list('monitor_time', flat=True))
+        stale = np.unique(np.floor(recent / interval) * interval)
+        raw = []
+        for bucket in stale.tolist():
+            # neighbouring stale buckets are read as one range
+            if raw and raw[-1][1] == bucket:
+                raw[-1] = (raw[-1][0], bucket + interval)
+            else:
+                raw.append((bucket, bucket + interval))
+
+        pieces = []
+        rows = (Rollup.objects.filter(channel_id=channel_id, resolution=resolutions[-1],
+                                      bucket__gte=start, bucket__lt=end)
+                .order_by('bucket').values_list('bucket', 'minimum', 'maximum', 'mean', 'count'))
+        if rows:
+            times, minimum, maximum, mean, count = zip(*rows)
+            seconds = to_seconds(times)
+            keep = np.isin(np.floor(seconds / interval) * interval, stale, invert=True)
+            count = np.array(count, dtype=np.float64)
+            pieces.append((seconds[keep], np.array(minimum)[keep], np.array(maximum)[keep],
+                           (np.array(mean) * count)[keep], count[keep]))
+
+    for low, high in raw:
+        for seconds, values in readings_between(channel_id, from_seconds(low), from_seconds(high)):
+            pieces.append((seconds, values, values, values, np.ones(len(values))))
+
+    pieces = [piece for piece in pieces if len(piece[0])]
+    if len(pieces) == 0:
+        empty = np.array([])
+        return empty, empty, empty, empty, empty
+    seconds, minimum, maximum, total, count = [np.concatenate(column) for column in zip(*pieces)]
+    order = np.argsort(seconds, kind='mergesort')
+    buckets, minimum, maximum, total, count = aggregate(seconds[order], minimum[order], maximum[order],
+                                                        total[order], count[order], interval)
+    return buckets, minimum, maximum, total / count, count
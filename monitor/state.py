@@ -0,0 +1,124 @@
+from __future__ import absolute_import
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from monitor.models import Channel, ChannelType, Rule, Alert
+from monitor.engine import reset_engine
+from monitor.utils import bump
+from monitor import conf
+import threading
+import time
+
+# per-process cache of what the ingest path and the rule evaluation need to know about a
+# channel. The signal handlers below bump a version counter in the shared cache when a
+# Channel, ChannelType, Rule or Alert changes, one per channel or one for everything; each
+# get_state() compares them with the versions its entry was loaded at, so a change made
+# in any process is seen by the next reading everywhere. Entries also expire after
+# conf.STATE_TTL seconds, in case the cache loses a counter. The glitch filter's state is
+# not cached per process at all but kept in the shared cache, so every process filters a
+# channel against the same previous readings.
+_states = {}
+_lock = threading.Lock()
+
+VERSION_KEY = 'monitor:state:version'
+CHANNEL_VERSION_KEY = 'monitor:state:version:{}'
+FILTER_KEY = 'monitor:state:filter:{}'
+
+
+class ChannelState(object):
+    def __init__(self, channel_id, monitor_id, glitch_filter, rules, alerts, version):
+        self.channel_id = channel_id
+        self.monitor_id = monitor_id
+        # the channel type's glitch filter; its state lives in the shared cache
+        self.glitch_filter = glitch_filter
+        # rules attached to the channel, with rule_type loaded
+        self.rules = rules
+        # active channel alerts keyed by rule id
+        self.alerts = alerts
+        # (global, channel) versions the entry was loaded at
+        self.version = version
+        self.expires = time.time() + conf.STATE_TTL
+
+    def load_filter(self):
+        """ the glitch filter's state after the channel's latest readings, rebuilt from
+        the Reading table when the shared cache doesn't have it """
+        from monitor.filters import recent_values
+        stored = cache.get(FILTER_KEY.format(self.channel_id))
+        # a filter change leaves state of the wrong shape behind
+        if stored is not None and stored[0] == self.glitch_filter.name:
+            return stored[1]
+        return self.glitch_filter.initial(recent_values(self.channel_id, self.glitch_filter.history))
+
+    def store_filter(self, filter_state):
+        """ records the glitch filter's state once the readings it saw are saved """
+        cache.set(FILTER_KEY.format(self.channel_id), (self.glitch_filter.name, filter_state), conf.FILTER_STATE_TTL)
+
+
+def get_state(channel_id):
+    """ returns the ChannelState for a channel, loading it from the database on a miss
+
+    raises Channel.DoesNotExist for unknown channels
+    """
+    keys = [VERSION_KEY, CHANNEL_VERSION_KEY.format(channel_id)]
+    versions = cache.get_many(keys)
+    version = tuple(versions.get(key, 0) for key in keys)
+    state = _states.get(channel_id)
+    if state is None or state.expires < time.time() or state.version != version:
+        state = _load(channel_id, version)
+        with _lock:
+            _states[channel_id] = state
+    return state
+
+
+def invalidate(channel_id=None):
+    """ drops one channel's state, or everything if no channel is given, in every process """
+    with _lock:
+        if channel_id is None:
+            _states.clear()
+        else:
+            _states.pop(channel_id, None)
+    bump(VERSION_KEY if channel_id is None else CHANNEL_VERSION_KEY.format(channel_id))
+
+
+def _load(channel_id, version):
+    channel = Channel.objects.select_related('channel_type').get(pk=channel_id)
+    glitch_filter = channel.channel_type.get_glitch_filter()
+    links = Channel.rules.through.objects.filter(channel_id=channel_id).select_related('rule__rule_type')
+    rules = [link.rule for link in links]
+    alerts = {}
+    for alert in Alert.objects.filter(channel_id=channel_id, active=True, alert_type=Alert.CHANNEL_ALERT):
+        alerts.setdefault(alert.rule_id, []).append(alert)
+    return ChannelState(channel.id, channel.monitor_id, glitch_filter, rules, alerts, version)
+
+
+@receiver([post_save, post_delete], sender=Channel)
+def channel_changed(sender, instance, **kwargs):
+    invalidate(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=ChannelType)
+def channel_type_changed(sender, instance, **kwargs):
+    # the glitch filter of every channel of the type may have changed
+    invalidate()
+
+
+@receiver([post_save, post_delete], sender=Rule)
+def rule_changed(sender, instance, **kwargs):
+    # a rule can be attached to any number of channels
+    invalidate()
+    reset_engine()
+
+
+@receiver([post_save, post_delete], sender=Alert)
+def alert_changed(sender, instance, **kwargs):
+    if instance.channel_id is not None:
+        invalidate(instance.channel_id)
+
+
+@receiver(m2m_changed, sender=Channel.rules.through)
+def channel_rules_changed(sender, instance, reverse, **kwargs):
+    if reverse:
+        invalidate()
+    else:
+        invalidate(instance.pk)
+    reset_engine()
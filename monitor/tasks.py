@@ -1,172 +1,237 @@
 from __future__ import absolute_import
-from django.core.mail import EmailMultiAlternatives, EmailMessage
 from celery import shared_task
-from monitor.models import Channel, Rule, User, Reading, Alert, Preference
-from automation.settings import SERVER_URL
+from django.db.models import Q
+from monitor.models import Channel, Rule, Reading, Alert
+from monitor.state import get_state
+from monitor.engine import get_engine
+from monitor.notify import dispatch
+from monitor.utils import utcnow
+from monitor import conf, metrics
 import datetime
-import uuid
+
+try:
+    from celery.contrib.batches import Batches
+except ImportError:
+    # removed from Celery 4; the celery-batches package carries it on
+    try:
+        from celery_batches import Batches
+    except ImportError:
+        Batches = None
 
 @shared_task
+@metrics.timed('process_reading')
 def process_reading(channel_id, reading_id):
-    channel = Channel.objects.get(pk=channel_id)
+    started = utcnow()
+    state = get_state(channel_id)
+    if len(state.rules) == 0:
+           return 'channel {}: no rules'.format(channel_id)
     try:
         reading = Reading.objects.get(pk=reading_id)
     except:
         raise Exception("Reading {} does not exist".format(reading_id))
-    rules = Rule.objects.filter(channel=channel)
-    if len(rules) == 0:
-           return 'channel {}: no rules'.format(channel_id)
+    metrics.queue_lag(reading.transaction_time)
+    metrics.increment('readings_evaluated_total')
+    outbox = []
+    return_text = evaluate_reading(state, reading, get_engine().evaluate([reading])[0], outbox, started)
+    if outbox:
+        process_alerts.delay(outbox)
+    return return_text
+
+@shared_task
+@metrics.timed('process_readings')
+def process_readings(reading_ids):
+    """ evaluates the rules for a batch of readings written by monitor.ingest
+
+    Inputs:
+      reading_ids - IDs of the readings to evaluate
+
+    Outputs:
+      text describing what happened to each reading
+    """
+    started = utcnow()
+    readings = list(Reading.objects.filter(pk__in=reading_ids).order_by('monitor_time'))
+    for reading in readings:
+        metrics.queue_lag(reading.transaction_time)
+    metrics.increment('readings_evaluated_total', len(readings))
     return_text = ''
-    for rule in rules:
-        # dont process inactive or paused rules
-        if rule.state == Rule.RULE_INACTIVE:
-            return_text += 'Rule {} inactive\n'.format(rule.id)
+    # notifications for the whole batch go out in one process_alerts task
+    outbox = []
+    for reading, results in zip(readings, get_engine().evaluate(readings)):
+        if len(results) == 0:
             continue
-        if rule.state == Rule.RULE_PAUSED:
-            return_text += 'Rule {} paused\n'.format(rule.id)
+        # fetched per reading: alerts opened or closed by the previous reading drop the
+        # channel's cached state
+        return_text += evaluate_reading(get_state(reading.channel_id), reading, results, outbox, started)
+    if outbox:
+        process_alerts.delay(outbox)
+    return return_text
+
+if Batches is not None:
+    @shared_task(base=Batches, flush_every=conf.EVALUATE_BATCH, flush_interval=conf.EVALUATE_WAIT / 1000.0)
+    def evaluate_readings(requests):
+        """ collects single readings queued by queue_evaluation and evaluates up to
+        conf.EVALUATE_BATCH of them, or whatever arrived within conf.EVALUATE_WAIT
+        milliseconds, with one process_readings call
+
+        Batches acknowledges each message when it is buffered, not when it is processed;
+        the readings buffered by a worker that stops are never evaluated.
+        """
+        metrics.observe('evaluate_batch_size', len(requests), metrics.COUNT_BUCKETS)
+        return process_readings([request.args[0] for request in requests])
+else:
+    evaluate_readings = None
+
+def queue_evaluation(channel_id, reading_id):
+    """ queues a newly saved reading for rule evaluation, batched when
+    conf.BATCHED_EVALUATION is on and a Batches implementation is installed """
+    if conf.BATCHED_EVALUATION and evaluate_readings is not None:
+        evaluate_readings.delay(reading_id)
+    else:
+        process_reading.delay(channel_id, reading_id)
+
+def evaluate_reading(state, reading, results, outbox, started=None):
+    """ opens, renews or resolves alerts for one reading
+
+    Inputs:
+      state - ChannelState of the reading's channel
+      reading - the Reading
+      results - (rule, matched) tuples from the rule engine; only active and paused rules
+                are included
+      outbox - list the (alert_id, restored, contact_ids) notifications are appended to
+      started - when the task evaluating the reading started, stamped on new alerts
 
+    Outputs:
+      text describing what happened
+    """
+    return_text = ''
+    for rule, matched in results:
         # don't create a new alert if there is an existing, active alert for this rule and
         # channel. We'll just queue up the existing alert (if unacknowledged) to keep nagging
         # the contacts
-        prev_alerts = Alert.objects.filter(channel=channel, rule=rule, active=True, alert_type=Alert.CHANNEL_ALERT)
+        prev_alerts = state.alerts.get(rule.id, [])
+        # a paused rule neither opens alerts nor sends reminders, but its alerts are still
+        # resolved once the condition clears
+        if rule.state == Rule.RULE_PAUSED and (matched or len(prev_alerts) == 0):
+            return_text += 'Rule {} paused\n'.format(rule.id)
+            continue
         if len(prev_alerts) > 0: # we must have existing alerts for this channel/rule
             for alert in prev_alerts:
-                if rule.evaluate(reading):
-                    if not alert.acknowledged_by:
-                        process_alert.delay(alert.id)
-                    return_text += 'Channel {}: rule matched - active alert exists - value = {}\n'.format(channel.id, str(reading.value))
+                if matched:
+                    if not alert.acknowledged_by_id and notification_due(alert, rule):
+                        outbox.append((alert.id, False, None))
+                    return_text += 'Channel {}: rule matched - active alert exists - value = {}\n'.format(state.channel_id, str(reading.value))
                 else: # the condition that triggered the active alert must not be present any longer
                     alert.active = False
                     alert.resolved_time = datetime.datetime.now()
                     alert.save()
-                    process_alert.delay(alert.id, restored=True)
+                    outbox.append((alert.id, True, None))
                     return_text += 'Channel {}: rule matched - active alert cancelled\n'
 
         else:
-            if reading.is_valid and rule.evaluate(reading):
+            if reading.is_valid and matched:
                 alert = Alert(alert_type = Alert.CHANNEL_ALERT,
-                              monitor = channel.monitor,
-                              channel = channel,
+                              monitor_id = state.monitor_id,
+                              channel_id = state.channel_id,
                               reading = reading,
                               rule = rule,
                               active = True,
+                              last_notified = datetime.datetime.now(),
+                              evaluated_time = started or utcnow(),
                               )
                 alert.save()
-                process_alert.delay(alert.id)
-                channel.last_alert = alert
-                channel.save()
-                return_text += 'Channel {}: rule {} matched value {} - alert created\n'.format(channel.id, rule.id, str(reading.value))
+                outbox.append((alert.id, False, None))
+                Channel.objects.filter(pk=state.channel_id).update(last_alert=alert)
+                return_text += 'Channel {}: rule {} matched value {} - alert created\n'.format(state.channel_id, rule.id, str(reading.value))
             else:
-                return_text += "Channel {}: rule {} didn't match value {}\n".format(channel.id, rule.id, str(reading.value))
+                return_text += "Channel {}: rule {} didn't match value {}\n".format(state.channel_id, rule.id, str(reading.value))
 
     return return_text
 
-def make_alert_email(user, channel, rule, alert):
-    to_addr = ['{} <{}>'.format(str(user.get_full_name()), user.email)]
-    msg = 'The following rule was activated on monitor: {}, '.format(channel.monitor.name)
-    msg = msg + 'channel: {}\n'.format(channel.name)
-    msg = msg + '{}\n\n'.format(rule.descriptive_name)
-    msg = msg + 'Current reading for {} is {}\n\n'.format(channel.name, channel.last_reading.value)
-    msg = msg + 'To acknowledge this alert click '
-    msg = msg + '<a href=https://{}/monitor/ack?aid={}&bid={}>here</a>'.format(SERVER_URL, alert.uuid, user.id)
-    html = '<span style="font-size: 150%">The following rule was activated on monitor: {}, '.format(channel.monitor.name)
-    html = html + 'channel: {}<br />'.format(channel.name)
-    html = html + '<span style="color:red;">{}</span><br /><br />'.format(rule.descriptive_name())
-    html = html + 'Current reading for {} is {}<br />'.format(channel.name, channel.last_reading.value)
-    html = html + 'To acknowledge this alert click '
-    html = html + '<a href=https://{}/monitor/ack?aid={}&bid={}>here</a></span>'.format(SERVER_URL, alert.uuid, user.id)
-    subject = 'Alert from {} Monitor'.format(channel.monitor.name)
-    from_addr = 'Syliant Monitor <admin@syliant.com>'
-    
-    email = EmailMultiAlternatives(subject, msg, from_addr, to_addr)
-    email.attach_alternative(html, "text/html")
-    return email
-
-def make_alert_text(user, channel, rule, alert):
-    to_addr = ['{} <{}@{}>'.format(str(user.get_full_name()), user.text_number, user.text_provider)]
-    msg = 'Monitor: {}, '.format(channel.monitor.name)
-    msg = msg + '{}\n\n'.format(rule.descriptive_name())
-    msg = msg + 'To acknowledge click link:'
-    msg = msg + '<a href=https://{}/monitor/ack?aid={}&bid={}></a>'.format(SERVER_URL, alert.uuid, user.id)
-    subject = 'Alert from {} Monitor'.format(channel.monitor.name)
-    from_addr = 'Oldboy Monitor <admin@oldboy.net>'
-    
-    email = EmailMessage(subject, msg, from_addr, to_addr)
-    return email
-
-def make_restored_email(user, channel):
-    to_addr = ['{} <{}>'.format(str(user.get_full_name()), user.email)]
-    msg = 'Monitor: {}, '.format(channel.monitor.name)
-    msg = msg + 'channel:{}\n'.format(channel.name)
-    msg = msg + 'is reporting normal values.'
-    html= '<span style="font-size: 150%;">Monitor: {}, '.format(channel.monitor.name)
-    html = html + 'channel:{}<br />'.format(channel.name)
-    html = html + 'is now reporting normal values.</span>'
-    subject = 'Recovery Notice from Syliant Monitor'
-    subject = 'Alert from {} Monitor'.format(channel.monitor.name)
-    from_addr = 'Oldboy Monitor <admin@oldboy.net>'
-    
-    email = EmailMultiAlternatives(subject, msg, from_addr, to_addr)
-    email.attach_alternative(html, "text/html")
-    return email
-
-def make_restored_text(user, channel):
-    to_addr = ['{} <{}@{}>'.format(str(user.get_full_name()), user.text_number, user.text_provider)]
-    msg = 'Monitor: {}, '.format(channel.monitor.name)
-    msg = msg + 'channel:{}\n'.format(channel.name)
-    msg = msg + 'is reporting normal values.'
-    subject = 'Recovery Notice from {} Monitor'.format(channel.monitor.name)
-    from_addr = 'Oldboy Monitor <admin@oldboy.net>'
-    
-    email = EmailMessage(subject, msg, from_addr, to_addr)
-    return email
+def notification_due(alert, rule):
+    """ True when an open alert's reminder interval has passed; marks it notified if so.
+
+    The cached alert can only be behind the row, so it rules out reminders that aren't due
+    without a query. The row is claimed with a conditional field-only update: of several
+    workers evaluating readings of the channel at once only the one whose update matched
+    sends the reminder. """
+    now = datetime.datetime.now()
+    due_before = now - rule.renotify_interval()
+    if alert.last_notified and alert.last_notified > due_before:
+        return False
+    claimed = (Alert.objects.filter(pk=alert.id)
+               .filter(Q(last_notified__isnull=True) | Q(last_notified__lte=due_before))
+               .update(last_notified=now))
+    alert.last_notified = now
+    return claimed == 1
 
 @shared_task
-def process_alert(alert_id, restored=False):
+def process_alert(alert_id, restored=False, contact_ids=None, attempt=0):
     """ sends alerts to contacts associated with rules
     
     Inputs:
       alert_id - ID of the alert object
       restored - if the condition that caused the alert no longer exists, notify contacts about this
+      contact_ids - only notify these users (used when retrying failed recipients)
+      attempt - number of earlier attempts
 
     Outputs:
-      none
+      number of messages sent
     """
-    alert = Alert.objects.get(pk=alert_id)
-    rule = alert.rule
-    channel = alert.channel
-    value = alert.reading.value
     print('processing alert {}'.format(alert_id))
-    contacts = rule.contacts.all()
-    if len(contacts) > 0 and (rule.action == Rule.SEND_EMAIL_TEXT_ALERT or rule.action == Rule.SEND_BOTH):
-        for contact in contacts:
-            emails = []
-            if not contact.is_active:
-                continue # don't send emails to inactive users
-            preference = Preference.objects.get(user=contact)
-            if preference.contact_method == Preference.EMAIL:
-                if restored:
-                    emails.append(make_restored_email(contact, channel))
-                else:
-                    emails.append(make_alert_email(contact, channel, rule, alert))
-            elif preference.contact_method == Preference.TEXT:
-                if restored:
-                    emails.append(make_restored_text(contact, channel))
-                else:
-                    emails.append(make_alert_text(contact, channel, rule, alert))
-            elif preference.contact_method == Preference.BOTH:
-                if restored:
-                    emails.append(make_restored_email(contact, channel))
-                    emails.append(make_restored_text(contact, channel))
-                else:
-                    emails.append(make_alert_email(contact, channel, rule, alert))
-                    emails.append(make_alert_text(contact, channel, rule, alert))
-
-            for email in emails:
-                if email.send() == 0:
-                    return 'error'
-                else:
-                    print('Sent email to {}'.format(','.join(email.to)))
+    return process_alerts([(alert_id, restored, contact_ids)], attempt)
+
+@shared_task
+@metrics.timed('process_alerts')
+def process_alerts(notifications, attempt=0):
+    """ sends the notifications for many alerts over a single mail connection
+
+    Inputs:
+      notifications - list of (alert_id, restored, contact_ids) tuples
+      attempt - number of earlier attempts
+
+    Outputs:
+      number of messages sent
+
+    Recipients whose messages fail are retried with backoff, up to conf.NOTIFY_RETRIES times.
+    """
+    sent, failed = dispatch(notifications)
+    if failed and attempt < conf.NOTIFY_RETRIES:
+        process_alerts.apply_async((failed, attempt + 1), countdown=conf.NOTIFY_RETRY_DELAY * 2 ** attempt)
+    return sent
+
+@shared_task
+def send_digests():
+    from monitor import notify
+    return '{} digest messages sent'.format(notify.send_digests())
+
+@shared_task
+def update_pointers(channel_id=None, monitor_id=None):
+    from monitor.ingest import flush_pointers
+    flush_pointers(channel_id, monitor_id)
+    return 'pointers updated for channel {} monitor {}'.format(channel_id, monitor_id)
+
+@shared_task
+def update_rollups():
+    from monitor import rollups
+    return '{} readings rolled up'.format(rollups.update_rollups())
+
+@shared_task
+def compact_readings():
+    from monitor import coldstore
+    return '{} readings moved to cold storage'.format(coldstore.compact())
+
+@shared_task
+def enforce_retention():
+    from monitor import retention
+    return '{} readings archived'.format(retention.enforce())
+
+@shared_task
+def check_overdue():
+    from monitor import overdue
+    opened, resolved = overdue.check_overdue()
+    if opened or resolved:
+        process_alerts.delay(opened + resolved)
+    return '{} monitors overdue, {} recovered'.format(len(opened), len(resolved))
 
 @shared_task
 def unpause(rule_id):
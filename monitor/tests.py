@@ -1,3 +1,748 @@
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail.backends.locmem import EmailBackend
+from django.test import RequestFactory, TestCase
+from unittest import mock, skipIf
+from monitor.models import (Monitor, Unit, ChannelType, Channel, Reading, Rollup, RuleType, Rule, Alert, Preference,
+                            PendingNotification)
+from monitor.ingest import ingest_readings, parse_time
+from monitor.engine import get_engine, VERSION_KEY
+from monitor.tasks import evaluate_reading, process_alerts
+from monitor.notify import dispatch, send_digests
+from monitor.overdue import check_overdue
+from monitor.utils import from_seconds, bump
+from monitor import coldstore, conf, events, filters, rollups, state, units
+from api import authentication, resources
+from api.paginators import KeysetPaginator, encode_cursor, decode_cursor
+from tastypie.exceptions import BadRequest
+from tastypie.models import ApiKey
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import calendar
+import datetime
+import json
+import shutil
+import tempfile
+import time
 
-# Create your tests here.
+# midnight UTC, 30 May 2016
+DAY = 1464566400
+
+
+def make_channel(**channel_type):
+    unit = Unit.objects.create(name='temperature', unit_metric='celsius', unit_imperial='fahrenheit',
+                               abbrev_metric='C', abbrev_imperial='F',
+                               m_to_i_function='celcius_to_fahrenheit', i_to_m_function='fahrenheit_to_celcius')
+    kind = ChannelType.objects.create(sensor_name='t', common_name='temperature', units=unit,
+                                      measurement_system=Unit.METRIC, **channel_type)
+    monitor = Monitor.objects.create(name='greenhouse', location='north')
+    return Channel.objects.create(monitor=monitor, channel_num=1, channel_type=kind, name='air',
+                                  status=Channel.ENABLED)
+
+
+def api_key(username='device'):
+    """ a user with an API key, and the Authorization header that presents it """
+    user = User.objects.create_user(username, password='secret')
+    key = ApiKey.objects.create(user=user)
+    return user, 'ApiKey {}:{}'.format(username, key.key)
+
+
+class StateTestCase(TestCase):
+    def setUp(self):
+        # the shared cache and the per-process channel state outlive each test's rollback
+        cache.clear()
+        state.invalidate()
+
+
+class IngestTests(StateTestCase):
+    def setUp(self):
+        super(IngestTests, self).setUp()
+        self.channel = make_channel()
+
+    def ingest(self, *samples):
+        return ingest_readings([{'channel': self.channel.pk, 'monitor_time': parse_time(DAY + seconds), 'value': value}
+                                for seconds, value in samples])
+
+    def test_writes_readings_in_time_order(self):
+        readings = self.ingest((120, 21.0), (0, 20.0), (60, 20.5))
+        self.assertEqual([reading.value for reading in readings], [20.0, 20.5, 21.0])
+        self.assertEqual(Reading.objects.filter(channel=self.channel).count(), 3)
+        self.assertTrue(all(reading.pk for reading in readings))
+
+    def test_applies_offsets(self):
+        readings = ingest_readings([{'channel': self.channel.pk, 'monitor_time': parse_time(DAY),
+                                     'value': 20.0, 'offset_value': -1.5}])
+        self.assertEqual(Reading.objects.get(pk=readings[0].pk).value, 18.5)
+
+    def test_moves_pointers_to_newest_reading(self):
+        readings = self.ingest((0, 20.0), (60, 20.5))
+        channel = Channel.objects.get(pk=self.channel.pk)
+        self.assertEqual(channel.last_reading_id, readings[-1].pk)
+        self.assertEqual(channel.last_valid_reading_id, readings[-1].pk)
+        self.assertIsNotNone(Monitor.objects.get(pk=self.channel.monitor_id).last_update)
+
+    def test_late_upload_does_not_move_pointers_back(self):
+        newest = self.ingest((600, 20.0))[0]
+        self.ingest((0, 19.0), (60, 19.5))
+        channel = Channel.objects.get(pk=self.channel.pk)
+        self.assertEqual(channel.last_reading_id, newest.pk)
+        self.assertEqual(channel.last_valid_reading_id, newest.pk)
+
+    def test_flags_glitches(self):
+        readings = self.ingest((0, 20.0), (60, 20.5), (120, 80.0))
+        self.assertEqual([reading.is_valid for reading in readings], [True, True, False])
+        channel = Channel.objects.get(pk=self.channel.pk)
+        self.assertEqual(channel.last_reading_id, readings[2].pk)
+        self.assertEqual(channel.last_valid_reading_id, readings[1].pk)
+
+    def test_filters_across_batches(self):
+        self.ingest((0, 20.0))
+        self.assertFalse(self.ingest((60, 80.0))[0].is_valid)
+
+    def test_unknown_channel(self):
+        with self.assertRaises(ValueError):
+            ingest_readings([{'channel': self.channel.pk + 1000, 'monitor_time': parse_time(DAY), 'value': 1.0}])
+
+    def test_empty_batch(self):
+        self.assertEqual(ingest_readings([]), [])
+
+
+class IngestResourceTests(StateTestCase):
+    def setUp(self):
+        super(IngestResourceTests, self).setUp()
+        self.channel = make_channel()
+        self.user, self.auth = api_key()
+
+    def post(self, body, content_type='text/csv', auth=True, query=''):
+        extra = {'HTTP_AUTHORIZATION': self.auth} if auth else {}
+        return self.client.post('/api/v1/ingest/' + query, body, content_type=content_type, **extra)
+
+    def test_csv(self):
+        body = '{0},{1},20.0\n{0},{2},20.5,21.0\n'.format(self.channel.pk, DAY, DAY + 60)
+        response = self.post(body, query='?step=30')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.content, b'3')
+        readings = Reading.objects.filter(channel=self.channel).order_by('monitor_time')
+        self.assertEqual([reading.value for reading in readings], [20.0, 20.5, 21.0])
+        self.assertEqual(readings[2].monitor_time, parse_time(DAY + 90))
+
+    @skipIf(resources.msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        body = resources.msgpack.packb([[self.channel.pk, DAY, 20.0],
+                                        [self.channel.pk, DAY + 60, 30, np.array([20.5, 21.0], dtype='<f4').tobytes()]])
+        response = self.post(body, content_type='application/x-msgpack')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.content, b'3')
+        readings = Reading.objects.filter(channel=self.channel).order_by('monitor_time')
+        self.assertEqual([reading.value for reading in readings], [20.0, 20.5, 21.0])
+
+    def test_malformed_row_is_rejected(self):
+        response = self.post('{0},{1},20.0\n{0},soon,20.5\n'.format(self.channel.pk, DAY))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Reading.objects.filter(channel=self.channel).exists())
+
+    def test_unauthenticated(self):
+        response = self.post('{},{},20.0\n'.format(self.channel.pk, DAY), auth=False)
+        self.assertEqual(response.status_code, 401)
+        self.assertFalse(Reading.objects.filter(channel=self.channel).exists())
+
+
+class AggregateTests(TestCase):
+    def test_folds_samples_into_buckets(self):
+        seconds = np.array([0, 10, 59, 60, 130, 170], dtype=np.float64)
+        values = np.array([1, 5, 3, 2, 8, 4], dtype=np.float64)
+        buckets, minimum, maximum, total, count = rollups.aggregate(seconds, values, values, values,
+                                                                    np.ones(len(values)), 60)
+        self.assertEqual(buckets.tolist(), [0, 60, 120])
+        self.assertEqual(minimum.tolist(), [1, 2, 4])
+        self.assertEqual(maximum.tolist(), [5, 2, 8])
+        self.assertEqual(total.tolist(), [9, 2, 12])
+        self.assertEqual(count.tolist(), [3, 1, 2])
+
+    def test_folds_rollups_into_coarser_buckets(self):
+        # two minutes with means 2 (of 3 readings) and 5 (of 1) make one hour with mean 2.75
+        buckets, minimum, maximum, total, count = rollups.aggregate(
+            np.array([0.0, 60.0]), np.array([1.0, 5.0]), np.array([3.0, 5.0]),
+            np.array([2.0 * 3, 5.0 * 1]), np.array([3.0, 1.0]), 3600)
+        self.assertEqual(buckets.tolist(), [0])
+        self.assertEqual((minimum[0], maximum[0], count[0]), (1, 5, 4))
+        self.assertEqual(total[0] / count[0], 2.75)
+
+    def test_no_samples(self):
+        buckets = rollups.aggregate(np.array([]), np.array([]), np.array([]), np.array([]), np.array([]), 60)
+        self.assertEqual([len(column) for column in buckets], [0] * 5)
+
+
+class RollupTests(StateTestCase):
+    def setUp(self):
+        super(RollupTests, self).setUp()
+        self.channel = make_channel()
+
+    def add(self, *samples):
+        Reading.objects.bulk_create([Reading(channel=self.channel, monitor_time=from_seconds(DAY + seconds),
+                                             value=value, is_valid=valid)
+                                     for seconds, value, valid in samples])
+
+    def rollup(self, resolution):
+        return list(Rollup.objects.filter(channel=self.channel, resolution=resolution).order_by('bucket')
+                    .values_list('minimum', 'maximum', 'mean', 'count'))
+
+    def test_builds_minute_hour_and_day_rollups(self):
+        self.add((0, 1.0, True), (30, 3.0, True), (90, 5.0, True), (100, 100.0, False))
+        with mock.patch.object(conf, 'ROLLUP_LAG', -60):
+            self.assertEqual(rollups.update_rollups(), 4)
+        self.assertEqual(self.rollup(Rollup.MINUTE), [(1.0, 3.0, 2.0, 2), (5.0, 5.0, 5.0, 1)])
+        self.assertEqual(self.rollup(Rollup.HOUR), [(1.0, 5.0, 3.0, 3)])
+        self.assertEqual(self.rollup(Rollup.DAY), [(1.0, 5.0, 3.0, 3)])
+
+    def test_aggregate_endpoint(self):
+        self.add((0, 1.0, True), (30, 3.0, True), (90, 5.0, True), (100, 100.0, False))
+        with mock.patch.object(conf, 'ROLLUP_LAG', -60):
+            rollups.update_rollups()
+        # arrives after the rollup, so its minute is read from the raw readings
+        self.add((45, 5.0, True))
+        user, auth = api_key()
+        response = self.client.get('/api/v1/aggregate/', {'channel': self.channel.pk, 'interval': 60,
+                                                          'start': DAY, 'end': DAY + 120},
+                                   HTTP_AUTHORIZATION=auth, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 200)
+        body = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(body['channel'], self.channel.pk)
+        self.assertEqual([(item['min'], item['max'], item['mean'], item['count']) for item in body['objects']],
+                         [(1.0, 5.0, 3.0, 3), (5.0, 5.0, 5.0, 1)])
+        self.assertEqual([parse_time(item['bucket']) for item in body['objects']],
+                         [parse_time(DAY), parse_time(DAY + 60)])
+
+    def test_waits_for_recent_readings(self):
+        self.add((0, 1.0, True))
+        self.assertEqual(rollups.update_rollups(), 0)
+
+    def test_rebuild_drops_emptied_buckets(self):
+        self.add((0, 1.0, True), (90, 5.0, True))
+        with mock.patch.object(conf, 'ROLLUP_LAG', -60):
+            rollups.update_rollups()
+        Reading.objects.filter(value=5.0).update(is_valid=False)
+        rollups.rebuild(self.channel.pk, [DAY + 90])
+        self.assertEqual(self.rollup(Rollup.MINUTE), [(1.0, 1.0, 1.0, 1)])
+        self.assertEqual(self.rollup(Rollup.HOUR), [(1.0, 1.0, 1.0, 1)])
+
+    def test_rebuild_keeps_minutes_past_retention(self):
+        self.add((0, 1.0, True), (90, 5.0, True))
+        with mock.patch.object(conf, 'ROLLUP_LAG', -60):
+            rollups.update_rollups()
+        # archived and deleted by monitor.retention
+        Channel.objects.filter(pk=self.channel.pk).update(raw_retention_days=1)
+        Reading.objects.filter(channel=self.channel).delete()
+        with mock.patch.object(conf, 'ARCHIVE_ROOT', '/archive'):
+            rollups.rebuild(self.channel.pk, [DAY + 90])
+        self.assertEqual(self.rollup(Rollup.MINUTE), [(1.0, 1.0, 1.0, 1), (5.0, 5.0, 5.0, 1)])
+
+    def test_summarize_reads_readings_not_rolled_up(self):
+        self.add((0, 1.0, True), (90, 5.0, True))
+        with mock.patch.object(conf, 'ROLLUP_LAG', -60):
+            rollups.update_rollups()
+        self.add((150, 9.0, True))
+        buckets, minimum, maximum, mean, count = rollups.summarize(self.channel.pk, from_seconds(DAY),
+                                                                   from_seconds(DAY + 180), 60)
+        self.assertEqual(buckets.tolist(), [DAY, DAY + 60, DAY + 120])
+        self.assertEqual(mean.tolist(), [1.0, 5.0, 9.0])
+        self.assertEqual(count.tolist(), [1, 1, 1])
+
+
+class AuthenticationTests(StateTestCase):
+    def setUp(self):
+        super(AuthenticationTests, self).setUp()
+        authentication._keys.clear()
+        self.user, self.auth = api_key()
+
+    def authenticate(self, auth=None):
+        request = RequestFactory().get('/api/v1/monitor/', HTTP_AUTHORIZATION=auth or self.auth)
+        return authentication.CachedApiKeyAuthentication().is_authenticated(request) is True, request
+
+    def test_hit_skips_queries(self):
+        self.assertTrue(self.authenticate()[0])
+        with self.assertNumQueries(0):
+            accepted, request = self.authenticate()
+        self.assertTrue(accepted)
+        self.assertEqual(request.user.pk, self.user.pk)
+
+    def test_expiry(self):
+        self.assertTrue(self.authenticate()[0])
+        # changed without signals, so only the expiry can notice
+        ApiKey.objects.filter(user=self.user).update(key='replaced')
+        self.assertTrue(self.authenticate()[0])
+        with mock.patch.object(authentication.time, 'time', return_value=time.time() + conf.AUTH_CACHE_TTL + 1):
+            self.assertFalse(self.authenticate()[0])
+
+    def test_revoked_key(self):
+        self.assertTrue(self.authenticate()[0])
+        ApiKey.objects.get(user=self.user).delete()
+        self.assertFalse(self.authenticate()[0])
+
+    def test_revoked_in_another_process(self):
+        self.assertTrue(self.authenticate()[0])
+        # another process's forget() only reaches this one through the shared counter
+        ApiKey.objects.filter(user=self.user).update(key='replaced')
+        bump(authentication.VERSION_KEY.format(self.user.pk))
+        self.assertFalse(self.authenticate()[0])
+
+    def test_deactivated_user(self):
+        self.assertTrue(self.authenticate()[0])
+        self.user.is_active = False
+        self.user.save()
+        self.assertFalse(self.authenticate()[0])
+
+    def test_inactive_cached_user(self):
+        accepted, request = self.authenticate()
+        request.user.is_active = False
+        self.assertFalse(self.authenticate()[0])
+
+    def test_eviction(self):
+        other, other_auth = api_key('other')
+        with mock.patch.object(conf, 'AUTH_CACHE_SIZE', 1):
+            self.assertTrue(self.authenticate()[0])
+            self.assertTrue(self.authenticate(other_auth)[0])
+        self.assertEqual([user.pk for user, expires, version in authentication._keys.values()], [other.pk])
+        # the evicted key is looked up again
+        ApiKey.objects.filter(user=self.user).update(key='replaced')
+        self.assertFalse(self.authenticate()[0])
+
+
+class KeysetPaginatorTests(TestCase):
+    def setUp(self):
+        self.channel = make_channel()
+        # pairs of readings share a time, so pages must break ties by id
+        Reading.objects.bulk_create([Reading(channel=self.channel, monitor_time=from_seconds(DAY + 60 * (i // 2)),
+                                             value=float(i)) for i in range(7)])
+        self.objects = Reading.objects.filter(channel=self.channel).order_by('-monitor_time', '-id')
+
+    def page(self, **params):
+        return KeysetPaginator(params, self.objects, resource_uri='/api/v1/reading/', limit=2).page()
+
+    def test_cursor_pages_cover_every_reading_once(self):
+        seen = []
+        page = self.page()
+        while True:
+            seen.extend(reading.pk for reading in page['objects'])
+            if page['meta']['next'] is None:
+                break
+            cursor = parse_qs(urlparse(page['meta']['next']).query)['cursor'][0]
+            page = self.page(cursor=cursor)
+        self.assertEqual(seen, list(self.objects.values_list('pk', flat=True)))
+
+    def test_total_count_is_optional(self):
+        self.assertEqual(self.page()['meta']['total_count'], 7)
+        self.assertNotIn('total_count', self.page(count='false')['meta'])
+
+    def test_cursor_round_trip(self):
+        reading = self.objects[0]
+        self.assertEqual(decode_cursor(encode_cursor(reading)), (reading.monitor_time, reading.pk))
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(BadRequest):
+            self.page(cursor='yesterday')
+
+
+class UnitTests(TestCase):
+    def setUp(self):
+        units.reset()
+        self.channel = make_channel()
+        self.unit = self.channel.channel_type.units
+
+    def test_converts_arrays_and_floats(self):
+        self.assertEqual(units.convert('celcius_to_fahrenheit', np.array([0.0, 100.0])).tolist(), [32.0, 212.0])
+        self.assertEqual(units.convert('fahrenheit_to_celcius', 212.0), 100.0)
+        self.assertEqual(units.convert('affine:0.5:-1', 4), 1.0)
+
+    def test_unknown_conversions(self):
+        for name in ('kelvin_to_rankine', 'affine:2', 'affine:a:b'):
+            with self.assertRaises(ValueError):
+                units.conversion(name)
+
+    def test_converter_follows_measurement_systems(self):
+        self.assertIsNone(units.converter(self.unit.pk, Unit.METRIC, Unit.METRIC))
+        self.assertEqual(units.converter(self.unit.pk, Unit.METRIC, Unit.IMPERIAL)(10.0), 50.0)
+        self.assertEqual(units.converter(self.unit.pk, Unit.IMPERIAL, Unit.METRIC)(50.0), 10.0)
+
+    def test_saving_a_unit_drops_cached_conversions(self):
+        units.converter(self.unit.pk, Unit.METRIC, Unit.IMPERIAL)
+        self.unit.m_to_i_function = 'affine:2:0'
+        self.unit.save()
+        self.assertEqual(units.converter(self.unit.pk, Unit.METRIC, Unit.IMPERIAL)(10.0), 20.0)
+
+
+class FilterTests(TestCase):
+    def setUp(self):
+        random = np.random.RandomState(7)
+        # noise around zero, a few spikes and a change of level
+        self.values = random.normal(0, 1, 200)
+        self.values[[20, 21, 90, 150]] += 40
+        self.values[120:] += 15
+
+    def test_batch_matches_step(self):
+        for name, cls in filters.FILTERS.items():
+            glitch_filter = cls()
+            stepped = []
+            state = None
+            for value in self.values.tolist():
+                valid, state = glitch_filter.step(state, value)
+                stepped.append(valid)
+            # in chunks, carrying the state across them like recompute does
+            batched = []
+            batch_state = None
+            for start in range(0, len(self.values), 37):
+                valid, batch_state = glitch_filter.batch(batch_state, self.values[start:start + 37])
+                batched.extend(valid.tolist())
+            self.assertEqual(batched, stepped, name)
+            self.assertEqual(list(np.ravel(batch_state)), list(np.ravel(state)), name)
+            self.assertFalse(all(stepped), name)
+
+    def test_step_leaves_state_alone(self):
+        for name, cls in filters.FILTERS.items():
+            glitch_filter = cls()
+            state = glitch_filter.initial(self.values[:30].tolist())
+            before = list(np.ravel(state))
+            glitch_filter.step(state, 100.0)
+            glitch_filter.batch(state, self.values[30:40])
+            self.assertEqual(list(np.ravel(state)), before, name)
+
+    def test_tolerance_near_zero(self):
+        self.assertTrue(filters.JumpFilter().step(0.01, 0.2)[0])
+        self.assertFalse(filters.JumpFilter(tolerance=0.0).step(0.01, 0.2)[0])
+
+    def test_filters_must_step(self):
+        with self.assertRaises(TypeError):
+            filters.GlitchFilter()
+
+
+class EngineTests(StateTestCase):
+    def setUp(self):
+        super(EngineTests, self).setUp()
+        self.channel = make_channel()
+
+    def rule(self, eval_func, lower=None, upper=None, state=Rule.RULE_ACTIVE):
+        rule_type = RuleType.objects.create(name=eval_func, description=eval_func, eval_func=eval_func)
+        rule = Rule.objects.create(name=eval_func, rule_type=rule_type, lower_threshold=lower, upper_threshold=upper,
+                                   action=Rule.SEND_GUI_ALERT, state=state)
+        self.channel.rules.add(rule)
+        return rule
+
+    def readings(self, *values):
+        return [Reading(channel=self.channel, monitor_time=from_seconds(DAY + i), value=value)
+                for i, value in enumerate(values)]
+
+    def evaluate(self, *values):
+        return [sorted((rule.name, bool(matched)) for rule, matched in results)
+                for results in get_engine().evaluate(self.readings(*values))]
+
+    def test_operators(self):
+        self.rule('eval_lt', lower=10)
+        self.rule('eval_gt', upper=30)
+        self.rule('range', lower=10, upper=30)
+        # several readings of one channel in a batch
+        self.assertEqual(self.evaluate(5, 20, 35), [
+            [('eval_gt', False), ('eval_lt', True), ('range', True)],
+            [('eval_gt', False), ('eval_lt', False), ('range', False)],
+            [('eval_gt', True), ('eval_lt', False), ('range', True)],
+        ])
+
+    def test_missing_threshold_never_matches(self):
+        self.rule('range', upper=30)
+        self.assertEqual(self.evaluate(-100, 35), [[('range', False)], [('range', True)]])
+        rule = Rule(lower_threshold=None, upper_threshold=30)
+        self.assertFalse(rule.range(Reading(value=-100)))
+        self.assertTrue(rule.range(Reading(value=35)))
+
+    def test_inactive_rules_are_skipped(self):
+        self.rule('eval_gt', upper=30, state=Rule.RULE_INACTIVE)
+        self.assertEqual(self.evaluate(35), [[]])
+
+    def test_recompiles_after_rule_edit(self):
+        rule = self.rule('eval_gt', upper=30)
+        self.assertEqual(self.evaluate(35), [[('eval_gt', True)]])
+        rule.upper_threshold = 40
+        rule.save()
+        self.assertEqual(self.evaluate(35), [[('eval_gt', False)]])
+
+    def test_recompiles_when_another_process_resets(self):
+        engine = get_engine()
+        bump(VERSION_KEY)
+        self.assertIsNot(get_engine(), engine)
+
+    def test_paused_rule_resolves_but_does_not_open(self):
+        rule = self.rule('eval_gt', upper=30, state=Rule.RULE_PAUSED)
+        reading = self.readings(35)[0]
+        outbox = []
+        evaluate_reading(state.get_state(self.channel.pk), reading, get_engine().evaluate([reading])[0], outbox)
+        self.assertFalse(Alert.objects.exists())
+
+        alert = Alert.objects.create(channel=self.channel, monitor=self.channel.monitor, rule=rule, active=True)
+        for value in (35, 20):
+            reading = self.readings(value)[0]
+            evaluate_reading(state.get_state(self.channel.pk), reading, get_engine().evaluate([reading])[0], outbox)
+        self.assertFalse(Alert.objects.get(pk=alert.pk).active)
+        self.assertEqual(outbox, [(alert.id, True, None)])
+
+
+def epoch(*when):
+    """ epoch seconds of a UTC date and time """
+    return calendar.timegm(datetime.datetime(*when).timetuple())
+
+
+class ColdStoreTests(TestCase):
+    def setUp(self):
+        self.channel = make_channel()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        patcher = mock.patch.object(conf, 'COLD_STORAGE', self.root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def add(self, *seconds):
+        Reading.objects.bulk_create([Reading(channel=self.channel, monitor_time=from_seconds(when), value=when)
+                                     for when in seconds])
+
+    def read(self, start, end=None):
+        pieces = list(coldstore.readings_between(self.channel.pk, from_seconds(start),
+                                                 None if end is None else from_seconds(end)))
+        return np.concatenate([seconds for seconds, values in pieces]).tolist() if pieces else []
+
+    def test_reads_table_around_and_between_partitions(self):
+        december, february = epoch(2015, 12, 10), epoch(2016, 2, 10)
+        self.add(december, february)
+        self.assertEqual(coldstore.compact(from_seconds(epoch(2016, 3, 1))), 2)
+        self.assertEqual([month.month for month in coldstore.partitions(self.channel.pk)], [12, 2])
+        # left in (or uploaded late to) the table: before the first partition, in a month
+        # without one, in a partitioned month and after the last
+        late = [epoch(2015, 11, 5), epoch(2016, 1, 20), epoch(2016, 2, 20), epoch(2016, 3, 5)]
+        self.add(*late)
+        self.assertEqual(self.read(epoch(2015, 11, 1)), sorted(late + [december, february]))
+        self.assertEqual(self.read(epoch(2015, 12, 1), epoch(2016, 2, 15)), [december, late[1], february])
+
+    def test_keeps_sub_second_times(self):
+        when = epoch(2016, 1, 10) + 0.25
+        self.add(when)
+        coldstore.compact(from_seconds(epoch(2016, 2, 1)))
+        self.assertFalse(Reading.objects.exists())
+        self.assertEqual(self.read(epoch(2016, 1, 1)), [when])
+        self.assertEqual(self.read(when + 0.1), [])
+
+    def test_reads_whole_second_partitions(self):
+        month = datetime.datetime(2016, 1, 1)
+        coldstore.write_partition(self.channel.pk, month, {'id': np.array([1, 2], dtype=np.int64),
+                                                           'time': np.array([60, 120], dtype=np.uint32),
+                                                           'value': np.array([1, 2], dtype=np.float32),
+                                                           'valid': np.array([True, True])})
+        self.assertEqual(self.read(epoch(2016, 1, 1), epoch(2016, 1, 1, 0, 1, 30)), [epoch(2016, 1, 1, 0, 1)])
+
+
+class ReadingsViewTests(StateTestCase):
+    def setUp(self):
+        super(ReadingsViewTests, self).setUp()
+        self.channel = make_channel()
+        user = User.objects.create_user('viewer', password='secret')
+        Preference.objects.create(user=user, measurement_system=Unit.METRIC)
+        self.client.login(username='viewer', password='secret')
+        self.now = int(time.time())
+        self.url = '/monitor/get_readings/{}/1/'.format(self.channel.pk)
+
+    def ingest(self, *samples):
+        return ingest_readings([{'channel': self.channel.pk, 'monitor_time': parse_time(self.now + seconds),
+                                 'value': value} for seconds, value in samples])
+
+    def get(self, headers=None, **params):
+        # enough points that the raw readings are served
+        params.setdefault('points', 100000)
+        return self.client.get(self.url, params, **(headers or {}))
+
+    def body(self, response):
+        return json.loads(b''.join(response.streaming_content).decode('utf-8'))
+
+    def test_unchanged_history_is_not_modified(self):
+        self.ingest((-120, 20.0))
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        self.assertEqual(self.get(headers={'HTTP_IF_NONE_MATCH': etag}).status_code, 304)
+        self.assertEqual(self.get(headers={'HTTP_IF_MODIFIED_SINCE': last_modified}).status_code, 304)
+
+        self.ingest((-60, 21.0))
+        response = self.get(headers={'HTTP_IF_NONE_MATCH': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_not_modified_sees_deferred_pointers(self):
+        self.ingest((-120, 20.0))
+        etag = self.get()['ETag']
+        with mock.patch.object(conf, 'DEFERRED_POINTERS', True):
+            self.ingest((-60, 21.0))
+            self.assertEqual(self.get(headers={'HTTP_IF_NONE_MATCH': etag}).status_code, 200)
+
+    def test_since(self):
+        self.ingest((-120, 20.0), (-60, 21.0))
+        body = self.body(self.get(since=0, format='columnar'))
+        self.assertEqual([value for chunk in body['chunks'] for value in chunk['y']], [20.0, 21.0])
+        self.assertEqual(body['since'], self.now - 60)
+
+        body = self.body(self.get(since=body['since'], format='columnar'))
+        self.assertEqual([value for chunk in body['chunks'] for value in chunk['y']], [])
+        self.assertEqual(body['since'], self.now - 60)
+
+        self.ingest((-30, 22.0))
+        body = self.body(self.get(since=body['since'], format='columnar'))
+        self.assertEqual([value for chunk in body['chunks'] for value in chunk['y']], [22.0])
+        self.assertEqual(body['since'], self.now - 30)
+
+    def test_bad_parameters(self):
+        self.assertEqual(self.get(points='many').status_code, 400)
+        self.assertEqual(self.get(since='yesterday').status_code, 400)
+
+
+class EventsTests(StateTestCase):
+    def setUp(self):
+        super(EventsTests, self).setUp()
+        self.channel = make_channel()
+
+    def test_read_filters_by_channel(self):
+        events.publish([{'type': 'alert', 'channel': self.channel.pk, 'state': 'open'},
+                        {'type': 'alert', 'channel': self.channel.pk + 1, 'state': 'open'}])
+        self.assertEqual(events.latest(), 2)
+        self.assertEqual(events.read(0, {self.channel.pk}),
+                         (2, [(1, {'type': 'alert', 'channel': self.channel.pk, 'state': 'open'})], False))
+        self.assertEqual(events.read(2, {self.channel.pk}), (2, [], False))
+
+    def test_read_stops_at_unwritten_event(self):
+        events.publish([{'type': 'alert', 'channel': self.channel.pk, 'state': 'open'}])
+        # a publisher that took number 2 and hasn't written it yet
+        cache.incr(events.SEQUENCE_KEY)
+        events.publish([{'type': 'alert', 'channel': self.channel.pk, 'state': 'resolved'}])
+        after, found = events.read(0, {self.channel.pk})[:2]
+        self.assertEqual((after, [number for number, event in found]), (1, [1]))
+        with mock.patch.object(events.time, 'time', return_value=time.time() + conf.EVENT_GRACE + 1):
+            after, found = events.read(after, {self.channel.pk})[:2]
+        self.assertEqual((after, [number for number, event in found]), (3, [3]))
+
+    def test_lost_counter_resyncs(self):
+        events.publish([{'type': 'alert', 'channel': self.channel.pk, 'state': 'open'}] * 5)
+        cache.delete(events.SEQUENCE_KEY)
+        events.publish([{'type': 'alert', 'channel': self.channel.pk, 'state': 'resolved'}])
+        self.assertEqual(events.read(5, {self.channel.pk}),
+                         (1, [(1, {'type': 'alert', 'channel': self.channel.pk, 'state': 'resolved'})], True))
+
+    def test_live_events_view(self):
+        user = User.objects.create_user('viewer', password='secret')
+        Preference.objects.create(user=user, measurement_system=Unit.METRIC)
+        self.client.login(username='viewer', password='secret')
+        readings = ingest_readings([{'channel': self.channel.pk, 'monitor_time': parse_time(DAY), 'value': 20.0}])
+        events.publish(events.reading_events(readings))
+
+        body = json.loads(self.client.get('/monitor/events', {'channels': self.channel.pk}).content.decode('utf-8'))
+        self.assertEqual(body, {'after': 1, 'events': [], 'resync': False})
+
+        body = json.loads(self.client.get('/monitor/events', {'channels': self.channel.pk, 'after': 0})
+                          .content.decode('utf-8'))
+        self.assertEqual((body['after'], body['resync']), (1, False))
+        self.assertEqual([(event['id'], event['value'], event['units']) for event in body['events']],
+                         [(readings[0].pk, 20.0, 'C')])
+
+        body = json.loads(self.client.get('/monitor/events', {'channels': self.channel.pk, 'after': 7})
+                          .content.decode('utf-8'))
+        self.assertEqual(body['resync'], True)
+        self.assertEqual(body['after'], 1)
+
+    def test_live_events_rejects_bad_ids(self):
+        User.objects.create_user('viewer', password='secret')
+        self.client.login(username='viewer', password='secret')
+        self.assertEqual(self.client.get('/monitor/events', {'channels': 'air'}).status_code, 400)
+
+
+class NotifyTests(StateTestCase):
+    def setUp(self):
+        super(NotifyTests, self).setUp()
+        self.channel = make_channel()
+        rule_type = RuleType.objects.create(name='above', description='above', eval_func='eval_gt')
+        self.rule = Rule.objects.create(name='above', rule_type=rule_type, upper_threshold=30,
+                                        action=Rule.SEND_EMAIL_TEXT_ALERT)
+        self.users = [User.objects.create(username=name, email='{}@example.com'.format(name), first_name=name)
+                      for name in ('ann', 'bob')]
+        for user in self.users:
+            Preference.objects.create(user=user, contact_method=Preference.EMAIL)
+            self.rule.contacts.add(user)
+        Reading.objects.bulk_create([Reading(channel=self.channel, monitor_time=from_seconds(DAY + i), value=35.0 + i)
+                                     for i in range(2)])
+        self.alerts = [Alert.objects.create(channel=self.channel, monitor=self.channel.monitor, rule=self.rule,
+                                            reading=reading, active=True)
+                       for reading in Reading.objects.order_by('monitor_time')]
+
+    def recipients(self):
+        return sorted(address for message in mail.outbox for address in message.to)
+
+    def test_one_message_per_contact_per_batch(self):
+        alert = self.alerts[0]
+        # one reminder per matching reading, and a retry for one contact, in the same batch
+        sent, failed = dispatch([(alert.id, False, None), (alert.id, False, None), (alert.id, False, [self.users[0].id])])
+        self.assertEqual((sent, failed), (2, []))
+        self.assertEqual(self.recipients(), ['ann <ann@example.com>', 'bob <bob@example.com>'])
+        self.assertIn('35.0', mail.outbox[0].body)
+
+    def test_retries_failed_recipients(self):
+        alert = self.alerts[0]
+        send = EmailBackend.send_messages
+
+        def refuse_ann(backend, messages):
+            if any('ann@' in address for message in messages for address in message.to):
+                raise IOError('550 mailbox unavailable')
+            return send(backend, messages)
+
+        with mock.patch.object(EmailBackend, 'send_messages', refuse_ann), \
+                mock.patch.object(process_alerts, 'apply_async') as retry:
+            self.assertEqual(process_alerts([(alert.id, False, None)]), 1)
+        retry.assert_called_once_with(([(alert.id, False, [self.users[0].id])], 1), countdown=conf.NOTIFY_RETRY_DELAY)
+        self.assertEqual(self.recipients(), ['bob <bob@example.com>'])
+
+        # the retry goes to the failed contact only
+        mail.outbox = []
+        self.assertEqual(dispatch([(alert.id, False, [self.users[0].id])]), (1, []))
+        self.assertEqual(self.recipients(), ['ann <ann@example.com>'])
+
+    def test_digest_groups_notifications(self):
+        Preference.objects.filter(user=self.users[1]).update(digest_minutes=10)
+        dispatch([(alert.id, False, None) for alert in self.alerts])
+        self.assertEqual(self.recipients(), ['ann <ann@example.com>'] * 2)
+        self.assertEqual(PendingNotification.objects.filter(user=self.users[1]).count(), 2)
+
+        mail.outbox = []
+        now = datetime.datetime.now()
+        self.assertEqual(send_digests(now), 0)
+        self.assertEqual(send_digests(now + datetime.timedelta(minutes=11)), 1)
+        self.assertEqual(self.recipients(), ['bob <bob@example.com>'])
+        self.assertIn('2 notifications', mail.outbox[0].subject)
+        self.assertIn('35.0', mail.outbox[0].body)
+        self.assertIn('36.0', mail.outbox[0].body)
+        self.assertFalse(PendingNotification.objects.exists())
+
+
+class OverdueTests(StateTestCase):
+    def setUp(self):
+        super(OverdueTests, self).setUp()
+        self.channel = make_channel()
+        self.monitor = self.channel.monitor
+        Monitor.objects.filter(pk=self.monitor.pk).update(
+            last_update=datetime.datetime.now() - datetime.timedelta(hours=1))
+
+    def test_raised_once_and_resolved_when_readings_resume(self):
+        opened, resolved = check_overdue()
+        alert = Alert.objects.get(alert_type=Alert.MONITOR_OVERDUE_ALERT, monitor=self.monitor)
+        self.assertEqual((opened, resolved), ([(alert.id, False, None)], []))
+        self.assertEqual(check_overdue(), ([], []))
+
+        ingest_readings([{'channel': self.channel.pk, 'monitor_time': parse_time(time.time()), 'value': 20.0}])
+        self.assertEqual(check_overdue(), ([], [(alert.id, True, None)]))
+        self.assertFalse(Alert.objects.get(pk=alert.pk).active)
+
+    def test_inactive_monitor_closed_silently(self):
+        check_overdue()
+        Monitor.objects.filter(pk=self.monitor.pk).update(status=Monitor.INACTIVE)
+        self.assertEqual(check_overdue(), ([], []))
+        self.assertFalse(Alert.objects.filter(active=True).exists())
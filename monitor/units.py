@@ -0,0 +1,103 @@
+from __future__ import absolute_import
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from monitor.models import Unit
+from monitor import conf
+import numpy as np
+import time
+
+# Unit conversions by name, applied to whole arrays (plain floats work too). A Unit's
+# m_to_i_function/i_to_m_function is either the name of a registered conversion or an
+# affine conversion written "affine:<scale>:<offset>", e.g. "affine:1.8:32" for Celsius to
+# Fahrenheit. Every Unit's pair of conversions is loaded in one query and kept for the
+# process; saving or deleting a Unit drops them, and they are reloaded after
+# conf.STATE_TTL seconds so changes made by other processes are picked up too.
+CONVERSIONS = {}
+_functions = {}
+# (unit id -> (m_to_i name, i_to_m name), expiry time); replaced whole, never mutated
+_units = (None, 0)
+
+
+def register(name):
+    """ decorator adding a conversion to the registry under `name` """
+    def decorator(func):
+        CONVERSIONS[name] = func
+        _functions.pop(name, None)
+        return func
+    return decorator
+
+
+@register('identity')
+def identity(values):
+    return values
+
+
+@register('celcius_to_fahrenheit')
+def celcius_to_fahrenheit(values):
+    return np.asarray(values, dtype=np.float64) * 9 / 5 + 32
+
+
+@register('fahrenheit_to_celcius')
+def fahrenheit_to_celcius(values):
+    return (np.asarray(values, dtype=np.float64) - 32) * 5 / 9
+
+
+def conversion(name):
+    """ returns the conversion function for a name or an "affine:<scale>:<offset>" spec;
+    raises ValueError for anything else """
+    func = _functions.get(name)
+    if func is not None:
+        return func
+    if name in CONVERSIONS:
+        func = CONVERSIONS[name]
+    elif name.startswith('affine:'):
+        try:
+            scale, offset = [float(part) for part in name[len('affine:'):].split(':')]
+        except ValueError:
+            raise ValueError('affine conversions are written affine:<scale>:<offset>, not {!r}'.format(name))
+        func = lambda values: np.asarray(values, dtype=np.float64) * scale + offset
+    else:
+        raise ValueError('unknown unit conversion {!r}'.format(name))
+    _functions[name] = func
+    return func
+
+
+def convert(name, values):
+    """ converts a value or an array of values with the named conversion """
+    result = conversion(name)(values)
+    if np.ndim(result) == 0:
+        return float(result)
+    return result
+
+
+def converter(unit_id, channel_system, user_system):
+    """ the array conversion from a channel's measurement system to a user's, or None when
+    no conversion is needed """
+    if channel_system == user_system:
+        return None
+    m_to_i, i_to_m = _load().get(unit_id, ('identity', 'identity'))
+    name = m_to_i if user_system == Unit.IMPERIAL else i_to_m
+    if name == 'identity':
+        return None
+    return conversion(name)
+
+
+def reset():
+    global _units
+    _units = (None, 0)
+
+
+def _load():
+    global _units
+    units, expires = _units
+    if units is None or expires < time.time():
+        units = dict((pk, (m_to_i, i_to_m)) for pk, m_to_i, i_to_m in
+                     Unit.objects.values_list('pk', 'm_to_i_function', 'i_to_m_function'))
+        _units = (units, time.time() + conf.STATE_TTL)
+    return units
+
+
+@receiver(post_save, sender=Unit)
+@receiver(post_delete, sender=Unit)
+def unit_changed(sender, instance, **kwargs):
+    reset()
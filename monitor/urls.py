@@ -10,4 +10,6 @@ urlpatterns = [
     url(r'^channel/(?P<channel_id>\d+)/$', views.channel),
     url(r'^channel/(?P<channel_id>\d+)/(?P<days>\d+)/$', views.channel),
     url(r'^ack/', views.ack),
+    url(r'^metrics$', views.export_metrics),
+    url(r'^events$', views.live_events),
 ]
@@ -0,0 +1,77 @@
+from __future__ import absolute_import
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from monitor import conf
+import numpy as np
+import datetime
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def bump(key):
+    """ increments a version counter in the shared cache, creating it if needed """
+    cache.add(key, 0, None)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # evicted between add and incr
+        cache.add(key, 0, None)
+        return cache.incr(key)
+
+
+def utcnow():
+    """ the current time in the form the database stores readings (naive UTC unless USE_TZ
+    is on), for stamps compared against a reading's monitor_time """
+    if settings.USE_TZ:
+        return timezone.now()
+    return datetime.datetime.utcnow()
+
+
+def to_seconds(times):
+    """ converts a sequence of datetimes (naive UTC or aware) to an array of epoch seconds """
+    times = [timezone.make_naive(t, timezone.utc) if timezone.is_aware(t) else t for t in times]
+    return (np.array(times, dtype='datetime64[us]') - np.datetime64(EPOCH, 'us')).astype(np.int64) / 1e6
+
+
+def from_seconds(seconds):
+    """ converts epoch seconds back to a datetime in the form the database stores """
+    when = EPOCH + datetime.timedelta(seconds=float(seconds))
+    if settings.USE_TZ:
+        when = timezone.make_aware(when, timezone.utc)
+    return when
+
+
+def to_micros(when):
+    """ converts a datetime (naive UTC or aware) to whole epoch microseconds, exactly """
+    if timezone.is_aware(when):
+        when = timezone.make_naive(when, timezone.utc)
+    return (when - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def from_micros(micros):
+    """ converts epoch microseconds back to a datetime in the form the database stores """
+    when = EPOCH + datetime.timedelta(microseconds=int(micros))
+    if settings.USE_TZ:
+        when = timezone.make_aware(when, timezone.utc)
+    return when
+
+
+def batches(rows, size=None):
+    """ groups (monitor_time, value) rows into (epoch seconds, values) array pairs """
+    size = size or conf.HISTORY_BATCH
+    if hasattr(rows, 'iterator'):
+        rows = rows.iterator()
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield _arrays(chunk)
+            chunk = []
+    if chunk:
+        yield _arrays(chunk)
+
+
+def _arrays(chunk):
+    times, values = zip(*chunk)
+    return to_seconds(times), np.array(values, dtype=np.float64)
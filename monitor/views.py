@@ -1,46 +1,71 @@
 from django.shortcuts import render, redirect
-from django.http import HttpResponse
+from django.http import (HttpResponse, StreamingHttpResponse, HttpResponseForbidden, HttpResponseBadRequest,
+                         HttpResponseNotModified)
+from django.utils import timezone
+from django.utils.http import http_date, parse_http_date_safe
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login, logout
+from django.core.cache import cache
 import datetime
 from dateutil import tz
 import time
+from monitor.models import Channel, Preference, Alert, User, Checkpoint
+from monitor.history import pick_resolution, series, stream_json, local_strings
+from monitor.ingest import newest_reading
+from monitor.utils import to_seconds, from_seconds
+from monitor import conf, metrics, events, rollups, units
+import calendar
+import hashlib
+import numpy as np
 import json
-from collections import OrderedDict
-from monitor.models import Channel, Reading, Unit, Preference, Alert, User
 
+# how the dashboard shows reading times
+DISPLAY_TIME = '%b %d, %Y %H:%M:%S'
+
+@metrics.timed('view', view='index')
 @login_required
 def index(request):
-    channels = Channel.objects.filter(status__in=[Channel.ENABLED, Channel.PAUSED])
-    latest_readings = {}
     user_system = Preference.objects.get(user=request.user).measurement_system
+    # the snapshot only depends on the measurement system, so every user shares it
+    key = 'monitor:dashboard:{}'.format(user_system)
+    # the live stream resumes from the last event published before the snapshot was built
+    cached = cache.get_many([key, key + ':events'])
+    latest_readings = cached.get(key)
+    events_after = cached.get(key + ':events', 0)
+    if latest_readings is None:
+        events_after = events.latest()
+        latest_readings = latest_snapshot(user_system)
+        cache.set_many({key: latest_readings, key + ':events': events_after}, conf.DASHBOARD_TTL)
+    return render(request, 'monitor/dashboard.html', {'latest_readings': latest_readings,
+                                                      'events_after': events_after,
+                                                      'event_poll': int(conf.EVENT_POLL * 1000)})
+
+def latest_snapshot(user_system):
+    """ latest valid reading and alert status of every enabled or paused channel, built
+    from one query for the channels (and their last valid readings) and one for alerts """
+    channels = (Channel.objects.filter(status__in=[Channel.ENABLED, Channel.PAUSED], last_valid_reading__isnull=False)
+                .select_related('monitor', 'channel_type__units', 'last_valid_reading'))
+    alerting = set(Alert.objects.filter(active=True, channel__isnull=False).values_list('channel_id', flat=True))
+    latest_readings = {}
 
     # for time conversion  UTC to local
     from_zone = tz.gettz('UTC')
     to_zone = tz.gettz('America/New_York')
 
     for channel in channels:
-        channel_system = channel.channel_type.measurement_system
-        latest = Reading.objects.filter(channel=channel, is_valid=True).order_by('-monitor_time')
-        if len(latest) > 0:
-            reading = latest[0]
-            if user_system == channel_system:
-                value = reading.value
-            elif user_system == Unit.IMPERIAL:
-                value = channel.channel_type.units.m_to_i(reading.value)
-            else:
-                value = channel.channel_type.units.i_to_m(reading.value)
-
-            utc = reading.monitor_time.replace(tzinfo=from_zone)
-            eastern = utc.astimezone(to_zone).strftime("%b %d, %Y %H:%M:%S")
-            units = channel.get_unit_abbrevs()[user_system]
-            alerts = Alert.objects.filter(channel=channel, active=True)
-            if len(alerts) > 0:
-                status = 'alert'
-            else:
-                status = 'ok'
-            latest_readings[channel.__str__()] = [value, channel.id, units, eastern, status]
-    return render(request, 'monitor/dashboard.html', {'latest_readings': latest_readings})
+        reading = channel.last_valid_reading
+        convert = converter(channel, user_system)
+        value = float(convert(reading.value)) if convert else reading.value
+
+        utc = reading.monitor_time.replace(tzinfo=from_zone)
+        eastern = utc.astimezone(to_zone).strftime(DISPLAY_TIME)
+        units = channel.get_unit_abbrevs()[user_system]
+        if channel.id in alerting:
+            status = 'alert'
+        else:
+            status = 'ok'
+        latest_readings[channel.__str__()] = [value, channel.id, units, eastern, status]
+    return latest_readings
 
 def user_login(request):
     if request.method == 'POST':
@@ -67,43 +92,142 @@ def user_logout(request):
     logout(request)
     return render(request, 'monitor/login.html', {'next':'/monitor/index/'})
 
+@metrics.timed('view', view='channel')
 def channel(request, channel_id, days=30):
     chan = Channel.objects.get(pk=channel_id)
 
     units = chan.channel_type.units
     system = Preference.objects.get(user=request.user).measurement_system
-    context = {'channel': chan, 'days': days, 'units': units, 'system': system}
+    context = {'channel': chan, 'days': days, 'units': units, 'system': system, 'events_after': events.latest(),
+               'event_poll': int(conf.EVENT_POLL * 1000)}
     return render(request, 'monitor/channel_detail.html', context)
     
 def get_readings(request, channel_id, days=30):
-    chan = Channel.objects.get(pk=channel_id)
+    """ a channel's history over the last `days` days as streamed JSON
+
+    ?since=<epoch seconds> (0 for the whole window) returns only what is newer than an
+    earlier response's "since" value and adds the next cursor. The ETag comes from the
+    channel's newest reading (and the rollup checkpoint when rollups are served) and
+    Last-Modified from that reading's time, both taken from the channel's last_reading
+    pointer (or its pending value while pointers are deferred), so an unchanged request
+    is answered with a 304 without touching the readings.
+    """
+    started = time.perf_counter()
+    try:
+        points = int(request.GET.get('points', 0))
+    except ValueError:
+        return HttpResponseBadRequest('points must be a number')
+    chan = Channel.objects.select_related('channel_type__units').get(pk=channel_id)
     days_ago = datetime.timedelta(days=int(days))
-    earliest = datetime.datetime.now() - days_ago
-    readings = Reading.objects.filter(channel=chan, monitor_time__gt=earliest, is_valid=True).order_by('monitor_time')
-    response_data = OrderedDict()
+    # long ranges come from the rollups at roughly one point per pixel of the chart
+    resolution = pick_resolution(days_ago.total_seconds(), points)
     user_pref = Preference.objects.get(user = request.user)
     user_system = user_pref.measurement_system
-    channel_system = chan.channel_type.measurement_system
-    response_data['unit'] = chan.get_units()[user_system]
 
-    from_zone = tz.gettz('UTC')
-    to_zone = tz.gettz('America/New_York')
+    newest_id, last_modified = newest_reading(chan)
+    if last_modified is not None and timezone.is_naive(last_modified):
+        # stored as naive UTC when USE_TZ is off
+        last_modified = timezone.make_aware(last_modified, timezone.utc)
+    version = [newest_id, user_system]
+    if resolution is not None:
+        version.append(Checkpoint.objects.filter(name=rollups.CHECKPOINT).values_list('value', flat=True).first())
+    etag = '"{}"'.format(hashlib.md5(':'.join(str(part) for part in version).encode()).hexdigest())
+    if not_modified(request, etag, last_modified):
+        return conditional(HttpResponseNotModified(), etag, last_modified)
+
+    earliest = datetime.datetime.now() - days_ago
+    since = request.GET.get('since')
+    if since is not None:
+        try:
+            since = float(since)
+        except ValueError:
+            return HttpResponseBadRequest('since must be epoch seconds')
+        # a reading newer than the cursor, or the (possibly still filling) bucket at it
+        cursor = since + 1e-6 if resolution is None else since - 1e-6
+        earliest = from_seconds(max(to_seconds([earliest])[0], cursor))
+    readings = series(chan.id, earliest, resolution)
+    # values are converted a batch at a time
+    convert = converter(chan, user_system)
+
+    content = stream_json(readings, chan.get_units()[user_system], convert,
+                          columnar=request.GET.get('format') == 'columnar', since=since)
+    response = StreamingHttpResponse(metrics.timed_stream('view', content, started, view='get_readings'),
+                                     content_type="application/json")
+    return conditional(response, etag, last_modified)
+
+def not_modified(request, etag, last_modified):
+    """ True when the request's If-None-Match (or, without one, If-Modified-Since) shows
+    the client already has this version """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return (if_modified_since is not None and last_modified is not None
+            and _http_seconds(last_modified) <= if_modified_since)
+
+def conditional(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(_http_seconds(last_modified))
+    # browsers revalidate every time instead of guessing a freshness lifetime
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+def _http_seconds(when):
+    if timezone.is_aware(when):
+        when = timezone.make_naive(when, timezone.utc)
+    return calendar.timegm(when.timetuple())
+
+def converter(channel, user_system):
+    """ the function converting the channel's values to the user's measurement system, or
+    None when they already match """
+    channel_type = channel.channel_type
+    return units.converter(channel_type.units_id, channel_type.measurement_system, user_system)
+
+@login_required
+def live_events(request):
+    """ new readings and alert changes for ?channels=1,2,... after event number ?after=, as
+    {"after": <?after= for the next poll>, "events": [...], "resync": <bool>}
+
+    Pages poll this every conf.EVENT_POLL seconds; each poll is answered straight from the
+    cache, and without ?after= only the current event number is returned. Reading values
+    are converted to the user's system and carry its unit abbreviation ("units") and
+    their local time as the charts show it ("local") and as the dashboard does ("display").
+    """
+    try:
+        channel_ids = set(int(channel_id) for channel_id in request.GET.get('channels', '').split(',') if channel_id)
+        after = request.GET.get('after')
+        after = int(after) if after else None
+    except ValueError:
+        return HttpResponseBadRequest('channels and after must be ids')
+    found = []
+    resync = False
+    if after is None:
+        after = events.latest()
+    else:
+        after, found, resync = events.read(after, channel_ids)
+    readings = [event for number, event in found if event['type'] == 'reading']
+    if readings:
+        system = Preference.objects.get(user=request.user).measurement_system
+        channels = dict((channel.id, channel) for channel in
+                        Channel.objects.filter(pk__in=set(event['channel'] for event in readings))
+                        .select_related('channel_type__units'))
+        local = local_strings(np.array([event['time'] for event in readings])).tolist()
+        for event, when in zip(readings, local):
+            channel = channels[event['channel']]
+            convert = converter(channel, system)
+            if convert is not None:
+                event['value'] = float(convert(event['value']))
+            event['units'] = channel.get_unit_abbrevs()[system]
+            event['local'] = when
+            event['display'] = datetime.datetime.strptime(when, '%Y-%m-%d %H:%M:%S').strftime(DISPLAY_TIME)
+    response = HttpResponse(json.dumps({'after': after, 'events': [event for number, event in found],
+                                        'resync': resync}),
+                            content_type='application/json')
+    response['Cache-Control'] = 'no-cache'
+    return response
 
-    for reading in readings:
-        if channel_system == user_system:
-            value = reading.value
-        elif user_system == Unit.IMPERIAL:
-            value = reading.channel.channel_type.units.m_to_i(reading.value)
-        else:
-            value = reading.channel.channel_type.units.i_to_m(reading.value)
-        
-        utc = reading.monitor_time.replace(tzinfo=from_zone)
-        eastern = utc.astimezone(to_zone)
-        
-        response_data[eastern.strftime("%Y-%m-%d %H:%M:%S")] = value
-    
-    return HttpResponse(json.dumps(response_data), content_type="application/json")
-    
 def ack(request):
     alert = Alert.objects.get(uuid=request.GET.get('aid'))
     if request.method == 'POST':
@@ -122,3 +246,13 @@ def ack(request):
         context = {'alert': alert, 'acknowledger': acknowledger}
 
     return render(request, 'monitor/alert_ack.html', context)
+
+def export_metrics(request):
+    """ every process's metrics in the Prometheus text format, for the bearer of
+    conf.METRICS_TOKEN or, without one, for staff """
+    if conf.METRICS_TOKEN:
+        if request.META.get('HTTP_AUTHORIZATION') != 'Bearer {}'.format(conf.METRICS_TOKEN):
+            return HttpResponseForbidden()
+    elif not (request.user.is_authenticated() and request.user.is_staff):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.exposition(), content_type='text/plain; version=0.0.4')